@@ -61,6 +61,8 @@ use constant EXTRACT_REPLICATES => 'Modules/tools/extract_replicates.py';
 use constant REPLICATE_LENGTH => 0;
 use constant REPLICATE_PERCENT => 0.97;   
 use constant REPLICATE_START => 20; # these three numbers are Tanya's standard values
+use constant CDHIT_PLAN => 'Modules/tools/cdhit_plan.py'; # estimates the h_vmem a dereplication job needs from its input
+use constant REPLICATE_H_VMEM => '2G'; # the h_vmem to request if the estimate fails
 
 # Fasta de-multiplexing and quality filtering
 use constant MINIMUM_SEQUENCE_LENGTH => 60;
@@ -69,6 +71,8 @@ use constant RL_MID_CONFIG_PARSE => 'data/MIDConfig_bdmMod_RL0.parse';
 # Listener parameters
 use constant WAIT_TIME => 120; # 300 seconds = 5 minutes
 use constant NO_CHANGE_IN_FILE_FOR_X_SECONDS => 60;
+use constant WAIT_FOR_MANIFEST => 'Modules/tools/wait_for_manifest.py'; # blocks until a dereplication run writes its completion manifest
+use constant REPLICATE_CLIENT => 'Modules/tools/replicate_client.py'; # submits a dereplication job to replicate_server.py; --print-socket gives the server's socket (batch_replicates_config.py)
 
 # split_run_check and parameters
 use constant SPLIT_RUN_CHECK => 'Modules/tools/split_run_check_combine.pl';
@@ -46,12 +46,40 @@ sub dereplicate{
   
   MessagesFileHandling->append_to_file("Dereplicator call:\t$command\n",$arg{outfile});
 
-  # write this as a job file and qsub the job
-  system("echo \"$command\" >$arg{jobName}\_DereplicateJob.txt");
+  my$derepSummary;
+  # the socket a replicate server listens on comes from batch_replicates_config.py, through the client
+  my$socket = `python ".Constants::REPLICATE_CLIENT()." --print-socket`;
+  chomp($socket) if defined $socket;
+  if (not $? and defined $socket and -S $socket) {
+    # a replicate server is running on this node: hand it the job and wait for the reply
+    my$client = "python ".Constants::REPLICATE_CLIENT()." --socket $socket --output cluster_summary ".$arg{fastaObj}->get_file()." ".Constants::REPLICATE_PERCENT()." ".Constants::REPLICATE_LENGTH()." ".Constants::REPLICATE_START()." $arg{jobName}\_Dereplicate";
+    MessagesFileHandling->append_to_file("Dereplicator server call:\t$client\n",$arg{outfile});
+    $derepSummary = `$client`;
+    if (($? >> 8) == 2) {
+      # the server can't be reached (a socket left behind by a server that died, say): qsub the job instead
+      MessagesFileHandling->append_to_file("Dereplicator server unreachable, submitting the job with qsub\n",$arg{outfile});
+      undef $derepSummary;
+    } else {
+      die "Dereplication through $socket failed (exit status ".($? >> 8).")\n" if $?;
+      chomp($derepSummary);
+    }
+  }
+  unless (defined $derepSummary) {
+    # write this as a job file and qsub the job
+    system("echo \"$command\" >$arg{jobName}\_DereplicateJob.txt");
 
-  system("qsub -l h_vmem=2G $arg{jobName}\_DereplicateJob.txt");
+    # request the memory cdhit_plan.py estimates the run needs for this input
+    my$plan = "python ".Constants::CDHIT_PLAN()." --h-vmem ".$arg{fastaObj}->get_file()." ".Constants::REPLICATE_PERCENT()." ".Constants::REPLICATE_START();
+    my$h_vmem = `$plan`;
+    chomp($h_vmem) if defined $h_vmem;
+    $h_vmem = Constants::REPLICATE_H_VMEM() if $? or not defined $h_vmem or $h_vmem !~ /^\d+[MG]$/;
+    MessagesFileHandling->append_to_file("Dereplicator h_vmem:\t$h_vmem\n",$arg{outfile});
 
-  my$derepSummary = MessagesFileHandling::wait_for_file("$arg{jobName}\_Dereplicate/extracted_clusters.cluster_summary");
+    system("qsub -l h_vmem=$h_vmem $arg{jobName}\_DereplicateJob.txt");
+
+    # extract_replicates.py writes completion.json once all its outputs are in place
+    $derepSummary = MessagesFileHandling::wait_for_manifest("$arg{jobName}\_Dereplicate/completion.json","cluster_summary");
+  }
 
   # GoodHeaders will have definitions for reads that are NOT replicates, and also for the single sequence (longest) that is used to represent replicate clusters
   my%GoodHeaders = process_cluster_summary($derepSummary);
@@ -112,6 +112,27 @@ sub wait_for_file{
   return $fileName;
 }
 
+=item $outputFile = wait_for_manifest($manifestFile,$outputName);
+
+Waits for the completion manifest (a JSON file) that extract_replicates.py writes when it finishes. Unlike wait_for_file, this doesn't poll every WAIT_TIME and then wait for the file size to settle: the outputs are renamed into place before the manifest, so the manifest appearing means everything is complete. The waiting is done by Modules/tools/wait_for_manifest.py, which uses inotify and returns within a second of the manifest being written.
+
+Returns the path the manifest lists for the output $outputName (e.g. "cluster_summary"). Dies if the run failed, with the error from the manifest.
+
+=cut
+
+sub wait_for_manifest{
+  my($manifest,$output) = @_;
+
+  print "Wait_for_manifest subroutine invoked at ".localtime().", waiting for manifest $manifest\n";
+
+  my$file = `python ${\Constants::WAIT_FOR_MANIFEST()} --output $output $manifest`;
+  die "Waiting for $manifest failed (exit status ".($? >> 8).")\n" if $?;
+  chomp($file);
+
+  print "Manifest $manifest found at ".localtime()."\n\n";
+  return $file;
+}
+
 # Maybe TODO: add a subroutine that looks for recheck jobs from split_run_check_combine
 #  If they exist, resubmit it with doubled memory and long queue?
 # Not quite sure how to do this - talk to J? Would require capturing the c#### code from his script
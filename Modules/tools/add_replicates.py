@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+#
+# Adds reads to a finished replicate filter run, without clustering the reads
+# it already has again.
+#
+# When a sample is topped up (another 454 region, or a rerun), the new reads
+# are compared with the representatives of the run's clusters by
+# cd-hit-est-2d.  A new read joins the cluster of the representative it
+# matches if it also starts with the same initial base pairs, the rule
+# split_clusters() applies; the rest are clustered among themselves with
+# cd-hit-est and split as usual, and become new clusters after the existing
+# ones.  Existing clusters keep their numbers and representatives.
+#
+# The cutoff, length difference and initial base pair requirements are the
+# earlier run's, from its completion.json, and the output files and the
+# manifest are updated in place.  Only the new reads are clustered or held in
+# memory: the representatives are streamed once into cd-hit-est-2d's database
+# (only those whose initial base pairs some new read has, since no other
+# cluster can take a new read), and the output files are streamed once to
+# write them again (see extract_clusters.update_outputs).
+#
+
+"""
+Usage: add_replicates.py [options] <input filename> <output directory>
+
+Adds the reads in <input filename> to the results of an earlier
+extract_replicates.py run in <output directory>, with the same parameters.
+The read names must not already be in the run.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import cdhit_parse
+import cdhit_run
+import extract_clusters
+import extract_replicates
+import fasta
+import wait_for_manifest
+
+from extract_replicates import DereplicationError
+
+
+def write_representatives(unique_file, db_file, bp_match, wanted=None):
+    """
+    Writes the representatives in a run's *_unique.fa (one per cluster, in
+    cluster order) to db_file, named by their cluster numbers.  With
+    'wanted', only those whose first bp_match bases are in it are written.
+    Returns the first bp_match bases of every representative, NUL padded,
+    in a bytearray, and the number written.
+    """
+    prefixes = bytearray()
+    written = 0
+    db = open(db_file, 'w')
+    try:
+        for (j, (name, sequence)) in enumerate(fasta.iterload(fasta.open_fasta(unique_file))):
+            prefix = sequence[:bp_match].ljust(bp_match, '\0')
+            prefixes.extend(prefix)
+            if wanted is None or prefix in wanted:
+                db.write('>%d\n%s\n' % (j + 1, sequence))
+                written = written + 1
+    finally:
+        db.close()
+    return prefixes, written
+
+
+def assign(cluster_file, reads, prefixes, bp_match):
+    """
+    Takes the *.clstr file object from cd-hit-est-2d against
+    write_representatives()' database, and returns a dict of the new read
+    IDs joining each cluster number, and a list of the IDs of the reads
+    that join none.  A read cd-hit lists under several clusters joins only
+    the first, in file order, whose prefix it shares.
+    """
+    joined = {}
+    taken = bytearray(len(reads))
+
+    for cluster in cdhit_parse.iter_clusters(cluster_file):
+        j = int(cluster.representative)
+        prefix = str(prefixes[(j - 1) * bp_match:j * bp_match])
+        for name in cluster.members[1:]:
+            i = reads.ids[name]
+            if taken[i]:
+                continue
+            if bp_match and reads.prefix(i, bp_match).ljust(bp_match, '\0') != prefix:
+                continue
+            joined.setdefault(j, []).append(i)
+            taken[i] = 1
+
+    for members in joined.itervalues():
+        members.sort()
+
+    return joined, [i for i in xrange(len(reads)) if not taken[i]]
+
+
+def add_reads(filename, dirname, processes=1, out=sys.stdout):
+    """
+    Adds the reads in a FASTA file to the run in dirname, updating its
+    output files and completion.json.  Returns the
+    extract_clusters.Summary of the whole run.  Raises DereplicationError
+    if it fails, in which case the run is left as it was.
+    """
+    start = time.time()
+
+    manifest_file = os.path.join(dirname, extract_replicates.manifest_name)
+    manifest = wait_for_manifest.read_manifest(manifest_file)
+    if manifest is None or manifest['status'] != 'complete':
+        raise DereplicationError('%s does not hold a completed run' % (dirname,))
+
+    parameters = manifest['parameters']
+    cutoff = parameters['cutoff']
+    length = parameters['length']
+    bp_test = parameters['bp']
+    compress = parameters.get('compress', False)
+    outfile = os.path.join(dirname, 'extracted_clusters')
+    old = extract_clusters.output_names(outfile, compress)
+
+    # Each increment (or attempt at one) gets its own tmp directory
+
+    increments = manifest.get('increments', [])
+    n = len(increments) + 1
+    while os.path.exists(os.path.join(dirname, 'tmp', 'increment_%d' % (n,))):
+        n = n + 1
+    tmp_dir = os.path.join(dirname, 'tmp', 'increment_%d' % (n,))
+    try:
+        os.makedirs(tmp_dir)
+    except OSError:
+        raise DereplicationError('Cannot make the directory %s' % (tmp_dir,))
+
+    # The new reads are written out for cd-hit as in extract_replicates.py
+
+    new_fasta_file = tmp_dir + '/input_fasta_file.fa'
+
+    try:
+        fasta_file = fasta.open_fasta(filename)
+    except IOError:
+        raise DereplicationError("This file could not be opened")
+
+    try:
+        input_fasta_file = open(new_fasta_file, 'w')
+        for (name, sequence) in fasta.iterload(fasta_file):
+            input_fasta_file.write('>%s\n%s\n' % (name, sequence))
+        input_fasta_file.close()
+        reads = extract_clusters.load_reads(new_fasta_file)
+    except ValueError:
+        raise DereplicationError('This file does not seem to be a fasta file.  Please try again with a fasta file', 0)
+
+    if not len(reads):
+        raise DereplicationError('There are no reads in %s' % (filename,), 0)
+
+    # Compare them with the representatives
+
+    cdhit_start = time.time()
+
+    wanted = None
+    if bp_test:
+        wanted = set([reads.prefix(i, bp_test).ljust(bp_test, '\0') for i in xrange(len(reads))])
+
+    db_file = tmp_dir + '/representatives.fa'
+    try:
+        (prefixes, written) = write_representatives(old['unique'], db_file, bp_test, wanted)
+    except IOError, e:
+        raise DereplicationError('Cannot open %s' % (e.filename,))
+
+    output_2d = tmp_dir + '/cdhit_2d_output'
+    if written:
+        (returncode, stderr) = cdhit_run.run_cdhit_2d(db_file, new_fasta_file, output_2d, cutoff, length, tmp_dir + '/cd-hit-2d')
+        if returncode != 0:
+            raise DereplicationError('cd-hit-est-2d failed\n%s' % (stderr,))
+    else:
+        open(output_2d + '.clstr', 'w').close()
+
+    try:
+        (joined, rest) = assign(open(output_2d + '.clstr'), reads, prefixes, bp_test)
+    except KeyError, e:
+        raise DereplicationError('\n%s is in the cd-hit-est-2d output but not in %s\n' % (e.args[0], filename))
+
+    # and cluster the rest among themselves
+
+    cdhit_output = tmp_dir + '/cdhit_output_temp'
+    rest_file = open(cdhit_output + '.fa', 'w')
+    for i in rest:
+        rest_file.write('>%s\n%s\n' % (reads.ids.names[i], reads.sequence(i)))
+    rest_file.close()
+
+    if rest:
+        (returncode, stderr) = cdhit_run.run_cdhit(cdhit_output + '.fa', cdhit_output, cutoff, length, tmp_dir + '/cd-hit')
+        if returncode != 0:
+            raise DereplicationError('cd-hit failed\n%s' % (stderr,))
+    else:
+        open(cdhit_output + '.clstr', 'w').close()
+
+    cdhit_time = time.time() - cdhit_start
+    extract_start = time.time()
+
+    try:
+        added = extract_clusters.extract(open(cdhit_output + '.clstr'), reads, bp_test)
+        (summary, outputs) = extract_clusters.update_outputs(outfile, filename, reads, joined, added, compress, processes)
+    except IOError, e:
+        raise DereplicationError('Cannot open %s' % (e.filename,))
+    except KeyError, e:
+        raise DereplicationError('\n%s is in the cd-hit output but not in %s\n' % (e.args[0], filename))
+    except ValueError, e:
+        raise DereplicationError(str(e))
+
+    print >>out, 'Added %d reads: %d joined %d existing clusters, %d formed %d new clusters\n' % (
+        len(reads), len(reads) - len(rest), len(joined), len(rest), len(added.cluster_set))
+    print >>out, extract_clusters.report(summary, 'text')
+    print >>out
+
+    increments.append({
+        'input': filename,
+        'reads': len(reads),
+        'joined': len(reads) - len(rest),
+        'clusters': len(added.cluster_set),
+        'timings': {
+            'cdhit': cdhit_time,
+            'extract': time.time() - extract_start,
+            'total': time.time() - start,
+        },
+    })
+
+    details = dict([(key, value) for (key, value) in manifest.iteritems()
+                    if key not in ('status', 'error', 'outputs', 'counts', 'finished')])
+    details['increments'] = increments
+    extract_clusters.write_manifest(manifest_file, 'complete', summary, outputs, **details)
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--processes", dest="processes", type="int", default=1,
+                      help="Number of threads to compress the output files on, if the run's are compressed (default: 1)")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        print __doc__
+        sys.exit(2)
+
+    (filename, dirname) = args
+
+    try:
+        add_reads(filename, dirname, options.processes)
+    except DereplicationError, e:
+        print e
+        sys.exit(e.exit_code)
+
+    print "Your results are in the directory: %s\n" % (dirname)
@@ -0,0 +1,38 @@
+#
+# Atomic file updates for the replicate filter scripts.
+#
+# Files that other processes watch (progress records, completion manifests) are
+# written to a temporary file in the same directory and renamed over the real
+# name, so a reader sees either the old contents or the new ones, never a
+# partial write.
+#
+
+import os
+import json
+import tempfile
+
+
+def write_file(path, data):
+    """
+    Replaces the file at 'path' with 'data' in one rename.
+    """
+    (fd, temp) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                  dir=os.path.dirname(path) or '.')
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(data)
+        f.close()
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except:
+        f.close()
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def write_json(path, record):
+    """
+    Replaces the file at 'path' with 'record' as JSON.
+    """
+    write_file(path, json.dumps(record, indent=1, sort_keys=True) + '\n')
@@ -0,0 +1,257 @@
+#! /usr/bin/env python
+#
+# Batch dereplication of many samples (e.g. every MID of a plate) in one job.
+#
+# Each sample is run through extract_replicates.dereplicate() in a pool of
+# worker processes, so a plate costs one job startup instead of one per MID.
+# The pool is sized to the cores and to the memory cd-hit may take per sample,
+# and each sample's run is planned on one core within that memory (see
+# cdhit_plan.py).
+# Samples are started largest file first, so a big sample doesn't end up
+# running alone at the end.
+#
+
+"""
+Usage: batch_replicates.py [options] <manifest> <sequence identity cutoff> <length difference requirement> <initial base pair requirement> <summary file>
+
+The manifest lists one sample per line, the FASTA file and its output
+directory separated by a tab:
+
+  sample_MID1.fna<TAB>sample_MID1_Dereplicate
+  sample_MID2.fna<TAB>sample_MID2_Dereplicate
+
+Blank lines and lines starting with # are ignored.  Every sample gets the
+same outputs as from extract_replicates.py, and the summary file gets one
+line per sample with its number of reads, unique reads and percent of
+replicates.
+"""
+
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+from optparse import OptionParser
+from cStringIO import StringIO
+
+import batch_replicates_config
+import resources
+import extract_replicates
+
+
+def read_manifest(f):
+    """
+    Returns the (fasta file, output directory) pairs of a manifest file
+    object.  Raises ValueError for a malformed line.
+    """
+    samples = []
+    for (number, line) in enumerate(f):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 2 or not fields[0] or not fields[1]:
+            raise ValueError('line %d of the manifest should be <fasta file><TAB><output directory>' % (number + 1,))
+        samples.append((fields[0], fields[1]))
+    return samples
+
+
+def pool_size(samples, processes=None, memory_per_sample=None):
+    """
+    How many samples to run at once: no more than the cores (or
+    'processes'), the samples, or the available memory allows.
+    """
+    size = processes or resources.available_cores()
+
+    if memory_per_sample is None:
+        memory_per_sample = batch_replicates_config.sample_memory_mb
+    memory = resources.available_memory()
+    if memory is not None and memory_per_sample > 0:
+        size = min(size, memory // memory_per_sample)
+
+    return max(min(size, len(samples)), 1)
+
+
+def run_sample(args):
+    """
+    Dereplicates one sample, given as an (index, fasta file, output
+    directory, cutoff, length, bp, settings) tuple, and returns (index,
+    reads, unique reads, percent, error, seconds).  Runs in a pool worker;
+    errors are returned, not raised.
+    """
+    (index, fasta_file, dirname, cutoff, length, bp, settings) = args
+    out = StringIO()
+
+    # Samples run side by side, so each is planned on one core, within the
+    # memory allowed per sample
+    settings = dict(settings)
+    settings.setdefault('threads', 1)
+    settings.setdefault('memory', batch_replicates_config.sample_memory_mb)
+
+    start = time.time()
+    made = True
+    try:
+        result = extract_replicates.dereplicate(fasta_file, cutoff, length, bp, dirname, out=out, **settings)
+        status = (int(result.num_seq), int(result.num_unique), result.percent, '')
+    except extract_replicates.OutputExistsError, e:
+        # The directory is another run's (or one still running): leave it be
+        made = False
+        status = (None, None, None, str(e).strip())
+    except extract_replicates.DereplicationError, e:
+        status = (None, None, None, str(e).strip())
+    except Exception:
+        status = (None, None, None, traceback.format_exc().strip().splitlines()[-1])
+
+    # Keep what extract_replicates.py would have printed with the outputs
+    if made and os.path.isdir(dirname + '/tmp'):
+        fp = open(dirname + '/tmp/extract.out', 'w')
+        fp.write(out.getvalue())
+        fp.close()
+
+    return (index,) + status + (time.time() - start,)
+
+
+def run_batch(samples, cutoff, length, bp, processes, settings):
+    """
+    Dereplicates every (fasta file, output directory) sample in a pool of
+    'processes' workers.  'settings' are keyword arguments for
+    extract_replicates.dereplicate().  Returns one (reads, unique reads,
+    percent, error, seconds) tuple per sample, in manifest order; the
+    counts are None for a sample that failed.
+    """
+    def size(sample):
+        try:
+            return os.path.getsize(sample[0])
+        except OSError:
+            return 0
+
+    order = sorted(range(len(samples)), key=lambda i: size(samples[i]), reverse=True)
+    jobs = [(i, samples[i][0], samples[i][1], cutoff, length, bp, settings) for i in order]
+
+    results = [None] * len(samples)
+    pool = Pool(processes)
+    try:
+        for result in pool.imap_unordered(run_sample, jobs, 1):
+            results[result[0]] = result[1:]
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def write_summary(samples, results, summary_file):
+    """
+    Writes the aggregated summary table and returns the number of samples
+    that failed.
+    """
+    out = open(summary_file, 'w')
+    out.write('Fasta file\tOutput directory\tNumber of sequences\tNumber of unique reads\tPercent of repeats\tSeconds\tError\n')
+
+    failed = 0
+    total_seq = 0
+    total_unique = 0
+    for ((fasta_file, dirname), (num_seq, num_unique, percent, error, seconds)) in zip(samples, results):
+        if error:
+            failed = failed + 1
+            out.write('%s\t%s\t\t\t\t%.1f\t%s\n' % (fasta_file, dirname, seconds, error.replace('\n', ' ')))
+        else:
+            total_seq = total_seq + num_seq
+            total_unique = total_unique + num_unique
+            out.write('%s\t%s\t%d\t%d\t%s\t%.1f\t\n' % (fasta_file, dirname, num_seq, num_unique, percent, seconds))
+
+    if total_seq:
+        out.write('Total\t\t%d\t%d\t%s\t\t\n' % (total_seq, total_unique,
+                                                round(float(total_seq - total_unique) / total_seq * 100, 2)))
+    out.close()
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--processes", dest="processes", type="int", default=0,
+                      help="Number of samples to run at once (default: number of cores, or the slots granted by the grid engine, limited by memory)")
+    parser.add_option("--sample-memory", dest="sample_memory", type="int", default=None,
+                      help="Memory in MB to allow for each sample when sizing the pool (default from batch_replicates_config.py)")
+    parser.add_option("--engine", dest="engine", type="choice", choices=["cdhit", "native"], default="cdhit",
+                      help="Replicate detection engine, as for extract_replicates.py")
+    parser.add_option("--collapse-duplicates", dest="collapse", action="store_true", default=False,
+                      help="Collapse exact duplicate reads before cd-hit, as for extract_replicates.py")
+    parser.add_option("--cache-dir", dest="cache_dir", default=batch_replicates_config.cdhit_cache_dir,
+                      help="Directory to cache cd-hit results in (default from batch_replicates_config.py)")
+    parser.add_option("--no-cache", dest="cache_dir", action="store_const", const=None,
+                      help="Always run cd-hit, even if a cache directory is configured")
+    parser.add_option("--compress-output", dest="compress", action="store_true", default=False,
+                      help="Write each sample's output files gzip (BGZF) compressed")
+    parser.add_option("--low-memory", dest="low_memory", action="store_true", default=False,
+                      help="Extract each sample's clusters in low-memory mode, as for extract_replicates.py")
+    parser.add_option("--packed", dest="packed", action="store_true", default=False,
+                      help="Load each sample's reads into memory packed 2 bits per base, as for extract_replicates.py")
+    parser.add_option("--memory-budget", dest="memory_budget", type="int", default=0,
+                      help="Extract each sample's clusters through sorted files on disk in about MEMORY_BUDGET MB, as for extract_replicates.py")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 5:
+        print __doc__
+        sys.exit(1)
+
+    (manifest, cutoff_input, length_input, bp_input, summary_file) = args
+
+    try:
+        cutoff = float(cutoff_input)
+        length = float(length_input)
+        bp = int(bp_input)
+    except ValueError:
+        print __doc__
+        sys.exit(2)
+
+    if cutoff > 1.0 or cutoff < 0.85:
+        print "Please input a cutoff value between 0.85 and 1.0"
+        sys.exit(2)
+    if length > 1.0:
+        print "Please input a length requirement value between 0 and 1.0"
+        sys.exit(2)
+    if bp < 0:
+        print "Please input an initial base pair requirement of 0 or more"
+        sys.exit(2)
+
+    try:
+        samples = read_manifest(open(manifest))
+    except IOError:
+        print 'Cannot open', manifest
+        sys.exit(2)
+    except ValueError, e:
+        print e
+        sys.exit(2)
+
+    if not samples:
+        print 'There are no samples in', manifest
+        sys.exit(2)
+
+    # Sharding would start a pool inside each worker, so samples run whole
+    settings = {
+        'engine': options.engine,
+        'collapse': options.collapse,
+        'cache_dir': options.cache_dir,
+        'compress': options.compress,
+        'low_memory': options.low_memory,
+        'memory_budget': options.memory_budget,
+        'packed': options.packed,
+    }
+    if options.sample_memory:
+        settings['memory'] = options.sample_memory
+
+    processes = pool_size(samples, options.processes, options.sample_memory)
+
+    start = time.time()
+    results = run_batch(samples, cutoff, length, bp, processes, settings)
+    failed = write_summary(samples, results, summary_file)
+
+    print open(summary_file).read()
+    print '%d samples in %.1f s with %d processes, %d failed.  The summary is in %s\n' % (
+        len(samples), time.time() - start, processes, failed, summary_file)
+
+    if failed:
+        sys.exit(2)
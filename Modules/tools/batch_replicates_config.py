@@ -11,3 +11,26 @@
 
 #cdhit_dir = "~tracyt/dev/replicates/scripts/cd-hit"
 cdhit_dir = "/srv/cgs/local/cd-hit/latest"
+
+# Where cd-hit results are cached, so reruns on the same input skip cd-hit.
+# None turns the cache off; extract_replicates.py --cache-dir overrides it.
+cdhit_cache_dir = None
+
+# Size limit of the cd-hit cache in bytes; least recently used results are
+# removed past it.
+cdhit_cache_size = 10 * 1024 * 1024 * 1024
+
+# Memory in MB to allow for each sample when batch_replicates.py sizes its
+# pool (cd-hit's smallest -M, 1000, plus the Python side); each sample's run is
+# planned within it (see cdhit_plan.py).  Also the memory to plan within where
+# the memory available can't be read.
+sample_memory_mb = 1500
+
+# Bounds in MB on the h_vmem Dereplicate.pm requests for a grid job, as
+# estimated by cdhit_plan.py for its input.
+min_h_vmem_mb = 1024
+max_h_vmem_mb = 16384
+
+# Unix socket replicate_server.py listens on and replicate_client.py sends
+# jobs to.
+server_socket = "/tmp/replicate_server.sock"
@@ -0,0 +1,611 @@
+#! /usr/bin/env python
+#
+# Benchmarks for the replicate filter tools.
+#
+# These generate synthetic input of increasing size and time the Python
+# stages of the dereplication path, so scaling regressions show up without
+# needing real sequencing data or cd-hit.  Try sizes from 10000 up to
+# 10000000 reads.
+
+"""
+Usage: benchmark_replicates.py <benchmark> [options]
+
+Benchmarks:
+  fasta     time fasta.iterload() / fasta.load() over synthetic FASTA files
+  clstr     time cdhit_parse.iter_clusters() over synthetic cd-hit .clstr files
+  memory    peak RSS of cluster extraction with each read store, including
+            the low-memory and external-memory modes
+  parallel  time fasta.load_parallel() on 1 to N processes (-j), and the
+            speedup over one process
+  stages    time and peak RSS of each stage of cluster extraction on 454-like
+            reads and clusters; --json saves the results, and --baseline
+            compares them with saved ones
+  generate  write 454-like reads and their *.clstr files to the workdir
+  sequtils  time the batch sequence functions in fasta.py (GC content,
+            validity, reverse complement) against the per-sequence ones
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import string
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import fasta
+import cdhit_parse
+import extract_clusters
+
+from optparse import OptionParser
+
+
+#
+# Synthetic input
+#
+
+def write_synthetic_fasta(path, num_reads, seed=0, line_width=60):
+    """
+    Writes 'num_reads' random 454-length DNA reads to 'path'.
+    Returns the number of bytes written.
+    """
+    rand = random.Random(seed)
+    out = open(path, 'w')
+    for i in xrange(num_reads):
+        length = rand.randint(100, 600)
+        seq = ''.join([rand.choice('ACGT') for _ in xrange(length)])
+        out.write('>SYN%08d length=%d\n' % (i, length))
+        for j in xrange(0, length, line_width):
+            out.write(seq[j:j + line_width] + '\n')
+    size = out.tell()
+    out.close()
+    return size
+
+
+def write_synthetic_clstr(path, num_reads, seed=0, mean_size=3):
+    """
+    Writes a cd-hit style *.clstr file covering 'num_reads' reads, with
+    cluster sizes drawn around 'mean_size'.  Returns the number of bytes
+    written.
+    """
+    rand = random.Random(seed)
+    out = open(path, 'w')
+    read = 0
+    cluster = 0
+    while read < num_reads:
+        size = min(num_reads - read, int(rand.expovariate(1.0 / mean_size)) + 1)
+        out.write('>Cluster %d\n' % cluster)
+        for i in xrange(size):
+            length = rand.randint(100, 600)
+            if i == 0:
+                out.write('%d\t%dnt, >SYN%08d... *\n' % (i, length, read))
+            else:
+                out.write('%d\t%dnt, >SYN%08d... at +/%.2f%%\n' % (i, length, read, rand.uniform(90, 100)))
+            read = read + 1
+        cluster = cluster + 1
+    size = out.tell()
+    out.close()
+    return size
+
+
+# 454-like reads, with their clusters.  Templates are slices of a large random
+# sequence; each read is a template cut to a length drawn around
+# read_length, with homopolymer errors (one base more or less in a run) at
+# homopolymer_rate per base, the dominant 454 error.  A fraction 'replicates'
+# of the reads are artificial replicates: copies of the previous template
+# from the same start, with their own length and errors.  A template and its
+# replicates are written next to each other and make one cluster, with the
+# longest read as its representative as cd-hit would pick.
+
+# Mean and standard deviation of the read length (GS FLX Titanium)
+read_length = (400, 100)
+
+# Homopolymer errors per base
+homopolymer_rate = 0.002
+
+# Size of the random sequence templates are cut from
+template_pool = 1 << 24
+
+
+# Hex digits map four to a base, so a random number gives random bases
+_hex_bases = string.maketrans('0123456789abcdef', 'ACGTACGTACGTACGT')
+
+
+def _template_pool(rand, size):
+    digits = ('%x' % rand.getrandbits(4 * size)).zfill(size)
+    return digits.translate(_hex_bases)
+
+
+def _poisson(rand, mean):
+    limit = math.exp(-mean)
+    k = 0
+    p = rand.random()
+    while p > limit:
+        k = k + 1
+        p = p * rand.random()
+    return k
+
+
+def _homopolymer_errors(rand, seq):
+    for k in xrange(_poisson(rand, homopolymer_rate * len(seq))):
+        p = rand.randrange(len(seq))
+        if rand.random() < 0.5:
+            seq = seq[:p] + seq[p] + seq[p:]
+        elif seq[p - 1:p] == seq[p] or seq[p + 1:p + 2] == seq[p]:
+            seq = seq[:p] + seq[p + 1:]
+    return seq
+
+
+def write_454_reads(fasta_path, clstr_path, num_reads, replicates=0.1, seed=0, line_width=60):
+    """
+    Writes 'num_reads' 454-like reads to fasta_path and their clusters, as
+    cd-hit would write them, to clstr_path.  The same arguments always give
+    the same files.  Returns the size of the FASTA file in bytes and the
+    number of clusters.
+    """
+    rand = random.Random(seed)
+    pool = _template_pool(rand, template_pool)
+    (mean, sd) = read_length
+
+    out = open(fasta_path, 'w')
+    clstr = open(clstr_path, 'w')
+    group = []
+    clusters = 0
+
+    for i in xrange(num_reads + 1):
+        if i == num_reads or not group or rand.random() >= replicates:
+            if group:
+                ref = max(xrange(len(group)), key=lambda k: group[k][1])
+                clstr.write('>Cluster %d\n' % clusters)
+                for (k, (name, length)) in enumerate(group):
+                    if k == ref:
+                        clstr.write('%d\t%dnt, >%s... *\n' % (k, length, name))
+                    else:
+                        clstr.write('%d\t%dnt, >%s... at +/%.2f%%\n' % (k, length, name, rand.uniform(95, 100)))
+                clusters = clusters + 1
+                group = []
+            if i == num_reads:
+                break
+            start = rand.randrange(template_pool - 1000)
+
+        length = min(max(int(rand.gauss(mean, sd)), 50), 1000)
+        seq = _homopolymer_errors(rand, pool[start:start + length])
+        name = 'SYN%08d' % i
+        out.write('>%s length=%d\n' % (name, len(seq)))
+        for j in xrange(0, len(seq), line_width):
+            out.write(seq[j:j + line_width] + '\n')
+        group.append((name, len(seq)))
+
+    size = out.tell()
+    out.close()
+    clstr.close()
+    return size, clusters
+
+
+def _report(label, num_reads, size, elapsed):
+    mb = size / float(1 << 20)
+    print '%-10s %10d reads %8.1f MB %8.2f s %8.1f MB/s %10.2f us/read' % (
+        label, num_reads, mb, elapsed, mb / max(elapsed, 1e-9),
+        elapsed / max(num_reads, 1) * 1e6)
+
+
+#
+# fasta
+#
+
+def bench_fasta(sizes, workdir):
+    """
+    Times a full pass of fasta.iterload() over each file size.  The
+    per-read time should stay flat as the file grows.
+    """
+    for num_reads in sizes:
+        path = os.path.join(workdir, 'bench_%d.fa' % num_reads)
+        size = write_synthetic_fasta(path, num_reads)
+
+        start = time.time()
+        count = 0
+        for record in fasta.iterload(open(path)):
+            count = count + 1
+        _report('iterload', count, size, time.time() - start)
+
+        start = time.time()
+        d = fasta.load(open(path))
+        _report('load', len(d), size, time.time() - start)
+        del d
+
+        os.remove(path)
+
+
+#
+# clstr
+#
+
+def bench_clstr(sizes, workdir):
+    """
+    Times a full pass of cdhit_parse.iter_clusters() over synthetic *.clstr
+    files.  Try sizes of 1000000,10000000 reads for real-run scale.
+    """
+    for num_reads in sizes:
+        path = os.path.join(workdir, 'bench_%d.clstr' % num_reads)
+        size = write_synthetic_clstr(path, num_reads)
+
+        start = time.time()
+        count = 0
+        for cluster in cdhit_parse.iter_clusters(open(path)):
+            count = count + cluster.count
+        _report('iter_clstr', count, size, time.time() - start)
+
+        os.remove(path)
+
+
+#
+# memory
+#
+
+def _in_child(function, *args):
+    """
+    Runs function(*args) in a child process, so it starts from a fresh
+    heap, and returns its result, which must be JSON serializable.
+    """
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            os.write(w, json.dumps(function(*args)))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    data = []
+    while 1:
+        block = os.read(r, 1 << 16)
+        if not block:
+            break
+        data.append(block)
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('%s failed' % (function.__name__,))
+
+    return json.loads(''.join(data))
+
+
+def _timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _peak_rss(function, *args):
+    """
+    Runs function(*args) in a child process and returns (seconds, peak
+    RSS in MB) for the child, so each run starts from a fresh heap.
+    """
+    (elapsed, rss) = _in_child(_timed, function, *args)
+    return elapsed, rss / 1024.0
+
+
+def _extract(store, fasta_path, clstr_path, outfile, bp_match):
+    if store == 'external':
+        extract_clusters.extract_external(open(clstr_path), fasta_path, bp_match, outfile, fasta_path, fasta_path,
+                                          memory=external_budget)
+        return
+    elif store == 'lowmem':
+        reads = extract_clusters.scan_reads(fasta_path, bp_match)
+    elif store == 'index':
+        reads = fasta.FastaIndex(fasta_path)
+    elif store == 'packed':
+        reads = fasta.load_packed(open(fasta_path))
+    else:
+        reads = fasta.load_store(open(fasta_path))
+    result = extract_clusters.extract(open(clstr_path), reads, bp_match)
+    extract_clusters.write_outputs(result, outfile, fasta_path, fasta_path)
+
+
+# The memory budget for the external-memory extraction
+external_budget = 16 << 20
+
+
+def bench_memory(sizes, workdir, bp_match=3):
+    """
+    Runs the whole extraction (load, split, write the outputs) on each
+    size with an in-memory SequenceStore, a FastaIndex, a 2-bit
+    PackedReadStore, the low-memory PrefixStore and the external-memory
+    extraction, and reports the peak RSS of each.  In the low-memory mode the cost per read is mostly its
+    name and should not grow with the read length; the in-memory stores
+    also hold (or, for the index, map) the sequences.  The external-memory
+    extraction should stay near its budget at any size.
+    """
+    (elapsed, baseline) = _peak_rss(lambda: None)
+    print 'baseline %.1f MB' % (baseline,)
+
+    for num_reads in sizes:
+        fasta_path = os.path.join(workdir, 'bench_%d.fa' % num_reads)
+        clstr_path = os.path.join(workdir, 'bench_%d.clstr' % num_reads)
+        outfile = os.path.join(workdir, 'bench_%d' % num_reads)
+        size = write_synthetic_fasta(fasta_path, num_reads)
+        write_synthetic_clstr(clstr_path, num_reads)
+
+        for store in ('store', 'index', 'packed', 'lowmem', 'external'):
+            (elapsed, rss) = _peak_rss(_extract, store, fasta_path, clstr_path, outfile, bp_match)
+            print '%-10s %10d reads %8.1f MB %8.2f s %8.1f MB peak RSS %8.1f bytes/read' % (
+                store, num_reads, size / float(1 << 20), elapsed, rss,
+                (rss - baseline) * (1 << 20) / num_reads)
+
+        for name in os.listdir(workdir):
+            if name.startswith('bench_%d' % num_reads):
+                os.remove(os.path.join(workdir, name))
+
+
+#
+# parallel
+#
+
+def bench_parallel(sizes, workdir, processes=None):
+    """
+    Times fasta.load_parallel() on each size with each number of processes
+    in 'processes' (default 1 up to the number of cores), and reports the
+    speedup over the first.  Parsing should scale until the disk, or the
+    merge in the parent, is the limit.
+    """
+    if not processes:
+        processes = range(1, multiprocessing.cpu_count() + 1)
+
+    for num_reads in sizes:
+        path = os.path.join(workdir, 'bench_%d.fa' % num_reads)
+        size = write_synthetic_fasta(path, num_reads)
+
+        first = None
+        for p in processes:
+            start = time.time()
+            reads = fasta.load_parallel(path, p)
+            elapsed = time.time() - start
+            if first is None:
+                first = elapsed
+            _report('parallel%d' % p, len(reads), size, elapsed)
+            print '%-10s speedup %.2fx' % ('', first / max(elapsed, 1e-9))
+            del reads
+
+        os.remove(path)
+
+
+#
+# stages
+#
+
+def _load(store, fasta_path):
+    if store == 'index':
+        return fasta.FastaIndex(fasta_path)
+    elif store == 'packed':
+        return fasta.load_packed(open(fasta_path))
+    return fasta.load_store(open(fasta_path))
+
+
+def _run_stages(store, fasta_path, clstr_path, outfile, bp_match):
+    """
+    Runs the extraction one stage at a time, and returns the seconds and
+    the peak RSS so far (in MB) at the end of each.
+    """
+    stages = []
+
+    def stage(name, function, *args):
+        start = time.time()
+        value = function(*args)
+        stages.append({
+            'stage': name,
+            'seconds': time.time() - start,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        })
+        return value
+
+    reads = stage('load', _load, store, fasta_path)
+    cluster_table = stage('parse', lambda: extract_clusters.parse_clusters(open(clstr_path), reads))
+    cluster_order = stage('order', extract_clusters.order_clusters, cluster_table)
+    cluster_set = stage('split', extract_clusters.split_clusters, cluster_table, cluster_order, reads, bp_match)
+    cluster_ref_seq = stage('representatives', extract_clusters.pick_representatives, cluster_set, reads)
+    result = extract_clusters.Extraction(reads, cluster_set, cluster_ref_seq)
+    stage('write', extract_clusters.write_outputs, result, outfile, fasta_path, fasta_path)
+    return stages
+
+
+def bench_stages(sizes, workdir, bp_match=3, store='index', replicates=0.1, seed=0):
+    """
+    Runs the extraction (load the reads with 'store', parse the *.clstr,
+    order and split the clusters, pick the representatives and write the
+    outputs) on 454-like reads of each size, and reports the time of each
+    stage and the peak RSS at its end.  Each size runs in a fresh process.
+    Returns the results as a list of dicts.
+    """
+    results = []
+
+    for num_reads in sizes:
+        fasta_path = os.path.join(workdir, 'bench_%d.fa' % num_reads)
+        clstr_path = os.path.join(workdir, 'bench_%d.clstr' % num_reads)
+        outfile = os.path.join(workdir, 'bench_%d' % num_reads)
+        (size, clusters) = write_454_reads(fasta_path, clstr_path, num_reads, replicates, seed)
+
+        for stage in _in_child(_run_stages, store, fasta_path, clstr_path, outfile, bp_match):
+            stage['reads'] = num_reads
+            stage['clusters'] = clusters
+            stage['fasta_mb'] = size / float(1 << 20)
+            results.append(stage)
+            print '%-16s %10d reads %8.2f s %10.2f us/read %8.1f MB peak RSS' % (
+                stage['stage'], num_reads, stage['seconds'], stage['seconds'] / num_reads * 1e6, stage['peak_rss_mb'])
+
+        for name in os.listdir(workdir):
+            if name.startswith('bench_%d' % num_reads):
+                os.remove(os.path.join(workdir, name))
+
+    return results
+
+
+def generate(sizes, workdir, replicates=0.1, seed=0):
+    """
+    Writes 454-like reads of each size and their *.clstr files to workdir,
+    and keeps them (e.g. to run cd-hit on).
+    """
+    for num_reads in sizes:
+        fasta_path = os.path.join(workdir, 'synthetic_%d.fa' % num_reads)
+        clstr_path = os.path.join(workdir, 'synthetic_%d.clstr' % num_reads)
+        (size, clusters) = write_454_reads(fasta_path, clstr_path, num_reads, replicates, seed)
+        print '%s %d reads in %d clusters, %.1f MB' % (fasta_path, num_reads, clusters, size / float(1 << 20))
+        print clstr_path
+
+
+#
+# sequtils
+#
+
+# Each per-sequence function, its batch version, and whether it asserts the
+# sequence is DNA
+sequtils = [
+    ('gc_content', fasta.gc_content, fasta.batch_gc_content, True),
+    ('is_dna', fasta.is_dna, fasta.batch_is_dna, False),
+    ('is_protein', fasta.is_protein, fasta.batch_is_protein, False),
+    ('force_dna', fasta.force_dna, fasta.batch_force_dna, False),
+    ('reverse_complement', fasta.reverse_complement, fasta.batch_reverse_complement, True),
+]
+
+
+def bench_sequtils(sizes, workdir, per_sequence_limit=100000):
+    """
+    Times each batch sequence function over 454-like reads of each size,
+    and the per-sequence function over up to 'per_sequence_limit' of them
+    (the rest would only take minutes to say the same), and checks they
+    agree.  Reports the time per read of each and the speedup.
+    """
+    for num_reads in sizes:
+        fasta_path = os.path.join(workdir, 'bench_%d.fa' % num_reads)
+        clstr_path = os.path.join(workdir, 'bench_%d.clstr' % num_reads)
+        write_454_reads(fasta_path, clstr_path, num_reads)
+        sequences = [sequence for (name, sequence) in fasta.iterload(open(fasta_path))]
+        os.remove(fasta_path)
+        os.remove(clstr_path)
+
+        sample = sequences[:per_sequence_limit]
+        for (name, single, batch, asserts) in sequtils:
+            start = time.time()
+            expected = [single(seq) for seq in sample]
+            single_time = (time.time() - start) / len(sample)
+
+            start = time.time()
+            results = batch(sequences)
+            batch_time = (time.time() - start) / len(sequences)
+
+            if list(results[:len(sample)]) != expected:
+                raise RuntimeError('batch_%s disagrees with %s' % (name, name))
+
+            print '%-20s %10d reads %10.2f us/read %10.2f us/read batch %8.1fx %8.2f s for the batch' % (
+                name, num_reads, single_time * 1e6, batch_time * 1e6,
+                single_time / max(batch_time, 1e-12), batch_time * num_reads)
+
+
+#
+# Results as JSON
+#
+# A run of the stages benchmark can be saved with --json and compared with a
+# saved run (e.g. from another version) with --baseline.
+
+def _version():
+    """
+    The git commit the tools are at, or None.
+    """
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = git.communicate()[0].strip()
+    except OSError:
+        return None
+    return git.returncode == 0 and commit or None
+
+
+def compare(results, baseline):
+    """
+    Prints the ratio of each stage's time and peak RSS to the same stage
+    and size in 'baseline' (a saved run).
+    """
+    old = dict([((r['reads'], r['stage']), r) for r in baseline['results']])
+    print '\nCompared with %s (%s):' % (baseline.get('version'), time.ctime(baseline.get('date', 0)))
+    for r in results:
+        b = old.get((r['reads'], r['stage']))
+        if b is None:
+            continue
+        print '%-16s %10d reads %8.2fx time %8.2fx peak RSS' % (
+            r['stage'], r['reads'], r['seconds'] / max(b['seconds'], 1e-9), r['peak_rss_mb'] / max(b['peak_rss_mb'], 1e-9))
+
+
+benchmarks = {
+    'fasta': bench_fasta,
+    'clstr': bench_clstr,
+    'memory': bench_memory,
+    'parallel': bench_parallel,
+    'stages': bench_stages,
+    'generate': generate,
+    'sequtils': bench_sequtils,
+}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("-n", "--sizes", dest="sizes", default="10000,100000,1000000",
+                      help="Comma separated list of read counts to benchmark")
+    parser.add_option("-d", "--workdir", dest="workdir", default=None,
+                      help="Directory for temporary benchmark files")
+    parser.add_option("-j", "--processes", dest="processes", default=None,
+                      help="Comma separated list of process counts for the parallel benchmark (default: 1 up to the number of cores)")
+    parser.add_option("--replicates", dest="replicates", type="float", default=0.1,
+                      help="Fraction of the 454-like reads that are artificial replicates (default: 0.1)")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="Seed for the 454-like reads (default: 0)")
+    parser.add_option("--bp", dest="bp", type="int", default=3,
+                      help="Initial base pair requirement for the stages benchmark (default: 3)")
+    parser.add_option("--store", dest="store", type="choice", choices=["index", "store", "packed"], default="index",
+                      help="Read store for the stages benchmark: index (as extract_replicates.py uses by default), store or packed")
+    parser.add_option("--json", dest="json", default=None,
+                      help="Save the results of the stages benchmark to this JSON file")
+    parser.add_option("--baseline", dest="baseline", default=None,
+                      help="Compare the results of the stages benchmark with this saved JSON file")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in benchmarks:
+        parser.print_usage()
+        sys.exit(1)
+
+    sizes = [int(x) for x in options.sizes.split(',')]
+    workdir = options.workdir or tempfile.mkdtemp()
+
+    if args[0] == 'parallel':
+        processes = options.processes and [int(x) for x in options.processes.split(',')]
+        bench_parallel(sizes, workdir, processes)
+    elif args[0] == 'generate':
+        generate(sizes, workdir, options.replicates, options.seed)
+    elif args[0] == 'stages':
+        results = bench_stages(sizes, workdir, options.bp, options.store, options.replicates, options.seed)
+        if options.json:
+            out = open(options.json, 'w')
+            json.dump({
+                'benchmark': 'stages',
+                'version': _version(),
+                'date': time.time(),
+                'python': sys.version.split()[0],
+                'parameters': {
+                    'bp': options.bp,
+                    'store': options.store,
+                    'replicates': options.replicates,
+                    'seed': options.seed,
+                    'read_length': read_length,
+                    'homopolymer_rate': homopolymer_rate,
+                },
+                'results': results,
+            }, out, indent=1, sort_keys=True)
+            out.close()
+        if options.baseline:
+            compare(results, json.load(open(options.baseline)))
+    else:
+        benchmarks[args[0]](sizes, workdir)
@@ -0,0 +1,194 @@
+#
+# gzip / BGZF support for the replicate filter scripts.
+#
+# GzipReader decompresses a gzip file as it is read, a block at a time, so a
+# compressed FASTA can be streamed without an uncompressed copy.  It reads
+# files made of several gzip members too, which includes BGZF (the blocked
+# gzip of samtools/tabix) and files written with `cat a.gz b.gz`.
+#
+# BgzfWriter writes BGZF: the data is cut into blocks of at most 64 KB, each
+# compressed as its own gzip member, so the blocks can be compressed on several
+# threads at once and the result is still a normal gzip file that gunzip and
+# zcat read.  zlib releases the GIL while it compresses, so the threads run in
+# parallel.
+#
+
+import zlib
+import struct
+import collections
+from multiprocessing.pool import ThreadPool
+
+import resources
+
+
+gzip_magic = '\x1f\x8b'
+
+
+def is_gzip(filename):
+    """
+    True if the file starts with the gzip magic number.
+    """
+    f = open(filename, 'rb')
+    try:
+        return f.read(2) == gzip_magic
+    finally:
+        f.close()
+
+
+class GzipReader(object):
+    """
+    A read-only file object over a gzip file object 'f', decompressing
+    blocksize bytes of it at a time.  Like gzip.GzipFile, it raises
+    IOError for a file that isn't gzip or ends inside a gzip member, and
+    ignores zeros padding the end of the file.
+    """
+
+    def __init__(self, f, blocksize=1 << 20):
+        self._file = f
+        self._blocksize = blocksize
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self):
+        raw = self._file.read(self._blocksize)
+        if not raw:
+            self._eof = True
+            if self._started and not self._member_ended():
+                raise IOError('Compressed file ended before the end of the gzip member')
+            return
+
+        chunks = []
+        while raw:
+            if not self._started:
+                raw = raw.lstrip('\0')
+                if not raw:
+                    break
+            self._started = True
+            try:
+                chunks.append(self._decompressor.decompress(raw))
+            except zlib.error, e:
+                raise IOError('Not a valid gzip file: %s' % (e,))
+            raw = self._decompressor.unused_data
+            if raw:
+                # The member ended inside this block; the rest is the next one
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._started = False
+        self._buffer = self._buffer + ''.join(chunks)
+
+    def _member_ended(self):
+        # zlib doesn't say whether the stream is complete, but once it is,
+        # any more input comes back as unused data.
+        try:
+            self._decompressor.decompress('\0')
+        except zlib.error:
+            return False
+        return self._decompressor.unused_data == '\0'
+
+    def read(self, size=-1):
+        if size < 0:
+            while not self._eof:
+                self._fill()
+            size = len(self._buffer)
+        else:
+            while len(self._buffer) < size and not self._eof:
+                self._fill()
+
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+#
+# BGZF output
+#
+
+# Uncompressed bytes per BGZF block, as samtools uses: small enough that the
+# compressed block always fits the 16-bit block size field.
+block_size = 0xff00
+
+# The empty block that marks the end of a BGZF file
+bgzf_eof = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+            '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def compress_block(data, level=6):
+    """
+    Returns 'data' (at most block_size bytes) as one BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+
+    # The header, with the BC extra subfield holding the block size - 1
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff,
+                         6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+    return header + deflated + trailer
+
+
+def _compress_chunk(args):
+    (data, level) = args
+    return ''.join([compress_block(data[i:i + block_size], level)
+                    for i in xrange(0, len(data), block_size)])
+
+
+class BgzfWriter(object):
+    """
+    A write-only file object that writes BGZF to 'filename', compressing
+    on 'threads' threads (by default one per core available).  Data is handed to the
+    threads in chunks of several blocks and written out in order.
+    """
+
+    def __init__(self, filename, threads=None, level=6, chunk_blocks=16):
+        self._file = open(filename, 'wb')
+        self._threads = threads or resources.available_cores()
+        self._pool = ThreadPool(self._threads)
+        self._level = level
+        self._chunk_size = chunk_blocks * block_size
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self.name = filename
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered = self._buffered + len(data)
+        if self._buffered >= self._chunk_size:
+            self._submit()
+
+    def _submit(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        # Whole chunks go to the threads; the remainder waits for more data
+        end = len(data) - len(data) % self._chunk_size
+        for i in xrange(0, end, self._chunk_size):
+            self._pending.append(self._pool.apply_async(_compress_chunk, ((data[i:i + self._chunk_size], self._level),)))
+        if end < len(data):
+            self._buffer.append(data[end:])
+            self._buffered = len(data) - end
+
+        # Don't let more than two chunks per thread pile up in memory
+        while len(self._pending) > 2 * self._threads:
+            self._file.write(self._pending.popleft().get())
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._buffered:
+            self._pending.append(self._pool.apply_async(_compress_chunk, ((''.join(self._buffer), self._level),)))
+            self._buffer = []
+            self._buffered = 0
+        while self._pending:
+            self._file.write(self._pending.popleft().get())
+        self._file.write(bgzf_eof)
+        self._file.close()
+        self._file = None
+        self._pool.close()
+        self._pool.join()
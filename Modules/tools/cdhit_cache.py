@@ -0,0 +1,172 @@
+#
+# A content-addressed cache of cd-hit results for the replicate filter scripts.
+#
+# cd-hit output depends only on the sequences it is given and on its clustering
+# parameters, not on the initial base pair requirement, so reruns over the same
+# input (after a downstream failure, or with a different REPLICATE_START) can
+# reuse an earlier *.clstr file instead of clustering again.
+#
+# Each entry is a directory named after the SHA-1 of the FASTA that went to
+# cd-hit plus the parameters, holding:
+#
+#   clstr            the *.clstr file
+#   representatives  the representative sequences
+#   seconds          how long cd-hit took to produce them
+#
+# Entries are written to a temporary directory and renamed into place, so a
+# half-written entry is never picked up.  A hit touches the entry; when the
+# cache grows past its size limit the least recently used entries are removed.
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+
+def hashed(records, digest):
+    """
+    Passes (name, sequence) records through, adding each one to 'digest'
+    exactly as it is written to the cd-hit input.
+    """
+    for (name, sequence) in records:
+        digest.update('>%s\n%s\n' % (name, sequence))
+        yield (name, sequence)
+
+
+def cache_key(digest, params):
+    """
+    The entry name for a digest of the input and a list of parameters.
+    """
+    key = digest.copy()
+    key.update('\0' + '\0'.join([str(p) for p in params]))
+    return key.hexdigest()
+
+
+def _entry_size(path):
+    size = 0
+    for name in os.listdir(path):
+        size = size + os.path.getsize(os.path.join(path, name))
+    return size
+
+
+class CdhitCache(object):
+    """
+    A cd-hit result cache in 'cache_dir', holding at most 'max_bytes' of
+    entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, output_file):
+        """
+        Copies a cached result to output_file and output_file.clstr.
+        Returns the seconds cd-hit originally took, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            seconds = float(open(os.path.join(path, 'seconds')).read())
+            shutil.copyfile(os.path.join(path, 'clstr'), output_file + '.clstr')
+            shutil.copyfile(os.path.join(path, 'representatives'), output_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return seconds
+
+    def store(self, key, output_file, seconds):
+        """
+        Adds the cd-hit result in output_file and output_file.clstr under
+        'key', then evicts least recently used entries over the size limit.
+        Returns the keys evicted.  A result that can't be stored is left
+        out of the cache with a warning on stderr; the run goes on.
+        """
+        if os.path.isdir(self._path(key)):
+            return []
+
+        temp = None
+        try:
+            temp = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+            os.chmod(temp, 0755)
+            shutil.copyfile(output_file + '.clstr', os.path.join(temp, 'clstr'))
+            shutil.copyfile(output_file, os.path.join(temp, 'representatives'))
+            fp = open(os.path.join(temp, 'seconds'), 'w')
+            try:
+                fp.write('%.3f\n' % seconds)
+            finally:
+                fp.close()
+            os.rename(temp, self._path(key))
+        except (IOError, OSError), e:
+            if temp is not None:
+                shutil.rmtree(temp, True)
+            # The rename fails onto an entry that is already there when
+            # another run stored the same entry first; anything else (a
+            # full disk, permissions) is a real failure to store it.
+            if not os.path.isdir(self._path(key)):
+                sys.stderr.write('Warning: cannot store the cd-hit result in the cache %s: %s\n' % (self.cache_dir, e))
+                return []
+
+        return self.evict()
+
+    def entries(self):
+        """
+        (last used time, size, key) of every entry, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self._path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _entry_size(path), key))
+            except OSError:
+                pass
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in
+        max_bytes.  Returns the keys removed.
+        """
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+
+        removed = []
+        for (used, size, key) in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._path(key), True)
+            total = total - size
+            removed.append(key)
+
+        return removed
+
+
+def log(log_file, key, seconds, elapsed, removed=()):
+    """
+    Appends a line about a cache lookup to log_file: 'hit' with the cd-hit
+    time saved, or 'miss' with the time cd-hit took.
+    """
+    fp = open(log_file, 'a')
+    if seconds is None:
+        fp.write('%s\tmiss\t%s\tcd-hit took %.1f s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), key, elapsed))
+    else:
+        fp.write('%s\thit\t%s\tsaved %.1f s (cd-hit took %.1f s, reading the cache %.1f s)\n' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), key, max(seconds - elapsed, 0), seconds, elapsed))
+    for key in removed:
+        fp.write('%s\tevicted\t%s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), key))
+    fp.close()
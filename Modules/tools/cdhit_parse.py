@@ -10,59 +10,170 @@
 
 # This parses cd-hit output files for use in the replicate filter scripts
 
+import cStringIO
+from array import array
+from collections import namedtuple
+
+
+# One cluster from a *.clstr file.  'members' lists every sequence in the
+# cluster with the representative first, and 'count' is len(members).
+
+Cluster = namedtuple('Cluster', 'id representative members count')
+
+
+def iter_clusters(f, blocksize=1 << 20):
+    """
+    Reads a cd-hit *.clstr file object in blocks of 'blocksize' bytes and
+    yields one Cluster at a time, so only a single cluster is ever held in
+    memory.
+    """
+    key = None
+    reference = None
+    sequences = []
+    tail = ''
+
+    while 1:
+        block = f.read(blocksize)
+        if block:
+            lines = (tail + block).split('\n')
+            tail = lines.pop()
+        elif tail:
+            lines = [tail]
+            tail = ''
+        else:
+            break
+
+        for line in lines:
+            if line[:9] == '>Cluster ':
+                if key is not None:
+                    yield _make_cluster(key, reference, sequences)
+                key = line[9:].rstrip()
+                reference = None
+                sequences = []
+                continue
+
+            # Split at the spaces
+            new = line.split(' ')
+
+            # If the third column is a *, it's the reference
+            if len(new) > 2 and new[2] == '*':
+                reference = new[1][:-3].lstrip('>')
+            # If the third column is 'at', it's one of the sequences in the cluster
+            elif len(new) == 4:
+                sequences.append(new[1][:-3].lstrip('>'))
+
+    if key is not None:
+        yield _make_cluster(key, reference, sequences)
+
+
+def _make_cluster(key, reference, sequences):
+    sequences.insert(0, reference)
+    return Cluster(key, reference, sequences, len(sequences))
+
+
+class ClusterTable(object):
+    """
+    Cluster membership held as integer read IDs in CSR form: the members of
+    cluster k are members[offsets[k]:offsets[k + 1]], representative first.
+    'labels' holds the cd-hit cluster names in the same order.
+
+    Read IDs come from a read_ids.ReadIds table shared with the FASTA store,
+    so each read name is only stored once.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.offsets = array('l', [0])
+        self.members = array('l')
+
+    def append(self, label, members):
+        """
+        Adds a cluster with the given member IDs; returns its index.
+        """
+        self.labels.append(label)
+        self.members.extend(members)
+        self.offsets.append(len(self.members))
+        return len(self.labels) - 1
+
+    def __len__(self):
+        return len(self.labels)
+
+    def cluster(self, k):
+        return self.members[self.offsets[k]:self.offsets[k + 1]]
+
+    def size(self, k):
+        return self.offsets[k + 1] - self.offsets[k]
+
+    def sizes(self):
+        offsets = self.offsets
+        return array('l', [offsets[k + 1] - offsets[k] for k in xrange(len(self.labels))])
+
+
+def insert_duplicates(members, added, key):
+    """
+    Returns the list 'members' with the items of 'added' put where cd-hit
+    would have listed them, by key(item): each goes before the first
+    member with a greater key.  cd-hit lists the members of a cluster
+    longest first, then in input order, so for collapsed duplicates the
+    key is (-length, input order).
+    """
+    added = sorted(added, key=key)
+    merged = []
+    a = 0
+    for member in members:
+        k = key(member)
+        while a < len(added) and key(added[a]) < k:
+            merged.append(added[a])
+            a = a + 1
+        merged.append(member)
+    merged.extend(added[a:])
+    return merged
+
+
+def read_cluster_table(f, ids, duplicates=None, length=None, blocksize=1 << 20):
+    """
+    Streams a cd-hit *.clstr file object into a ClusterTable, mapping each
+    sequence name to its ID in the read_ids.ReadIds table 'ids'.  A name that
+    isn't in 'ids' raises KeyError.
+
+    If exact duplicates were collapsed before running cd-hit, 'duplicates'
+    maps each carrier name to its duplicates' names (see duplicates.py);
+    they are put back into the carrier's cluster where cd-hit would have
+    listed them had they not been collapsed (see insert_duplicates()),
+    which takes length(i), the length of read i.  IDs are in input order.
+    """
+    table = ClusterTable()
+    key = lambda i: (-length(i), i)
+    for cluster in iter_clusters(f, blocksize):
+        members = [ids[name] for name in cluster.members]
+        if duplicates:
+            added = []
+            for name in cluster.members:
+                for duplicate in duplicates.get(name, ()):
+                    added.append(ids[duplicate])
+            if added:
+                members = insert_duplicates(members, added, key)
+        table.append(cluster.id, members)
+    return table
+
+
 def read_clusters(cluster_list):
+    """
+    Compatibility wrapper around iter_clusters().  Takes the contents of a
+    *.clstr file (or an open file object) and returns the cluster_db,
+    cluster_db_count and unique_list structures.
+    """
     cluster_db = {}
     cluster_db_count = {}
 
     unique_list = []
 
+    if not hasattr(cluster_list, 'read'):
+        cluster_list = cStringIO.StringIO(cluster_list)
 
-    # Split the file so that each cluster is it's own line
-    clusters  = cluster_list.split('>Cluster ')
-
-    # Go through the cluster
-    for line in clusters:
-        # Take off the end newline
-        line = line.rstrip('\n')
-
-        sequences = []
-        count = 0
-
-        # If it's a cluster
-        if len(line) > 0:
-
-            # split at the newlines, so each sequence is on its own line
-            hits = line.split('\n')
-
-            # For each hit split it to get the sequence name 
-            for i in hits:
-                # Split at the spaces
-                new = i.split(' ')
-
-                # If the length of the line is 1, it's the name of the cluster,
-                # what we're using as the key
-                if len(new) == 1:
-                    key = new[0]
-                # If the third column is a *, it's the reference
-                elif new[2] == '*':
-                    reference = new[1]
-                    reference = reference[:-3]
-                    reference = reference.lstrip('>')
-                    count = count + 1
-                    unique_list.append(reference)
-                    #  sequences = sequences.append(new[1])
-                # If the third column is 'at', it's one of the sequences in the cluster
-                elif len(new) == 4:
-                    seq = new[1]
-                    seq = seq[:-3]
-                    seq = seq.lstrip('>')
-                    sequences.append(seq)
-                    count = count + 1
-
-            sequences.insert(0, reference)
-
-            cluster_db[key] = sequences
-            cluster_db_count[key] = count
+    for cluster in iter_clusters(cluster_list):
+        cluster_db[cluster.id] = cluster.members
+        cluster_db_count[cluster.id] = cluster.count
+        unique_list.append(cluster.representative)
 
     return cluster_db, cluster_db_count, unique_list
-
@@ -0,0 +1,447 @@
+#! /usr/bin/env python
+#
+# Planning cd-hit runs for the replicate filter scripts.
+#
+# cd-hit-est used to run as "-n 8 -d 0 -M 1000" whatever the input or the
+# machine: on one thread, and capped at 1000 MB, which small runs don't need
+# and large runs fail on.  plan() takes the size of the input (reads and
+# bases) and the cores and memory there are to use (or a budget), and chooses
+# cd-hit's threads (-T), memory limit (-M) and word size (-n), and whether the
+# run has to be sharded, or its clusters extracted in low-memory or external
+# memory mode, to fit.
+#
+# The memory figures are linear models: of cd-hit (the sequences it holds,
+# plus its word table, which it can build in several rounds if -M is too small
+# to hold it at once), and of each way of extracting the clusters (bytes per
+# read and per base, as measured with "benchmark_replicates.py memory").  They
+# are estimates, so a run logs them next to the peak memory it measured (see
+# log_record()); the constants below are the place to correct them.
+#
+# The same estimate gives the h_vmem Dereplicate.pm requests for a grid job
+# ("cdhit_plan.py --h-vmem <fasta file> <cutoff> <bp>").
+#
+
+"""
+Usage: cdhit_plan.py [options] <fasta file> <sequence identity cutoff> <initial base pair requirement>
+
+Prints how extract_replicates.py would run cd-hit on <fasta file> here: the
+threads, memory limit and word size, the sharding and extraction mode, and
+the memory each part is estimated to take.  With --h-vmem it prints only
+the h_vmem to request for running it as a one-slot grid job (e.g. 3G).
+"""
+
+import os
+import sys
+import json
+from optparse import OptionParser
+
+import batch_replicates_config
+import fasta
+import resources
+
+
+# cd-hit: fixed buffers, then the bytes per base and per read of the sequences
+# it holds, the bytes per base of its word table, and the MB per thread
+cdhit_fixed_mb = 64
+cdhit_bytes_per_base = 1.0
+cdhit_bytes_per_read = 100
+cdhit_table_bytes_per_base = 4.0
+cdhit_thread_mb = 32
+
+# The smallest -M given to cd-hit (the old fixed figure), memory allowing
+min_cdhit_memory_mb = 1000
+
+# Reads per cd-hit thread: below this, starting threads costs more than they save
+reads_per_thread = 10000
+
+# The Python side: the interpreter and its modules, the bytes per read kept
+# while collapsing duplicates, and the (bytes per read, bytes per base) of
+# each way of holding the reads while extracting the clusters.  External
+# extraction takes its memory budget.
+python_fixed_mb = 32
+collapse_bytes_per_read = 120
+extract_bytes = {
+    'index': (380, 1.0),
+    'packed': (300, 0.25),
+    'low_memory': (340, 0.0),
+}
+
+# Extraction modes to try, in order, when the reads don't fit in memory
+extraction_modes = ('index', 'low_memory')
+
+
+def word_size(cutoff):
+    """
+    cd-hit-est's word size (-n) for a sequence identity cutoff, as its
+    documentation recommends.  8 down to 0.9, as the scripts always used.
+    """
+    if cutoff >= 0.9:
+        return 8
+    if cutoff >= 0.88:
+        return 7
+    if cutoff >= 0.85:
+        return 6
+    if cutoff >= 0.8:
+        return 5
+    return 4
+
+
+def measure_input(filename, blocksize=1 << 20):
+    """
+    Returns the number of reads and of bases in a FASTA file (plain or
+    gzip compressed).  Raises IOError if it can't be read.
+    """
+    f = fasta.open_fasta(filename)
+    reads = 0
+    bases = 0
+    pending = ''
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            lines = (pending + block).split('\n')
+            pending = lines.pop()
+            headers = [line for line in lines if line[:1] == '>']
+            reads = reads + len(headers)
+            bases = bases + sum(map(len, lines)) - sum(map(len, headers))
+    finally:
+        f.close()
+
+    if pending[:1] == '>':
+        reads = reads + 1
+    else:
+        bases = bases + len(pending)
+    return reads, bases
+
+
+class InputCounts(object):
+    """
+    Counts the reads and bases of the (name, sequence) records passed
+    through counted(), so a run can be planned on the reads as they are
+    first read instead of measuring the input separately.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+
+    def counted(self, records):
+        for (name, sequence) in records:
+            self.reads = self.reads + 1
+            self.bases = self.bases + len(sequence)
+            yield (name, sequence)
+
+
+def cdhit_memory_mb(reads, bases, threads=1, table=True):
+    """
+    The estimated memory of cd-hit-est on 'reads' reads of 'bases' bases in
+    all, in MB; without 'table', just what it needs to hold the sequences
+    (below which it fails).
+    """
+    size = cdhit_bytes_per_base * bases + cdhit_bytes_per_read * reads
+    if table:
+        size = size + cdhit_table_bytes_per_base * bases
+    return int(cdhit_fixed_mb + cdhit_thread_mb * threads + size / (1 << 20))
+
+
+def extract_memory_mb(reads, bases, mode, memory_budget=0):
+    """
+    The estimated memory of extracting the clusters of 'reads' reads of
+    'bases' bases in all, in MB, holding the reads in 'mode' ('index',
+    'packed', 'low_memory', or 'external' with memory_budget MB).
+    """
+    if mode == 'external':
+        return python_fixed_mb + memory_budget
+    (per_read, per_base) = extract_bytes[mode]
+    return int(python_fixed_mb + (per_read * reads + per_base * bases) / (1 << 20))
+
+
+def _round_up(mb, unit):
+    return -(-int(mb) // unit) * unit
+
+
+def _shard_prefix(shards, bp):
+    # Enough prefixes to spread over the shards evenly, within bp
+    prefix = 1
+    while 4 ** prefix < 4 * shards and prefix < bp:
+        prefix = prefix + 1
+    return min(prefix, bp)
+
+
+class Plan(object):
+    """
+    How to run the replicate filter on one input: cd-hit's threads,
+    memory limit (MB) and word size; the shard prefix (0 for a single
+    cd-hit), shards and processes; how the clusters are extracted
+    ('index', 'packed', 'low_memory' or 'external', with memory_budget MB);
+    the estimated memory in MB of each cd-hit, of all those running at
+    once, and of the extraction; and notes on what didn't fit.
+    """
+
+    def __init__(self, reads, bases, cutoff, cores, memory_mb):
+        self.reads = reads
+        self.bases = bases
+        self.cutoff = cutoff
+        self.cores = cores
+        self.memory_mb = memory_mb
+        self.word_size = word_size(cutoff)
+        self.threads = 1
+        self.cdhit_memory = min_cdhit_memory_mb
+        self.shard_prefix = 0
+        self.shards = 0
+        self.processes = 1
+        self.extraction = 'index'
+        self.memory_budget = 0
+        self.cdhit_mb = 0
+        self.cdhit_total_mb = 0
+        self.python_mb = python_fixed_mb
+        self.extract_mb = 0
+        self.notes = []
+
+    def peak_mb(self):
+        """
+        The estimated peak memory of the run, cd-hit or the extraction.
+        """
+        return max(self.python_mb + self.cdhit_total_mb, self.extract_mb)
+
+    def h_vmem_mb(self):
+        """
+        The estimated peak virtual memory of the run, within the configured
+        bounds on h_vmem requests.
+        """
+        vmem = self.peak_mb() + resources.vmem_fixed_mb + resources.vmem_thread_mb * self.threads * self.processes
+        vmem = _round_up(vmem, 256)
+        return min(max(vmem, batch_replicates_config.min_h_vmem_mb), batch_replicates_config.max_h_vmem_mb)
+
+    def record(self):
+        return {
+            'reads': self.reads,
+            'bases': self.bases,
+            'cores': self.cores,
+            'memory_mb': self.memory_mb,
+            'threads': self.threads,
+            'cdhit_memory': self.cdhit_memory,
+            'word_size': self.word_size,
+            'shard_prefix': self.shard_prefix,
+            'shards': self.shards,
+            'processes': self.processes,
+            'extraction': self.extraction,
+            'memory_budget': self.memory_budget,
+            'estimate': {
+                'cdhit_mb': self.cdhit_mb,
+                'cdhit_total_mb': self.cdhit_total_mb,
+                'python_mb': self.python_mb,
+                'extract_mb': self.extract_mb,
+                'peak_mb': self.peak_mb(),
+                'h_vmem_mb': self.h_vmem_mb(),
+            },
+            'notes': self.notes,
+        }
+
+    def report(self):
+        """
+        The plan in a line or two of text.
+        """
+        if self.shard_prefix:
+            cdhit = '%d shards on %d-base prefixes, %d at a time, each with -M %d' % (
+                self.shards, self.shard_prefix, self.processes, self.cdhit_memory)
+            each = ' each'
+        else:
+            cdhit = '-T %d -M %d' % (self.threads, self.cdhit_memory)
+            each = ''
+        text = 'cd-hit plan for %d reads (%d bases): %s -n %d, %s extraction; estimated %d MB for cd-hit%s, %d MB for the extraction' % (
+            self.reads, self.bases, cdhit, self.word_size, self.extraction.replace('_', '-'),
+            self.cdhit_mb, each, self.extract_mb)
+        return '\n'.join([text] + self.notes)
+
+
+def plan(reads, bases, cutoff, bp, cores=None, memory_mb=None, threads=None,
+         shard_prefix=0, shards=0, processes=None, extraction=None, memory_budget=0,
+         collapse=False, can_shard=True):
+    """
+    Plans a run on 'reads' reads of 'bases' bases with the given cutoff and
+    initial base pair requirement, on 'cores' cores (default: those
+    available) within memory_mb MB (default: what is available), and
+    returns the Plan.
+
+    Whatever is given is kept: 'threads' for cd-hit; shard_prefix (with
+    'shards' and 'processes', as for extract_replicates.py) for a sharded
+    run, though never more processes than cores; 'extraction' ('index', 'packed', 'low_memory' or 'external', with
+    memory_budget MB).  The rest is chosen to fit: a single cd-hit if it
+    fits, else (with can_shard and a base pair requirement) shards small
+    enough that 'processes' of them at once fit; the extraction modes in
+    extraction_modes order, else external with half the memory left.
+    """
+    if cores is None:
+        cores = resources.available_cores()
+    if memory_mb is None:
+        memory_mb = resources.available_memory() or batch_replicates_config.sample_memory_mb
+
+    p = Plan(reads, bases, cutoff, cores, memory_mb)
+    processes = min(processes or cores, cores)
+
+    if collapse:
+        p.python_mb = p.python_mb + int(collapse_bytes_per_read * reads / (1 << 20))
+    budget = max(memory_mb - p.python_mb, 0)
+
+    # A single cd-hit, on threads enough for the reads
+
+    if threads:
+        p.threads = threads
+    else:
+        p.threads = max(min(cores, reads // reads_per_thread), 1)
+
+    needs = cdhit_memory_mb(reads, bases, p.threads, table=False)
+    fixed = cdhit_memory_mb(0, 0, table=False)
+    if not shard_prefix and can_shard and bp and needs > budget:
+        # Shard so that 'processes' shards at once fit, counting on the
+        # largest shard having twice its share of the reads.  Each cd-hit
+        # has its fixed memory however few reads it gets, so fewer run at
+        # once if that would take over half their share.
+        processes = min(processes, max(budget // (2 * fixed), 1))
+        if budget // processes > fixed:
+            reads_mb = cdhit_memory_mb(reads, bases, table=False) - fixed
+            shards = -(-2 * reads_mb // (budget // processes - fixed))
+            shards = min(max(shards, processes), 4 ** bp)
+            shard_prefix = _shard_prefix(shards, bp)
+            p.notes.append('cd-hit needs about %d MB for all the reads, so they are sharded' % (needs,))
+
+    if shard_prefix:
+        p.shards = shards or processes
+        p.processes = min(processes, p.shards)
+        p.shard_prefix = min(shard_prefix, bp)
+        p.threads = 1
+        fraction = min(2.0 / p.shards, 1.0)
+        (reads, bases) = (int(reads * fraction), int(bases * fraction))
+        budget = budget // p.processes
+
+    p.cdhit_mb = cdhit_memory_mb(reads, bases, p.threads)
+    needs = cdhit_memory_mb(reads, bases, p.threads, table=False)
+
+    # -M: what cd-hit is estimated to take, with a quarter to spare and no
+    # less than it always had, within the budget
+
+    p.cdhit_memory = min(max(_round_up(p.cdhit_mb * 1.25, 100), min_cdhit_memory_mb), budget)
+    if needs > budget:
+        p.cdhit_memory = needs
+        p.notes.append('cd-hit needs about %d MB to hold the reads, over the %d MB there is for it' % (needs, budget))
+    elif p.cdhit_mb > budget:
+        p.notes.append('cd-hit is limited to %d MB, less than the %d MB estimated, so it builds its word table in several rounds' % (
+            budget, p.cdhit_mb))
+    p.cdhit_total_mb = min(p.cdhit_mb, p.cdhit_memory) * p.processes
+
+    (reads, bases) = (p.reads, p.bases)
+
+    # The extraction
+
+    if extraction:
+        p.extraction = extraction
+        p.memory_budget = memory_budget
+    else:
+        for mode in extraction_modes:
+            if extract_memory_mb(reads, bases, mode) <= memory_mb:
+                p.extraction = mode
+                break
+        else:
+            p.extraction = 'external'
+            p.memory_budget = max((memory_mb - python_fixed_mb) // 2, 64)
+    p.extract_mb = extract_memory_mb(reads, bases, p.extraction, p.memory_budget)
+
+    return p
+
+
+def plan_input(filename, cutoff, bp, **kwargs):
+    """
+    plan() for the reads in a FASTA file.  Raises IOError if it can't be
+    read.
+    """
+    (reads, bases) = measure_input(filename)
+    return plan(reads, bases, cutoff, bp, **kwargs)
+
+
+def log_record(plan, profile_record):
+    """
+    The plan's estimates next to what a run measured, from its
+    profiling.Profile record: the peak RSS of cd-hit (of each process,
+    when sharded) and of the Python side, in MB.
+    """
+    measured = {
+        'cdhit_mb': None,
+        'python_mb': profile_record['peak_rss_mb'],
+        'cdhit_seconds': None,
+    }
+    for stage in profile_record['stages']:
+        if stage['stage'] == 'cdhit':
+            measured['cdhit_mb'] = stage['child_peak_rss_mb']
+            measured['cdhit_seconds'] = stage['wall']
+
+    record = plan.record()
+    record['measured'] = measured
+    return record
+
+
+def log_report(record):
+    """
+    A line comparing a log_record()'s estimates with its measurements.
+    """
+    (estimate, measured) = (record['estimate'], record['measured'])
+    if measured['cdhit_mb'] is None:
+        cdhit = 'cd-hit did not run'
+    else:
+        cdhit = 'cd-hit estimated %d MB, used %d MB' % (estimate['cdhit_mb'], measured['cdhit_mb'])
+    return '%s; extraction estimated %d MB, peak %d MB' % (
+        cdhit, estimate['extract_mb'], measured['python_mb'])
+
+
+def format_h_vmem(mb):
+    """
+    An h_vmem figure for qsub: whole GB where it is, else MB.
+    """
+    if mb % 1024 == 0:
+        return '%dG' % (mb // 1024)
+    return '%dM' % (mb,)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--threads", dest="threads", type="int", default=0,
+                      help="cd-hit threads (default: by the reads, up to the cores available; 1 with --h-vmem)")
+    parser.add_option("--memory", dest="memory", type="int", default=0,
+                      help="Memory to plan within, in MB (default: what is available; with --h-vmem, the largest h_vmem configured)")
+    parser.add_option("--h-vmem", dest="h_vmem", action="store_true", default=False,
+                      help="Print only the h_vmem to request for the run as a one-slot grid job")
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="Print the plan as JSON")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 3:
+        print __doc__
+        sys.exit(2)
+
+    try:
+        (filename, cutoff, bp) = (args[0], float(args[1]), int(args[2]))
+    except ValueError:
+        print __doc__
+        sys.exit(2)
+
+    if options.h_vmem:
+        threads = options.threads or 1
+        memory = options.memory or (batch_replicates_config.max_h_vmem_mb - resources.vmem_fixed_mb - resources.vmem_thread_mb * threads)
+        kwargs = {'cores': threads, 'memory_mb': memory, 'threads': threads}
+    else:
+        kwargs = {'memory_mb': options.memory or None, 'threads': options.threads or None}
+
+    try:
+        result = plan_input(filename, cutoff, bp, **kwargs)
+    except IOError:
+        print >>sys.stderr, 'Cannot read %s' % (filename,)
+        sys.exit(2)
+
+    if options.h_vmem:
+        print format_h_vmem(result.h_vmem_mb())
+    elif options.json:
+        print json.dumps(result.record(), indent=1, sort_keys=True)
+    else:
+        print result.report()
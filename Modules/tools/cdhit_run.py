@@ -0,0 +1,293 @@
+#
+# Running cd-hit-est for the replicate filter scripts.
+#
+# run_cdhit() runs a single cd-hit-est over one FASTA file.  run_sharded()
+# runs it over prefix shards of the input in a local process pool and merges
+# the per-shard results into one *.clstr file, as if cd-hit had been run once.
+# run_cdhit_2d() runs cd-hit-est-2d, which compares reads with an existing set
+# of representatives instead of with each other.
+#
+# cd-hit's output is streamed straight to its log files as it runs, and its
+# progress lines ("..........  10000  finished  6543  clusters") are turned
+# into a small JSON progress record (sequences done, clusters so far, rate and
+# estimated time left) that is replaced atomically about once a second, so a
+# long clustering can be watched from outside.
+#
+# Sharding is safe because members of a final replicate cluster must share
+# their first <initial base pair requirement> bases, so as long as the shard
+# prefix is no longer than that, reads that could end up in the same cluster
+# always land in the same shard.
+#
+
+import os
+import re
+import time
+import zlib
+import subprocess
+from multiprocessing import Pool
+
+import atomic
+import batch_replicates_config
+
+
+def _options(word_size, memory, threads):
+    # -T only when it is more than one thread, so the default command is the
+    # one always run (and cached on)
+    options = '-n %d -s %%s -d 0 -M %d' % (word_size, memory)
+    if threads != 1:
+        options = options + ' -T %d' % (threads,)
+    return options
+
+
+def cdhit_command(input_file, output_file, cutoff, length, word_size=8, memory=1000, threads=1):
+    return ('%s/cd-hit-est -i %s -o %s -c %s ' + _options(word_size, memory, threads)) % (
+        batch_replicates_config.cdhit_dir, input_file, output_file, cutoff, length)
+
+
+def cdhit_2d_command(db_file, input_file, output_file, cutoff, length, word_size=8, memory=1000, threads=1):
+    return ('%s/cd-hit-est-2d -i %s -i2 %s -o %s -c %s ' + _options(word_size, memory, threads)) % (
+        batch_replicates_config.cdhit_dir, db_file, input_file, output_file, cutoff, length)
+
+
+#
+# Progress
+#
+
+_total_line = re.compile(r'total seq:\s*(\d+)')
+_progress_line = re.compile(r'(\d+)\s+finished\s+(\d+)\s+clusters')
+
+
+class Progress(object):
+    """
+    Tracks how far a cd-hit run has got, from its stdout lines, and keeps
+    a JSON record of it at 'path' (if given), rewritten at most every
+    'interval' seconds.  The record holds the status ('running',
+    'finished' or 'failed'), sequences done, total sequences, clusters so
+    far, elapsed seconds, rate in sequences per second and the estimated
+    seconds left.
+    """
+
+    def __init__(self, path=None, total=None, interval=1.0):
+        self.path = path
+        self.total = total
+        self.interval = interval
+        self.sequences = 0
+        self.clusters = 0
+        self.start = time.time()
+        self._written = 0
+
+    def line(self, line):
+        """
+        Takes one line of cd-hit's stdout.
+        """
+        m = _progress_line.search(line)
+        if m:
+            self.advance(int(m.group(1)) - self.sequences, int(m.group(2)) - self.clusters)
+            return
+        m = _total_line.search(line)
+        if m and self.total is None:
+            self.total = int(m.group(1))
+
+    def advance(self, sequences, clusters):
+        """
+        Adds sequences and clusters done.
+        """
+        self.sequences = self.sequences + sequences
+        self.clusters = self.clusters + clusters
+        if time.time() - self._written >= self.interval:
+            self.write()
+
+    def record(self, status='running'):
+        elapsed = time.time() - self.start
+        rate = elapsed and self.sequences / elapsed or 0.0
+        eta = None
+        if self.total and rate:
+            eta = round(max(self.total - self.sequences, 0) / rate, 1)
+        return {
+            'status': status,
+            'sequences': self.sequences,
+            'total': self.total,
+            'clusters': self.clusters,
+            'elapsed': round(elapsed, 1),
+            'rate': round(rate, 1),
+            'eta': eta,
+            'updated': time.time(),
+        }
+
+    def write(self, status='running'):
+        self._written = time.time()
+        if self.path:
+            atomic.write_json(self.path, self.record(status))
+
+
+def _read_tail(f, size=1 << 16):
+    f.seek(0, 2)
+    f.seek(max(f.tell() - size, 0))
+    return f.read()
+
+
+def run_cdhit(input_file, output_file, cutoff, length, log_prefix, progress=None,
+              word_size=8, memory=1000, threads=1):
+    """
+    Runs cd-hit-est on input_file, writing output_file and output_file.clstr.
+    cd-hit's stdout and stderr are written to log_prefix.out /
+    log_prefix.err as it runs, and its progress lines are fed to
+    'progress' (a Progress), if given.  word_size, memory (MB) and threads
+    are cd-hit's -n, -M and -T (see cdhit_plan.py).
+
+    Returns (returncode, stderr), with at most the last 64 KB of stderr.
+    """
+    return _run(cdhit_command(input_file, output_file, cutoff, length, word_size, memory, threads),
+                log_prefix, progress)
+
+
+def run_cdhit_2d(db_file, input_file, output_file, cutoff, length, log_prefix, progress=None,
+                 word_size=8, memory=1000, threads=1):
+    """
+    Runs cd-hit-est-2d, comparing the reads in input_file with the
+    sequences in db_file.  output_file gets the reads that match none of
+    them, and output_file.clstr a cluster for each db_file sequence (as
+    the representative) with the reads that match it.  Otherwise as
+    run_cdhit().
+    """
+    return _run(cdhit_2d_command(db_file, input_file, output_file, cutoff, length, word_size, memory, threads),
+                log_prefix, progress)
+
+
+def _run(command, log_prefix, progress):
+    out = open(log_prefix + '.out', 'w')
+    err = open(log_prefix + '.err', 'w+')
+
+    prog = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=err)
+
+    for line in iter(prog.stdout.readline, ''):
+        out.write(line)
+        out.flush()
+        if progress is not None:
+            progress.line(line)
+
+    prog.stdout.close()
+    prog.wait()
+    out.close()
+
+    stderr = _read_tail(err)
+    err.close()
+
+    if progress is not None:
+        progress.write(prog.returncode == 0 and 'finished' or 'failed')
+
+    return prog.returncode, stderr
+
+
+#
+# Sharded execution
+#
+
+def shard_of(sequence, prefix_length, num_shards):
+    """
+    Returns the shard number for a sequence, from its first prefix_length
+    bases.
+    """
+    return (zlib.crc32(sequence[:prefix_length]) & 0xffffffff) % num_shards
+
+
+def write_shards(records, shard_dir, prefix_length, num_shards):
+    """
+    Writes (name, sequence) records into num_shards FASTA files in
+    shard_dir, bucketed by their first prefix_length bases.  Returns the
+    list of shard file names that received any reads, and the number of
+    reads written.
+    """
+    names = [os.path.join(shard_dir, 'shard_%03d.fa' % i) for i in range(num_shards)]
+    files = [None] * num_shards
+
+    count = 0
+    for (name, sequence) in records:
+        i = shard_of(sequence, prefix_length, num_shards)
+        if files[i] is None:
+            files[i] = open(names[i], 'w')
+        files[i].write('>%s\n%s\n' % (name, sequence))
+        count = count + 1
+
+    used = []
+    for i in range(num_shards):
+        if files[i] is not None:
+            files[i].close()
+            used.append(names[i])
+
+    return used, count
+
+
+def _run_shard(args):
+    (index, shard_file, cutoff, length, word_size, memory) = args
+    output_file = shard_file[:-3] + '.cdhit'
+    shard_progress = Progress()
+    (returncode, stderr) = run_cdhit(shard_file, output_file, cutoff, length, shard_file[:-3] + '.cd-hit', shard_progress,
+                                     word_size, memory)
+    return index, output_file, returncode, stderr, shard_progress.sequences, shard_progress.clusters
+
+
+def run_sharded(shard_files, output_file, cutoff, length, processes, progress=None,
+                word_size=8, memory=1000):
+    """
+    Runs cd-hit-est on every shard file with a pool of 'processes' workers,
+    then merges the results into output_file and output_file.clstr.
+    'progress' (a Progress), if given, is advanced as each shard finishes.
+    Each cd-hit runs on one thread, with -n word_size and -M memory.
+
+    Returns (returncode, stderr) of the first shard that failed, or (0, '').
+    """
+    results = [None] * len(shard_files)
+
+    pool = Pool(processes)
+    try:
+        jobs = [(i, f, cutoff, length, word_size, memory) for (i, f) in enumerate(shard_files)]
+        for result in pool.imap_unordered(_run_shard, jobs, 1):
+            results[result[0]] = result
+            if progress is not None:
+                progress.advance(result[4], result[5])
+    finally:
+        pool.close()
+        pool.join()
+
+    for (index, shard_output, returncode, stderr, sequences, clusters) in results:
+        if returncode != 0:
+            if progress is not None:
+                progress.write('failed')
+            return returncode, '%s: %s' % (shard_files[index], stderr)
+
+    merge_clusters([r[1] for r in results], output_file)
+
+    if progress is not None:
+        progress.write('finished')
+
+    return 0, ''
+
+
+def merge_clusters(shard_outputs, output_file):
+    """
+    Concatenates per-shard cd-hit outputs into output_file (representative
+    sequences) and output_file.clstr, renumbering the clusters so every
+    cluster ID is unique.
+    """
+    clstr = open(output_file + '.clstr', 'w')
+    representatives = open(output_file, 'w')
+
+    next_id = 0
+    for shard_output in shard_outputs:
+        for line in open(shard_output + '.clstr'):
+            if line[:9] == '>Cluster ':
+                clstr.write('>Cluster %d\n' % next_id)
+                next_id = next_id + 1
+            elif line[-1:] == '\n':
+                clstr.write(line)
+            else:
+                clstr.write(line + '\n')
+
+        for line in open(shard_output):
+            representatives.write(line)
+
+    clstr.close()
+    representatives.close()
+
+    return next_id
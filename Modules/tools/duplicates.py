@@ -0,0 +1,77 @@
+#
+# Exact-duplicate collapsing for the replicate filter scripts.
+#
+# Byte-identical reads always end up in the same cd-hit cluster, so only one
+# of them (the "carrier") needs to go through cd-hit.  The other copies are
+# recorded in a duplicates file and put back into the carrier's cluster when
+# the *.clstr file is parsed.
+#
+# The duplicates file has one line per carrier that has copies:
+#
+#   carrier<TAB>duplicate<TAB>duplicate...
+#
+# using the read names up to the first space, as cd-hit reports them.
+#
+
+import hashlib
+
+
+class DuplicateCollapser(object):
+    """
+    Filters a stream of (name, sequence) records down to the first record
+    of every distinct sequence.  Sequences are keyed on their MD5 digest, so
+    only 16 bytes per distinct sequence are kept for the lookup.
+
+    After the stream is consumed, 'reads' and 'distinct' hold the record
+    counts and write() saves the duplicates file.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.distinct = 0
+        self._carriers = {}
+        self._carrier_names = []
+        self._duplicates = {}
+
+    def collapse(self, records):
+        carriers = self._carriers
+        for (name, sequence) in records:
+            self.reads = self.reads + 1
+            digest = hashlib.md5(sequence).digest()
+            carrier = carriers.get(digest)
+            if carrier is None:
+                carriers[digest] = len(self._carrier_names)
+                self._carrier_names.append(name.split(' ')[0])
+                self.distinct = self.distinct + 1
+                yield (name, sequence)
+            else:
+                self._duplicates.setdefault(carrier, []).append(name.split(' ')[0])
+
+    def collapsed(self):
+        return self.reads - self.distinct
+
+    def duplicates(self):
+        """
+        The carrier -> duplicates map, as read_duplicates() returns it.
+        """
+        names = self._carrier_names
+        return dict([(names[c], d) for (c, d) in self._duplicates.iteritems()])
+
+    def write(self, filename):
+        out = open(filename, 'w')
+        for carrier in sorted(self._duplicates):
+            out.write('%s\t%s\n' % (self._carrier_names[carrier], '\t'.join(self._duplicates[carrier])))
+        out.close()
+
+
+def read_duplicates(f):
+    """
+    Reads a duplicates file object into a dict mapping each carrier name to
+    the list of its duplicates' names.
+    """
+    duplicates = {}
+    for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) > 1:
+            duplicates[fields[0]] = fields[1:]
+    return duplicates
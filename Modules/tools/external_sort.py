@@ -0,0 +1,113 @@
+#
+# External-memory sorting for the replicate filter scripts.
+#
+# Records (tuples of ints and strings) are collected in memory until a run is
+# full, then sorted and spilled to a temporary file with marshal.  Reading them
+# back k-way merges the runs with heapq.merge, so only one record per run is
+# held in memory while the sorted stream is consumed.  If everything fits in a
+# single run nothing is written to disk.
+#
+# Each run is an open file, so no more than fan_in runs are merged at once:
+# whenever fan_in runs of one level have been written they are merged into one
+# run of the next level, and sorted() merges the smallest runs together until
+# at most fan_in are left for the final merge.  A sort keeps about fan_in files
+# open per level (a level holds fan_in times as many records as the one below).
+#
+
+import heapq
+import marshal
+import tempfile
+
+
+# A rough size of one buffered record (a tuple of four to seven small fields),
+# used to turn a memory budget in bytes into a run length
+record_bytes = 200
+
+# The most runs merged at once
+fan_in = 64
+
+
+def run_length(memory, sorts=1):
+    """
+    The number of records per run that keeps 'sorts' sorts running at
+    once within 'memory' bytes.
+    """
+    return max(1000, memory // (record_bytes * sorts))
+
+
+class ExternalSort(object):
+    """
+    Sorts records that may not fit in memory.  add() records, then iterate
+    over sorted() once.  Runs of 'length' records are spilled to temporary
+    files in 'tmp_dir', and merged 'fan_in' at a time; the files are
+    unlinked as soon as they are made, so nothing is left behind.
+    """
+
+    def __init__(self, tmp_dir, length, fan_in=fan_in):
+        self.tmp_dir = tmp_dir
+        self.length = length
+        self.fan_in = fan_in
+        self.count = 0
+        self._buffer = []
+        self._runs = []      # (level, file), level 0 for the spilled runs
+
+    def add(self, record):
+        self._buffer.append(record)
+        self.count = self.count + 1
+        if len(self._buffer) >= self.length:
+            self._spill()
+
+    def _spill(self):
+        self._buffer.sort()
+        self._add_run(0, self._write_run(self._buffer))
+        self._buffer = []
+
+    def _write_run(self, records):
+        f = tempfile.TemporaryFile(dir=self.tmp_dir)
+        dump = marshal.dump
+        for record in records:
+            dump(record, f)
+        f.seek(0)
+        return f
+
+    def _add_run(self, level, f):
+        self._runs.append((level, f))
+        group = [run for (run_level, run) in self._runs if run_level == level]
+        if len(group) >= self.fan_in:
+            self._runs = [(run_level, run) for (run_level, run) in self._runs if run_level != level]
+            self._add_run(level + 1, self._write_run(_merge(group)))
+
+    def sorted(self):
+        """
+        Returns an iterator over all the records added, in sorted order.
+        """
+        if not self._runs:
+            self._buffer.sort()
+            records = self._buffer
+            self._buffer = []
+            return iter(records)
+
+        if self._buffer:
+            self._spill()
+        self._runs.sort(key=lambda run: run[0])
+        runs = [run for (level, run) in self._runs]
+        self._runs = []
+
+        while len(runs) > self.fan_in:
+            group = min(len(runs) - self.fan_in + 1, self.fan_in)
+            runs = runs[group:] + [self._write_run(_merge(runs[:group]))]
+
+        return _merge(runs)
+
+
+def _merge(runs):
+    return heapq.merge(*[_read_run(f) for f in runs])
+
+
+def _read_run(f):
+    load = marshal.load
+    try:
+        while 1:
+            yield load(f)
+    except EOFError:
+        f.close()
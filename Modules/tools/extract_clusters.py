@@ -0,0 +1,1048 @@
+#
+# This tool is from:
+#
+# V. Gomez-Alvarez, T. K. Teal, T. M. Schmidt, Systematic artifacts in metagenomes from complex microbial communities, ISME J 3, 1314-1317 (2009).
+# http://microbiomes.msu.edu/replicates/
+# License: GPL
+#
+# Version: "2009-0611", current as of 2011/08/24
+# - semenko
+
+# The cluster extraction behind extract-clusters-html.py, as importable
+# functions, so extract_replicates.py can run it in-process on the reads it
+# has already loaded.
+#
+# It takes CD-HIT output and creates four output files
+# *.fasta_clusters is a file with all the clusters in fasta format, sorted from clusters with the
+# most sequences to those with the least
+# *_unique.fa is a fasta file of all the unique sequences, taking the representative sequence
+# from each cluster
+# *.cluster_summary is a summary of the sequences and the number of clusters in each file
+# *.cluser_sizes is a list of the number of clusters of each size
+#
+# Reads are handled through a read store (fasta.FastaIndex or
+# fasta.SequenceStore) and addressed by their integer IDs; names are only
+# looked up when writing output.
+#
+# For runs too large for that, there is a low-memory mode (scan_reads()): the
+# first pass over the FASTA keeps only each read's length and first bases in
+# a fasta.PrefixStore, which is all splitting clusters and picking
+# representatives need.  write_outputs() then lays out the *.fasta_clusters and
+# *_unique.fa files from the lengths, and a second, streaming pass over the
+# FASTA fills in each read at its place.  Beyond that, extract_external() runs
+# the whole extraction through sorted runs on disk, within a memory budget.
+#
+# update_outputs() adds the reads of a later increment to the output files of
+# an earlier run (see add_replicates.py).
+
+import os
+import re
+import time
+import heapq
+import shutil
+import tempfile
+import itertools
+from array import array
+from operator import itemgetter
+
+import atomic
+import bgzf
+import external_sort
+import fasta
+import profiling
+
+# a library for parsing the cd-hit output
+import cdhit_parse
+
+
+def load_reads(fasta_filename, packed=False, processes=1):
+    """
+    Returns a read store for a FASTA file.  The file is indexed, so
+    sequences are read on demand and only the index is held in memory;
+    files that can't be indexed (e.g. Mac EOLs, or gzip and BGZF files),
+    or any file with 'packed', are loaded into memory instead, packed 2 bits
+    per base in a fasta.PackedReadStore.  With 'packed', the file is parsed
+    in 'processes' processes.  Raises ValueError if it isn't a FASTA file.
+
+    The store is keyed on everything before the first space in the first
+    line of each FASTA record.  This is also how cd-hit takes the name, so
+    the keys will match.
+    """
+    if packed:
+        return fasta.load_parallel(fasta_filename, processes)
+    try:
+        return fasta.FastaIndex(fasta_filename)
+    except ValueError:
+        return fasta.load_packed(fasta.open_fasta(fasta_filename))
+
+
+def scan_reads(fasta_filename, bp_match):
+    """
+    Returns a fasta.PrefixStore for a FASTA file, for the low-memory mode:
+    only the length and first bp_match bases of each read are kept.  Raises
+    ValueError if it isn't a FASTA file.
+    """
+    return fasta.PrefixStore(fasta_filename, bp_match)
+
+
+def parse_clusters(cluster_file, reads, duplicates=None):
+    """
+    Parses a cd-hit *.clstr file object into a cdhit_parse.ClusterTable of
+    read IDs from 'reads'.  'duplicates' is the carrier -> duplicates map of
+    collapsed reads, if any.  Raises KeyError for a read that isn't in
+    'reads'.
+    """
+    return cdhit_parse.read_cluster_table(cluster_file, reads.ids, duplicates, reads.length)
+
+
+# The original extract-clusters-html.py kept the clusters and their members in
+# dicts, so the order it numbered clusters of the same size in, and the order of
+# the members of each cluster, were the dicts' iteration order.  Members are
+# listed in that order, and the representative depends on it (see
+# pick_representatives()), so the same dicts are built here to take the same
+# order.  Only the keys and the order they are added in decide it (CPython 2
+# string hashes are fixed, unless hash randomization is turned on).
+
+def _dict_order(items, key):
+    """
+    'items' in the order a dict keyed on key(item), filled in the order of
+    'items', iterates.  Of items with the same key the last is kept.
+    """
+    d = {}
+    for item in items:
+        d[key(item)] = item
+    return d.values()
+
+
+def order_clusters(cluster_table):
+    """
+    Returns the cluster indexes of a ClusterTable, largest cluster first.
+    Clusters of the same size are taken in the order of a dict keyed on
+    their cd-hit names, as extract-clusters-html.py always took them.
+    Raises ValueError if two clusters have the same name.
+    """
+    labels = cluster_table.labels
+    order = _dict_order(xrange(len(labels)), labels.__getitem__)
+    if len(order) != len(labels):
+        raise ValueError('A cluster name is repeated in the cd-hit output')
+    return sorted(order, key=cluster_table.size, reverse=True)
+
+
+# **************  Analyze clusters to see if the first 3 bp match ********
+
+# Split every cluster so that all the sequences in a piece share their first
+# bp_match base pairs, as compare_bp() in extract-clusters-html.py always did.
+# The first piece holds the members that share the cd-hit representative's
+# prefix, the next those that share the prefix of the first member left over,
+# and so on, each piece and the members left over in the dict order of the
+# members (see _dict_order()).  Prefixes are compared with the store's
+# prefix_key(), which for packed reads compares packed bytes instead of
+# strings.  If bp_match is set to 0, then clusters will not be affected by
+# comparing the initial base pairs.
+
+def split_clusters(cluster_table, cluster_order, reads, bp_match):
+    """
+    Returns a ClusterTable of the clusters in cluster_table, taken in
+    cluster_order and split by their first bp_match base pairs.
+    """
+    split_set = cdhit_parse.ClusterTable()
+
+    members = cluster_table.members
+    offsets = cluster_table.offsets
+    name = reads.ids.names.__getitem__
+    prefix_key = reads.prefix_key
+
+    for cluster in cluster_order:
+        start, end = offsets[cluster], offsets[cluster + 1]
+        label = cluster_table.labels[cluster]
+
+        if end - start == 1:
+            split_set.append(label, members[start:end])
+            continue
+
+        if not bp_match:
+            split_set.append(label, _dict_order(members[start:end], name))
+            continue
+
+        prefixes = dict([(i, prefix_key(i, bp_match)) for i in members[start:end]])
+        remaining = members[start:end]
+        while remaining:
+            template = prefixes[remaining[0]]
+            piece = array('l')
+            rest = []
+            for i in _dict_order(remaining, name):
+                if prefixes[i] == template:
+                    piece.append(i)
+                else:
+                    rest.append(i)
+            split_set.append(label, piece)
+            remaining = rest
+
+    return split_set
+
+
+def count_unique(cluster_table, reads, bp_values):
+    """
+    Returns a dict of the number of clusters split_clusters() would give
+    for each initial base pair requirement in bp_values, without building
+    the split clusters.  The clusters are split once at the longest
+    requirement; a shorter one only merges pieces, so it is counted by
+    truncating the distinct prefixes of each cluster.
+    """
+    longest = max(bp_values)
+    counts = dict([(bp, 0) for bp in bp_values])
+
+    members = cluster_table.members
+    offsets = cluster_table.offsets
+    prefix = reads.prefix
+
+    for cluster in xrange(len(cluster_table)):
+        start, end = offsets[cluster], offsets[cluster + 1]
+
+        if not longest or end - start == 1:
+            for bp in counts:
+                counts[bp] = counts[bp] + 1
+            continue
+
+        prefixes = set([prefix(members[m], longest) for m in xrange(start, end)])
+
+        for bp in counts:
+            if bp == longest:
+                counts[bp] = counts[bp] + len(prefixes)
+            elif not bp:
+                counts[bp] = counts[bp] + 1
+            else:
+                counts[bp] = counts[bp] + len(set([p[:bp] for p in prefixes]))
+
+    return counts
+
+
+def pick_representatives(cluster_set, reads):
+    """
+    Returns an array with the reference sequence ID for each cluster of
+    cluster_set: the last member that is longer than the cluster's first
+    member, or the first member if none is, in the member order
+    split_clusters() gives.
+    """
+    cluster_ref_seq = array('l')
+
+    for j in xrange(len(cluster_set)):
+
+        members = cluster_set.cluster(j)
+        ref_seq = members[0]
+        ref_seq_length = reads.length(members[0])
+        for s in members:
+            if (reads.length(s) > ref_seq_length):
+                ref_seq = s
+
+        cluster_ref_seq.append(ref_seq)
+
+    return cluster_ref_seq
+
+
+class Extraction(object):
+    """
+    The result of extracting replicate clusters.  Cluster number n is row
+    n - 1 of cluster_set; cluster_ref_seq and cluster_num_seq hold the
+    reference sequence ID and the number of sequences of each cluster.
+    """
+
+    def __init__(self, reads, cluster_set, cluster_ref_seq):
+        self.reads = reads
+        self.cluster_set = cluster_set
+        self.cluster_ref_seq = cluster_ref_seq
+        self.cluster_num_seq = cluster_set.sizes()
+
+        self.num_seq = float(len(reads))
+        self.num_unique = float(len(cluster_set))
+        percent_float = (self.num_seq - self.num_unique)/self.num_seq*100
+        self.percent = round(percent_float, 2)
+
+    def largest(self, n=10):
+        """
+        Indexes of the n largest clusters, in order of most sequences to least.
+        """
+        return sorted(xrange(len(self.cluster_set)), key=self.cluster_num_seq.__getitem__, reverse=True)[0:n]
+
+
+def extract(cluster_file, reads, bp_match, duplicates=None, profile=None):
+    """
+    Runs the whole analysis on a cd-hit *.clstr file object and a read
+    store, and returns an Extraction.  Each step is run as a stage of
+    'profile' (a profiling.Profile), if given.
+    """
+    if profile is None:
+        profile = profiling.Profile()
+
+    cluster_table = profile.run('parse', parse_clusters, cluster_file, reads, duplicates)
+    profile.count(len(cluster_table.members))
+    cluster_order = profile.run('order', order_clusters, cluster_table)
+    cluster_set = profile.run('split', split_clusters, cluster_table, cluster_order, reads, bp_match)
+    profile.count(len(cluster_set))
+    cluster_ref_seq = profile.run('representatives', pick_representatives, cluster_set, reads)
+    return Extraction(reads, cluster_set, cluster_ref_seq)
+
+
+def report(result, output_type):
+    """
+    The summary printed to the terminal.  If this is coming from the cgi
+    script the output will be HTML.  If it's from the command line script,
+    it will be text.
+    """
+    lines = []
+
+    if (output_type == 'html'):
+
+        lines.append('<dl><dd>Number of reads: %s <dd>Number of unique reads: %s <dd>Percent of reads that are replicates: %s %%</dl>' % (int(result.num_seq), int(result.num_unique), result.percent))
+
+        lines.append('<p>10 largest clusters <dl>')
+        for l in result.largest():
+            lines.append('<dd>Cluster %s Number of sequences: %s' % (l + 1, result.cluster_num_seq[l]))
+        lines.append('</dl>')
+
+    elif (output_type == 'text'):
+        lines.append('Number of reads: %s \nNumber of unique reads: %s \nPercent of reads that are replicates: %s %%\n' % (int(result.num_seq), int(result.num_unique), result.percent))
+
+        lines.append('10 largest clusters\n')
+        for l in result.largest():
+            lines.append('Cluster %s Number of sequences: %s' % (l + 1, result.cluster_num_seq[l]))
+
+    return '\n'.join(lines)
+
+
+def output_names(outfile, compress=False):
+    """
+    The four output file names for an output prefix.  Compressed outputs
+    get a .gz suffix.
+    """
+    suffix = compress and '.gz' or ''
+    return {
+        'fasta_clusters': outfile + '.fasta_clusters' + suffix,
+        'cluster_summary': outfile + '.cluster_summary' + suffix,
+        'cluster_sizes': outfile + '.cluster_sizes' + suffix,
+        'unique': outfile + '_unique.fa' + suffix,
+    }
+
+
+def _temp_name(name):
+    (head, tail) = os.path.split(name)
+    return os.path.join(head, '.' + tail + '.part')
+
+
+def write_outputs(result, outfile, input_name, fasta_name, compress=False, threads=None):
+    """
+    Writes the four output files for an Extraction.  'input_name' is the
+    file name reported as analyzed, 'fasta_name' the FASTA file the
+    sequences came from.  With 'compress' the files are written as BGZF,
+    compressed on 'threads' threads.  Returns the output_names().  Raises
+    IOError if a file can't be written.
+
+    The files are written under temporary names and renamed into place
+    once they are all complete, the cluster summary last, so a file that
+    exists under its real name is always whole.
+
+    If the reads are a fasta.PrefixStore (the low-memory mode), the
+    sequences are streamed from its FASTA file instead.  The output is the
+    same.
+    """
+    if isinstance(result.reads, fasta.PrefixStore):
+        write = lambda files: _stream_files(result, files, input_name, fasta_name, os.path.dirname(outfile) or '.')
+    else:
+        write = lambda files: _write_files(result, files, input_name, fasta_name)
+    return _write_atomically(outfile, compress, threads, write)
+
+
+def _write_atomically(outfile, compress, threads, write):
+    """
+    Opens the output files under temporary names, calls write(files) with
+    them keyed as in output_names(), and renames them into place.
+    """
+    names = output_names(outfile, compress)
+    temps = dict([(key, _temp_name(name)) for (key, name) in names.iteritems()])
+
+    if compress:
+        opener = lambda name: bgzf.BgzfWriter(name, threads)
+    else:
+        opener = lambda name: open(name, 'w')
+
+    files = {}
+    try:
+        for key in ('fasta_clusters', 'cluster_summary', 'cluster_sizes', 'unique'):
+            files[key] = opener(temps[key])
+        write(files)
+        for f in files.values():
+            f.close()
+    except:
+        for key in files:
+            files[key].close()
+            os.unlink(temps[key])
+        raise
+
+    for key in ('fasta_clusters', 'cluster_sizes', 'unique', 'cluster_summary'):
+        os.rename(temps[key], names[key])
+
+    return names
+
+
+def _write_files(result, files, input_name, fasta_name):
+    reads = result.reads
+    read_names = reads.ids.names
+    cluster_set = result.cluster_set
+
+    _write_tables(result, files['cluster_summary'], files['cluster_sizes'], input_name, fasta_name)
+
+    # ++++++++++
+
+    # Writing each sequence out, so that you have a file with all the sequences in
+    # each cluster
+
+    # Right now the output is in order from most sequences in a cluster to least, except
+    # where clusters are split after the initial base pair check.
+    # If you want the output in order of most sequences in a cluster to least for all clusters,
+    # loop over result.largest(len(cluster_set)) instead of range(len(cluster_set)).
+
+    # Output file for the list of all the sequences in each cluster
+    output = files['fasta_clusters']
+
+    output.write('File analyzed: %s' % (input_name))
+
+    for j in xrange(len(cluster_set)):
+        output.write(_cluster_header(j + 1, read_names[result.cluster_ref_seq[j]], result.cluster_num_seq[j]))
+        for item in cluster_set.cluster(j):
+            output.write('>%s\n%s\n' % (read_names[item], reads.sequence(item),))
+
+    # ~~~~~~~~~~~~~ Create a file with all the unique sequences
+
+    output_unique = files['unique']
+
+    for q in result.cluster_ref_seq:
+        output_unique.write('>%s\n%s\n' % (read_names[q], reads.sequence(q)))
+
+
+def _cluster_header(cluster_id, ref_name, num_seq):
+    return '\n----------------------------------------\nCluster %s   Reference sequence: %s Number of sequences: %s\n' % (cluster_id, ref_name, num_seq,)
+
+
+def _summary_header(result, input_name):
+    return 'File analyzed: %s\n454 Replicate Filter version 0.3\nNumber of sequences: %s  Number of unique reads: %s  Percent of repeats %s\nCluster\tRef sequence\tNum of seq\n' % (input_name, result.num_seq, result.num_unique, result.percent,)
+
+
+def _summary_row(cluster_id, ref_name, num_seq):
+    return '%s\t%s\t%s\n' % (cluster_id, ref_name, num_seq,)
+
+
+def _write_sizes(output_clstr_size, cluster_size_db, fasta_name):
+
+    # ~~~~~~  Create a file that has the number of sequences in a cluster versus
+    #         the number of clusters there are of that size
+
+    output_clstr_size.write('File analyzed:\n%s\nCluster size\tNumber of clusters\n' % (fasta_name,))
+
+    for clstr_num in sorted(cluster_size_db):
+        output_clstr_size.write('%s\t%s\n' % (clstr_num, cluster_size_db[clstr_num],))
+
+
+def _write_tables(result, output_summary, output_clstr_size, input_name, fasta_name):
+    """
+    Writes the *.cluster_summary and *.cluster_sizes files, which need no
+    sequences.
+    """
+    read_names = result.reads.ids.names
+    cluster_ref_seq = result.cluster_ref_seq
+    cluster_num_seq = result.cluster_num_seq
+
+    # Output summary
+    output_summary.write(_summary_header(result, input_name))
+
+    cluster_size_db = {}
+
+    for j in xrange(len(result.cluster_set)):
+
+        # Detail for output summary file
+        output_summary.write(_summary_row(j + 1, read_names[cluster_ref_seq[j]], cluster_num_seq[j]))
+
+        # Determine the number of clusters with a given number of reads in it
+        cluster_size_db[cluster_num_seq[j]] = cluster_size_db.get(cluster_num_seq[j], 0) + 1
+
+    _write_sizes(output_clstr_size, cluster_size_db, fasta_name)
+
+
+# The low-memory writer.  Every record in *.fasta_clusters and *_unique.fa is
+# '>name\nsequence\n', so its size is known from the read's name and length
+# alone.  The first pass writes the cluster headers and leaves a gap of exactly
+# that size for each read, noting where it goes; the second streams the FASTA
+# in file order and writes each read into its gap(s).  Compressed outputs can't
+# be written out of order, so they are laid out in a scratch file first and
+# compressed from it.
+#
+# A read normally has at most one place in each file, kept in an array indexed
+# by read ID.  A read whose name is repeated in the input can be listed more
+# than once by cd-hit; its further places go in a dict.
+
+class _Places(object):
+
+    def __init__(self, num_reads):
+        self.first = array('l', [-1]) * num_reads
+        self.more = {}
+
+    def add(self, i, pos):
+        if self.first[i] < 0:
+            self.first[i] = pos
+        else:
+            self.more.setdefault(i, []).append(pos)
+
+    def get(self, i):
+        if self.first[i] < 0:
+            return ()
+        return [self.first[i]] + self.more.get(i, [])
+
+
+
+def _stream_files(result, files, input_name, fasta_name, scratch_dir):
+    reads = result.reads
+    read_names = reads.ids.names
+    lengths = reads.lengths
+    cluster_set = result.cluster_set
+
+    _write_tables(result, files['cluster_summary'], files['cluster_sizes'], input_name, fasta_name)
+
+    outputs = _seekable(files, scratch_dir)
+
+    # Lay out the files
+
+    output = outputs['fasta_clusters']
+    cluster_places = _Places(len(reads))
+
+    header = 'File analyzed: %s' % (input_name)
+    output.write(header)
+    pos = len(header)
+
+    for j in xrange(len(cluster_set)):
+        header = _cluster_header(j + 1, read_names[result.cluster_ref_seq[j]], result.cluster_num_seq[j])
+        output.seek(pos)
+        output.write(header)
+        pos = pos + len(header)
+        for item in cluster_set.cluster(j):
+            cluster_places.add(item, pos)
+            pos = pos + len(read_names[item]) + lengths[item] + 3
+
+    unique_places = _Places(len(reads))
+    pos = 0
+
+    for q in result.cluster_ref_seq:
+        unique_places.add(q, pos)
+        pos = pos + len(read_names[q]) + lengths[q] + 3
+
+    # Fill in the reads
+
+    output_unique = outputs['unique']
+
+    for (i, sequence) in reads.records():
+        for pos in cluster_places.get(i):
+            output.seek(pos)
+            output.write('>%s\n%s\n' % (read_names[i], sequence))
+        for pos in unique_places.get(i):
+            output_unique.seek(pos)
+            output_unique.write('>%s\n%s\n' % (read_names[i], sequence))
+
+    _copy_scratch(outputs, files)
+
+
+def _seekable(files, scratch_dir):
+    """
+    The *.fasta_clusters and *_unique.fa files, or scratch files in
+    'scratch_dir' to lay them out in if they are compressed.
+    """
+    outputs = {}
+    for key in ('fasta_clusters', 'unique'):
+        if isinstance(files[key], file):
+            outputs[key] = files[key]
+        else:
+            outputs[key] = tempfile.TemporaryFile(dir=scratch_dir)
+    return outputs
+
+
+def _copy_scratch(outputs, files):
+    for key in outputs:
+        if outputs[key] is not files[key]:
+            outputs[key].seek(0)
+            shutil.copyfileobj(outputs[key], files[key], 1 << 20)
+            outputs[key].close()
+
+
+#
+# External-memory extraction
+#
+# For runs whose cluster set-up doesn't fit in memory even in the low-memory
+# mode, extract_external() does the whole extraction as a series of
+# external_sort.ExternalSort streams, so memory is bounded by a budget (and by
+# the largest single cd-hit cluster) rather than by the number of reads:
+#
+#   1. The FASTA file is scanned into (name, ordinal, length, prefix) records
+#      and the *.clstr file into (name, -size, cluster, position) records, and
+#      both are sorted by name.  'ordinal' is the record's place in the FASTA
+#      file, 'position' the member's place in its cd-hit cluster.
+#   2. The two are merge-joined on the name, and the members, now with their
+#      lengths and prefixes, are sorted into (-size, cluster, position) order,
+#      the order order_clusters() puts the clusters in.
+#   3. That stream is read one cd-hit cluster at a time.  Each is split and
+#      given its representatives as split_clusters() and
+#      pick_representatives() do, and the summary, the size histogram and the
+#      layout of *.fasta_clusters and *_unique.fa (see _stream_files()) are
+#      written as it goes.  Where each read goes is recorded as an (ordinal,
+#      file, offset) record.
+#   4. Those are sorted by ordinal, and the FASTA file is streamed once more
+#      to write each read into its places.
+#
+# The output is the same as from extract() and write_outputs().
+
+class Summary(object):
+    """
+    The counts of an external extraction.  It has the attributes of an
+    Extraction that report() and write_manifest() use, but cluster_num_seq
+    only holds the sizes of the largest clusters.
+    """
+
+    # The number of largest clusters kept for report()
+    keep = 10
+
+    def __init__(self, num_seq, num_unique, largest):
+        self.num_seq = float(num_seq)
+        self.num_unique = float(num_unique)
+        percent_float = (self.num_seq - self.num_unique)/self.num_seq*100
+        self.percent = round(percent_float, 2)
+
+        self._largest = [j for (j, size) in largest]
+        self.cluster_num_seq = dict(largest)
+
+    def largest(self, n=10):
+        return self._largest[0:n]
+
+
+def extract_external(cluster_file, fasta_filename, bp_match, outfile, input_name, fasta_name,
+                     duplicates=None, memory=256 << 20, tmp_dir=None, compress=False, threads=None):
+    """
+    Runs the whole analysis on a cd-hit *.clstr file object and a FASTA
+    file in about 'memory' bytes, spilling sorted runs to temporary files in
+    'tmp_dir' (by default the output directory), and writes the output
+    files as write_outputs() does.  Returns (Summary, output_names()).
+    Raises KeyError for a read that isn't in the FASTA file, ValueError if
+    it isn't a FASTA file, and IOError if a file can't be written.
+    """
+    tmp_dir = tmp_dir or os.path.dirname(outfile) or '.'
+    length = external_sort.run_length(memory, 3)
+
+    # 1. Both inputs, sorted by name
+
+    reads = external_sort.ExternalSort(tmp_dir, length)
+    f = fasta.open_fasta(fasta_filename)
+    try:
+        for (ordinal, (name, sequence)) in enumerate(fasta.iterload(f)):
+            reads.add((name.split(' ')[0], ordinal, len(sequence), sequence[:bp_match]))
+    finally:
+        f.close()
+
+    # Collapsed duplicates are given position -1 and put in their place in
+    # the cluster once their lengths are known (see _write_external()).
+
+    members = external_sort.ExternalSort(tmp_dir, length)
+    labels = []
+    for (k, cluster) in enumerate(cdhit_parse.iter_clusters(cluster_file)):
+        labels.append(cluster.id)
+        added = []
+        if duplicates:
+            for name in cluster.members:
+                added.extend(duplicates.get(name, ()))
+        size = -(len(cluster.members) + len(added))
+        for (position, name) in enumerate(cluster.members):
+            members.add((name, size, k, position))
+        for name in added:
+            members.add((name, size, k, -1))
+
+    # 2. Joined on the name, and sorted into cluster order.  As in
+    #    load_store(), the last of several reads with the same name wins.
+    #    Clusters of the same size go in order_clusters() order, by their rank
+    #    in it.
+
+    order = _dict_order(xrange(len(labels)), labels.__getitem__)
+    if len(order) != len(labels):
+        raise ValueError('A cluster name is repeated in the cd-hit output')
+    rank = array('l', [0]) * len(labels)
+    for (r, k) in enumerate(order):
+        rank[k] = r
+    del labels, order
+
+    clustered = external_sort.ExternalSort(tmp_dir, length)
+    num_seq = 0
+
+    named = _last_of_each_name(reads.sorted())
+    read = next(named, None)
+    for (name, size, k, position) in members.sorted():
+        while read is not None and read[0] < name:
+            num_seq = num_seq + 1
+            read = next(named, None)
+        if read is None or read[0] != name:
+            raise KeyError(name)
+        clustered.add((size, rank[k], position, name, read[1], read[2], read[3]))
+
+    while read is not None:
+        num_seq = num_seq + 1
+        read = next(named, None)
+
+    # 3. and 4.
+
+    summary = []
+    write = lambda files: summary.append(_write_external(files, clustered, num_seq, bp_match, fasta_filename,
+                                                         input_name, fasta_name, tmp_dir, length))
+    outputs = _write_atomically(outfile, compress, threads, write)
+
+    return summary[0], outputs
+
+
+def _last_of_each_name(records):
+    previous = None
+    for record in records:
+        if previous is not None and record[0] != previous[0]:
+            yield previous
+        previous = record
+    if previous is not None:
+        yield previous
+
+
+def _split_members(members, bp_match):
+    """
+    Splits the members of one cd-hit cluster, in .clstr order, as
+    split_clusters() does.
+    """
+    name = itemgetter(3)
+
+    if len(members) == 1:
+        return [members]
+    if not bp_match:
+        return [_dict_order(members, name)]
+
+    pieces = []
+    while members:
+        template = members[0][6]
+        piece = []
+        rest = []
+        for member in _dict_order(members, name):
+            if member[6] == template:
+                piece.append(member)
+            else:
+                rest.append(member)
+        pieces.append(piece)
+        members = rest
+    return pieces
+
+
+def _write_external(files, clustered, num_seq, bp_match, fasta_filename, input_name, fasta_name, tmp_dir, length):
+    outputs = _seekable(files, tmp_dir)
+    output = outputs['fasta_clusters']
+    output_unique = outputs['unique']
+
+    # The summary rows go to a scratch file until the counts for its header
+    # are known
+    rows = tempfile.TemporaryFile(dir=tmp_dir)
+    places = external_sort.ExternalSort(tmp_dir, length)
+    cluster_size_db = {}
+    largest = []
+
+    header = 'File analyzed: %s' % (input_name)
+    output.write(header)
+    pos = len(header)
+    unique_pos = 0
+    j = 0
+
+    # member is (-size, cluster, position, name, ordinal, length, prefix)
+    in_order = lambda member: (-member[5], member[4])
+
+    for (k, members) in itertools.groupby(clustered.sorted(), lambda member: member[1]):
+        members = list(members)
+        if members[0][2] < 0:
+            added = [member for member in members if member[2] < 0]
+            members = cdhit_parse.insert_duplicates(members[len(added):], added, in_order)
+
+        for piece in _split_members(members, bp_match):
+
+            ref = piece[0]
+            for member in piece:
+                if member[5] > piece[0][5]:
+                    ref = member
+
+            j = j + 1
+            num = len(piece)
+
+            rows.write(_summary_row(j, ref[3], num))
+            cluster_size_db[num] = cluster_size_db.get(num, 0) + 1
+
+            _keep_largest(largest, num, j)
+
+            header = _cluster_header(j, ref[3], num)
+            output.seek(pos)
+            output.write(header)
+            pos = pos + len(header)
+            for member in piece:
+                places.add((member[4], 0, pos))
+                pos = pos + len(member[3]) + member[5] + 3
+
+            places.add((ref[4], 1, unique_pos))
+            unique_pos = unique_pos + len(ref[3]) + ref[5] + 3
+
+    summary = Summary(num_seq, j, _largest_of(largest))
+
+    files['cluster_summary'].write(_summary_header(summary, input_name))
+    rows.seek(0)
+    shutil.copyfileobj(rows, files['cluster_summary'], 1 << 20)
+    rows.close()
+
+    _write_sizes(files['cluster_sizes'], cluster_size_db, fasta_name)
+
+    # Fill in the reads
+
+    targets = (output, output_unique)
+    in_order = places.sorted()
+    place = next(in_order, None)
+
+    f = fasta.open_fasta(fasta_filename)
+    try:
+        for (ordinal, (name, sequence)) in enumerate(fasta.iterload(f)):
+            if place is None:
+                break
+            while place is not None and place[0] == ordinal:
+                target = targets[place[1]]
+                target.seek(place[2])
+                target.write('>%s\n%s\n' % (name.split(' ')[0], sequence))
+                place = next(in_order, None)
+    finally:
+        f.close()
+
+    if place is not None:
+        raise ValueError('%s has changed since it was first read' % (fasta_filename,))
+
+    _copy_scratch(outputs, files)
+
+    return summary
+
+
+def _keep_largest(largest, num, j):
+    """
+    Keeps the Summary.keep largest clusters in the heap 'largest' as
+    (size, -cluster number); the first cluster wins a tie.
+    """
+    if len(largest) < Summary.keep:
+        heapq.heappush(largest, (num, -j))
+    elif (num, -j) > largest[0]:
+        heapq.heapreplace(largest, (num, -j))
+
+
+def _largest_of(largest):
+    return [(-negative - 1, num) for (num, negative) in sorted(largest, reverse=True)]
+
+
+#
+# Adding reads to an earlier run
+#
+# The reads of an increment either join existing clusters, whose numbers and
+# representatives stay the same, or form new clusters numbered after the
+# existing ones.  update_outputs() writes the four output files again from the
+# old ones, streaming each once, so only the new reads (and the cluster size
+# histogram) are held in memory:
+#
+#   *.cluster_summary  the counts in the header change; the rows of clusters
+#                      that grew get their new sizes, and the new clusters are
+#                      added at the end
+#   *.cluster_sizes    the old histogram, with those changes
+#   *.fasta_clusters   the new reads are added at the end of the cluster they
+#                      joined, and the new clusters after the last one
+#   *_unique.fa        the representatives of the new clusters are added
+#
+# The name of the increment's FASTA file is added to each "File analyzed".
+
+_summary_counts = re.compile(r'Number of sequences: ([0-9.]+)  Number of unique reads: ([0-9.]+)')
+_cluster_line = re.compile(r'Cluster (\d+)   Reference sequence: (.*) Number of sequences: (\d+)$')
+
+
+def update_outputs(outfile, added_name, reads, joined, added, compress=False, threads=None):
+    """
+    Adds new reads to the output files of an earlier run with the output
+    prefix 'outfile', in place.  'reads' is a read store of the new reads,
+    'joined' maps an existing cluster number to the IDs of the new reads
+    that join it, and 'added' is the Extraction of the others.
+    'added_name' is the name of the new reads' file.  The files are
+    replaced as write_outputs() writes them.  Returns (Summary,
+    output_names()).  Raises IOError if a file can't be read or written,
+    and ValueError if the files aren't a run's output, or a new read has
+    the name of an old one.
+    """
+    old = output_names(outfile, compress)
+    summary = []
+    write = lambda files: summary.append(_update_files(old, files, added_name, reads, joined, added))
+    outputs = _write_atomically(outfile, compress, threads, write)
+    return summary[0], outputs
+
+
+def _lines(filename, blocksize=1 << 20):
+    """
+    Yields the lines of a file (which may be gzip or BGZF compressed)
+    without their line ends.
+    """
+    f = fasta.open_fasta(filename)
+    try:
+        tail = ''
+        while 1:
+            block = f.read(blocksize)
+            if not block:
+                break
+            lines = (tail + block).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line
+        if tail:
+            yield tail
+    finally:
+        f.close()
+
+
+def _update_files(old, files, added_name, reads, joined, added):
+    read_names = reads.ids.names
+    added_set = added.cluster_set
+
+    # The summary, and which clusters changed size
+
+    lines = _lines(old['cluster_summary'])
+    input_name = next(lines, '')
+    next(lines, None)
+    counts = _summary_counts.match(next(lines, ''))
+    next(lines, None)
+    if input_name[:15] != 'File analyzed: ' or not counts:
+        raise ValueError('%s is not a cluster summary' % (old['cluster_summary'],))
+
+    input_name = input_name[15:] + ', ' + added_name
+    num_clusters = int(float(counts.group(2)))
+    summary = Summary(int(float(counts.group(1))) + len(reads), num_clusters + len(added_set), [])
+
+    output_summary = files['cluster_summary']
+    output_summary.write(_summary_header(summary, input_name))
+
+    largest = []
+    resized = {}
+    j = 0
+
+    for line in lines:
+        if not line:
+            continue
+        (cluster_id, ref_name, num) = line.split('\t')
+        j = int(cluster_id)
+        num = int(num)
+        if j in joined:
+            resized[num] = resized.get(num, 0) - 1
+            num = num + len(joined[j])
+            resized[num] = resized.get(num, 0) + 1
+        output_summary.write(_summary_row(j, ref_name, num))
+        _keep_largest(largest, num, j)
+
+    if j != num_clusters:
+        raise ValueError('%s lists %d of %d clusters' % (old['cluster_summary'], j, num_clusters))
+
+    for k in xrange(len(added_set)):
+        j = num_clusters + k + 1
+        num = added.cluster_num_seq[k]
+        output_summary.write(_summary_row(j, read_names[added.cluster_ref_seq[k]], num))
+        _keep_largest(largest, num, j)
+        resized[num] = resized.get(num, 0) + 1
+
+    # The histogram
+
+    lines = _lines(old['cluster_sizes'])
+    next(lines, None)
+    fasta_name = next(lines, '') + ', ' + added_name
+    next(lines, None)
+
+    cluster_size_db = {}
+    for line in lines:
+        if line:
+            (size, count) = line.split('\t')
+            cluster_size_db[int(size)] = int(count)
+    for (size, change) in resized.iteritems():
+        cluster_size_db[size] = cluster_size_db.get(size, 0) + change
+        if not cluster_size_db[size]:
+            del cluster_size_db[size]
+
+    _write_sizes(files['cluster_sizes'], cluster_size_db, fasta_name)
+
+    # The clusters.  Every read is a '>name' line and a sequence line.
+
+    output = files['fasta_clusters']
+
+    def write_reads(members):
+        for item in members:
+            output.write('>%s\n%s\n' % (read_names[item], reads.sequence(item)))
+
+    lines = _lines(old['fasta_clusters'])
+    next(lines, None)
+    output.write('File analyzed: %s' % (input_name))
+
+    j = 0
+    for line in lines:
+        if line[:1] == '>':
+            if line[1:] in reads.ids:
+                raise ValueError('%s is already in %s' % (line[1:], old['fasta_clusters']))
+            output.write('%s\n%s\n' % (line, next(lines, '')))
+        elif line[:8] == 'Cluster ':
+            write_reads(joined.get(j, ()))
+            (cluster_id, ref_name, num) = _cluster_line.match(line).groups()
+            j = int(cluster_id)
+            output.write(_cluster_header(j, ref_name, int(num) + len(joined.get(j, ()))))
+    write_reads(joined.get(j, ()))
+
+    for k in xrange(len(added_set)):
+        output.write(_cluster_header(num_clusters + k + 1, read_names[added.cluster_ref_seq[k]], added.cluster_num_seq[k]))
+        write_reads(added_set.cluster(k))
+
+    # The representatives
+
+    output_unique = files['unique']
+    for line in _lines(old['unique']):
+        output_unique.write(line + '\n')
+    for q in added.cluster_ref_seq:
+        output_unique.write('>%s\n%s\n' % (read_names[q], reads.sequence(q)))
+
+    return Summary(summary.num_seq, summary.num_unique, _largest_of(largest))
+
+
+#
+# Completion manifest
+#
+# When a run ends, successfully or not, a JSON manifest is written atomically
+# next to its outputs.  Its appearance is the signal that the run is over
+# (wait_for_manifest.py blocks on it); it holds
+#
+#   status    'complete' or 'failed'
+#   error     the error message, if it failed
+#   outputs   the output file names, keyed as in output_names()
+#   counts    reads, unique reads and percent of replicates
+#   finished  the time it was written
+#
+# plus whatever the writer adds (input, parameters, timings, and increments
+# for a run that reads were added to).
+#
+
+def write_manifest(path, status, result=None, outputs=None, error=None, **details):
+    """
+    Writes the completion manifest to 'path'.
+    """
+    record = {
+        'status': status,
+        'error': error,
+        'outputs': outputs or {},
+        'finished': time.time(),
+    }
+    if result is not None:
+        record['counts'] = {
+            'reads': int(result.num_seq),
+            'unique': int(result.num_unique),
+            'percent': result.percent,
+        }
+    record.update(details)
+    atomic.write_json(path, record)
@@ -10,16 +10,26 @@
 # - semenko
 
 
+import atomic
 import batch_replicates_config
+import cdhit_cache
+import cdhit_plan
+import cdhit_run
+import duplicates
+import extract_clusters
 import fasta
+import hashlib
+import native_replicates
 import os
-import subprocess
+import profiling
 import random
+import resources
 import tempfile
 import sys
 import time
+import multiprocessing
 
-#from optparse import OptionParser
+from optparse import OptionParser
 
 '''
 This script takes a 454 fasta file as input, determines which reads
@@ -35,11 +45,11 @@ to determine if they are truly # artifactual by determining if the
 initial base pairs of clustered sequences match.
 
 This script requires:
-  an installation of cd-hit
+  an installation of cd-hit (not needed with --engine native)
   batch_replicates_config.py
   fasta.py
-  cd_hit_parse.py
-  extract-clusters-html.py
+  cdhit_parse.py
+  extract_clusters.py
 
 
 Changing the input to use option flags rather than sys.argv position.  This is not yet implemented.
@@ -58,10 +68,7 @@ Changing the input to use option flags rather than sys.argv position.  This is n
 ##########
 '''
 
-if (len(sys.argv) != 6):
-
-   print """
-
+usage = """
 -------------------
 
 Usage: extract_replicates.py <input filename> <sequence identity cutoff> <length difference requirement> <initial base pair requirement> <output directory>
@@ -77,20 +84,27 @@ The <initial base pair requirement> is the number of base pairs required to matc
 -------------------
 
 """
-   sys.exit(1)
 
 
-filename = sys.argv[1]
-cutoff_input = sys.argv[2]
-length_input = sys.argv[3]
-bp_input = sys.argv[4]
-dirname = sys.argv[5]
+# The completion manifest written to the output directory when a run ends
+manifest_name = 'completion.json'
+
+
+class DereplicationError(Exception):
+   """
+   Raised by dereplicate() with the message to show the user.
+   """
+
+   def __init__(self, message, exit_code=2):
+      Exception.__init__(self, message)
+      self.exit_code = exit_code
 
-filename_check = filename.split(" ")
-if len(filename_check) > 1:
-   print '\nThe input filename should not contain spaces.  Please rename it, and try again.\n'
-   sys.exit(2)
 
+class OutputExistsError(DereplicationError):
+   """
+   Raised by dereplicate() when the output directory already exists, so
+   nothing in it belongs to this run.
+   """
 
 
 #
@@ -101,8 +115,7 @@ def _mkdir(root, newdir):
    try:
       os.mkdir(root)
    except OSError:
-      print "\nCannot make the directory", root, ".  Does it already exist?\n"
-      sys.exit(2)
+      raise OutputExistsError("\nCannot make the directory %s .  Does it already exist?\n" % (root,))
    os.mkdir(newdir)
 
 #def _mkdir(root, newdir):
@@ -120,132 +133,509 @@ def _mkdir(root, newdir):
 #         os.mkdir(newdir)
 
 
-#
-# Make the output directory 
-#
-
-_mkdir(dirname, dirname+'/tmp')
-
-
-# Check to make sure the sequence identity cutoff and length difference requirement values
-# are within acceptable ranges
-
-try:
-    cutoff_test = float(cutoff_input)
-    if (cutoff_test > 1.0 or cutoff_test < 0.85):
-        print "Please input a cutoff value between 0.85 and 1.0"
-        sys.exit(2)
-    else:
-        cutoff = cutoff_test
-
-except ValueError:
-    print "Please input a cutoff value between 0.85 and 1.0"
-    sys.exit(2)
- 
-
-try:
-    length_test = float(length_input)
-    if (length_test > 1.0):
-        print "Please input a length requirement value between 0 and 1.0"
-        sys.exit(2)
-    else:
-        length = length_test
-except ValueError:
-    print "Please input a length requirement value between 0 and 1.0"
-    sys.exit(2)
-
-
-# Check to make sure the input file exists and can be opened
-
-try:
-   fasta_file = open(filename)
-except:
-   print "This file could not be opened"
-   sys.exit(2)
-
-
-# Check to make sure the input file is in FASTA format
-
-try:
-   fasta_data = fasta.load(fasta_file)
-except:
-   print 'This file does not seem to be a fasta file.  Please try again with a fasta file'
-   sys.exit(0)
+def _write_reads(records, f, index=None):
+   """
+   Writes (name, sequence) records to the file object f as FASTA, and
+   returns the number written.  Each record is also added to 'index', a
+   fasta.new_index(), if given.
+   """
+   num_reads = 0
+   offset = 0
+   for (name, sequence) in records:
+      f.write('>%s\n%s\n' % (name, sequence))
+      num_reads = num_reads + 1
+      if index is not None:
+         fasta.index_record(index, name, offset + len(name) + 2, len(sequence))
+         offset = offset + len(name) + len(sequence) + 3
+   return num_reads
+
+
+def dereplicate(filename, cutoff, length, bp_test, dirname, engine='cdhit',
+                shard_prefix=0, shards=0, processes=1, collapse=False,
+                cache_dir=None, compress=False, low_memory=False, memory_budget=0,
+                packed=False, profile=False, threads=None, memory=None, plan=True,
+                out=sys.stdout):
+   """
+   Runs the whole replicate filter on one FASTA file, writing the results to
+   the new directory dirname and progress messages to 'out'.  The keyword
+   arguments are the command line options.  Returns the
+   extract_clusters.Extraction.  Raises DereplicationError if it fails, or
+   OutputExistsError, without touching it, if dirname already exists.
+
+   Once the directory is made, the run always ends by writing
+   dirname/completion.json (see extract_clusters.write_manifest), with the
+   parameters, output files, counts and timings, or the error.  The time,
+   CPU, peak memory and items of each stage are kept in
+   dirname/tmp/profile.json as it runs (see profiling.py); with 'profile'
+   the Python stages are also profiled with cProfile into
+   dirname/tmp/profile/.
+
+   With 'plan', cd-hit's threads, memory limit and word size are chosen
+   for the reads counted as the input is rewritten for cd-hit, and for the
+   cores and memory available (or 'threads' and 'memory' MB), and the run
+   is sharded, or its clusters extracted in low-memory or external mode,
+   if it wouldn't fit otherwise (see cdhit_plan.py).  The plan's estimates are kept in dirname/tmp/plan.json,
+   and next to the memory measured in the manifest once the run ends.
+   """
+
+   # Make the output directory
+
+   _mkdir(dirname, dirname+'/tmp')
+
+   manifest = dirname+'/'+manifest_name
+   details = {
+      'input': filename,
+      'output_directory': dirname,
+      'parameters': {
+         'cutoff': cutoff,
+         'length': length,
+         'bp': bp_test,
+         'engine': engine,
+         'shard_prefix': min(shard_prefix, bp_test),
+         'shards': shards,
+         'collapse': collapse,
+         'compress': compress,
+         'low_memory': low_memory,
+         'memory_budget': memory_budget,
+         'packed': packed,
+      },
+   }
+   start = time.time()
+   stages = profiling.Profile(dirname+'/tmp/profile.json', profile and dirname+'/tmp/profile' or None)
+   planner = None
+
+   if plan and engine == 'cdhit':
+      planner = _Planner(cutoff, bp_test, dirname, details['parameters'], processes, threads, memory)
+   if processes is None:
+      processes = resources.available_cores()
+   elif planner is not None:
+      processes = min(processes, resources.available_cores())
 
+   try:
+      (result, outputs, timings) = _dereplicate(filename, cutoff, length, bp_test, dirname, engine,
+                                                shard_prefix, shards, processes, collapse,
+                                                cache_dir, compress, low_memory, memory_budget, packed,
+                                                planner, stages, out)
+   except Exception, e:
+      # Anything that goes wrong still ends the run, so waiters don't hang
+      error = str(e).strip()
+      if not isinstance(e, DereplicationError):
+         error = '%s: %s' % (e.__class__.__name__, error)
+      if planner is not None and planner.plan is not None:
+         details['plan'] = _log_plan(dirname, planner.plan, stages)
+      extract_clusters.write_manifest(manifest, 'failed', error=error,
+                                      timings={'total': time.time() - start}, **details)
+      raise
+
+   if planner is not None and planner.plan is not None:
+      details['plan'] = _log_plan(dirname, planner.plan, stages)
+      print >>out, cdhit_plan.log_report(details['plan'])
+      print >>out
+
+   timings['total'] = time.time() - start
+   extract_clusters.write_manifest(manifest, 'complete', result, outputs, timings=timings, **details)
+
+   return result
+
+
+class _Planner(object):
+   """
+   Plans the cd-hit run (see cdhit_plan.py) once _dereplicate() has counted
+   the reads, keeping the options that were given, and updates the
+   manifest's 'parameters' to what the plan chose.  'plan' is the
+   cdhit_plan.Plan once it is made.
+   """
+
+   def __init__(self, cutoff, bp_test, dirname, parameters, processes, threads, memory):
+      self.cutoff = cutoff
+      self.bp_test = bp_test
+      self.dirname = dirname
+      self.parameters = parameters
+      self.processes = processes
+      self.threads = threads
+      self.memory = memory
+      self.plan = None
+
+   def extraction(self):
+      # The extraction mode the options ask for, if any
+      if self.parameters['memory_budget']:
+         return 'external'
+      elif self.parameters['low_memory']:
+         return 'low_memory'
+      elif self.parameters['packed']:
+         return 'packed'
+      return None
+
+   def __call__(self, reads, bases, out):
+      # Pool workers (batch_replicates.py) can't start the pool a sharded
+      # run needs.
+      parameters = self.parameters
+      cdhit = cdhit_plan.plan(reads, bases, self.cutoff, self.bp_test, memory_mb=self.memory, threads=self.threads,
+                              shard_prefix=parameters['shard_prefix'], shards=parameters['shards'],
+                              processes=self.processes, extraction=self.extraction(),
+                              memory_budget=parameters['memory_budget'], collapse=parameters['collapse'],
+                              can_shard=not multiprocessing.current_process().daemon)
+      self.plan = cdhit
+
+      if cdhit.shard_prefix:
+         parameters.update(shard_prefix=cdhit.shard_prefix, shards=cdhit.shards)
+      parameters.update(low_memory=cdhit.extraction == 'low_memory', memory_budget=cdhit.memory_budget)
+      atomic.write_json(self.dirname+'/tmp/plan.json', cdhit.record())
+      print >>out, cdhit.report()
+      print >>out
+
+      return cdhit
+
+
+def _log_plan(dirname, cdhit, profile):
+   # The plan's estimates next to the memory the run measured
+   record = cdhit_plan.log_record(cdhit, profile.record())
+   atomic.write_json(dirname+'/tmp/plan.json', record)
+   return record
+
+
+def _dereplicate(filename, cutoff, length, bp_test, dirname, engine, shard_prefix,
+                 shards, processes, collapse, cache_dir, compress, low_memory, memory_budget, packed,
+                 planner, profile, out):
+
+   # Reads are only sharded on a prefix no longer than the initial base pair
+   # requirement, so reads that could be replicates of each other always go to
+   # the same shard.
+
+   shard_prefix = min(shard_prefix, bp_test)
+   num_shards = shards or processes
+
+   # Check to make sure the input file exists and can be opened
 
-# Write out the FASTA input file to a new file, because CD-HIT doesn't handle
-# all input file types correctly
+   try:
+      fasta_file = fasta.open_fasta(filename)
+   except IOError:
+      raise DereplicationError("This file could not be opened")
 
+   # Write out the FASTA input file to a new file, because CD-HIT doesn't handle
+   # all input file types correctly (or compressed input at all).  The input is
+   # streamed record by record, so it is never held in memory.  In sharded mode the reads are written straight
+   # into the shard files instead, and the native engine clusters them directly.
 
-new_fasta_file = dirname+'/tmp/input_fasta_file.fa'
+   new_fasta_file = dirname+'/tmp/input_fasta_file.fa'
 
-try: 
-   input_fasta_file = open(new_fasta_file, 'wt')
-except:
-   print 'Cannot open', new_fasta_file, 'for writing a temporary fasta file'
-   sys.exit(2)
+   # Byte-identical reads can optionally be collapsed to a single carrier read here,
+   # so only distinct sequences go to cd-hit.
 
-for i in fasta_data:
-   input_fasta_file.write('>%s\n%s\n' % (i, fasta_data[i]))
+   records = fasta.iterload(fasta_file)
 
-input_fasta_file.close()
+   # The reads and bases are counted for the planner as they are read, and
+   # unless they are collapsed or sharded the rewritten file is indexed as it
+   # is written, so neither file has to be read again to plan the run or to
+   # extract the clusters from it.
 
+   counts = cdhit_plan.InputCounts()
+   records = counts.counted(records)
 
-# The output file from cd-hit is written to a tmp directory for this session
+   index = None
+   if engine == 'cdhit' and not (collapse or shard_prefix or low_memory or memory_budget or packed):
+      index = fasta.new_index()
 
-cdhit_command = '%s/cd-hit-est -i %s/tmp/input_fasta_file.fa -o %s/tmp/cdhit_output_temp -c %s -n 8 -s %s -d 0 -M 1000' % (batch_replicates_config.cdhit_dir, dirname, dirname, cutoff, length)
+   if collapse:
+      collapser = duplicates.DuplicateCollapser()
+      records = collapser.collapse(records)
 
+   # cd-hit results are cached on the reads as they are written for cd-hit (after
+   # any collapsing) plus everything that changes cd-hit's output.  The native
+   # engine clusters the reads as they stream in, so it isn't cached.
 
-# Run CD-HIT
-prog = subprocess.Popen(cdhit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+   cache = None
 
-(stdout, stderr) = prog.communicate()
+   if cache_dir and engine == 'cdhit':
+      cache = cdhit_cache.CdhitCache(cache_dir, batch_replicates_config.cdhit_cache_size)
+      input_digest = hashlib.sha1()
+      records = cdhit_cache.hashed(records, input_digest)
 
-if (prog.returncode != 0):
-   print 'cd-hit failed'
-   print stderr
-   sys.exit(2)
+   # The cluster output (from cd-hit or the native engine) is written to a tmp
+   # directory for this session.  cd-hit output and errors are also written to the
+   # tmp directory.
 
+   cdhit_output = dirname+'/tmp/cdhit_output_temp'
 
-# Output cd-hit output and errors to a tmp directory
+   cdhit_start = time.time()
 
-fp = open(dirname+'/tmp/cd-hit.out', 'w')
-fp.write(stdout)
-fp.close()
+   # Check to make sure the input file is in FASTA format
 
-fp = open(dirname+'/tmp/cd-hit.err', 'w')
-fp.write(stderr)
-fp.close()
+   try:
+      if engine == 'native':
+         profile.run('native', native_replicates.cluster, records, cdhit_output, cutoff, length, bp_test)
+      elif shard_prefix:
+         (shard_files, num_reads) = profile.run('rewrite', cdhit_run.write_shards, records, dirname+'/tmp', shard_prefix, num_shards)
+         profile.count(num_reads)
+      else:
+         try:
+            input_fasta_file = open(new_fasta_file, 'wt')
+         except IOError:
+            raise DereplicationError('Cannot open %s for writing a temporary fasta file' % (new_fasta_file,))
+
+         num_reads = profile.run('rewrite', _write_reads, records, input_fasta_file, index)
+         profile.count(num_reads)
+
+         input_fasta_file.close()
+   except ValueError:
+      raise DereplicationError('This file does not seem to be a fasta file.  Please try again with a fasta file', 0)
+   finally:
+      fasta_file.close()
+
+   # Plan cd-hit on the reads counted.  cdhit_options are its word size,
+   # memory limit and threads (a shard's cd-hit has one thread).  If the plan
+   # shards the run, the rewritten file is split into shards once it is
+   # known that cd-hit has to run.
+
+   cdhit_options = (8, 1000, 1)
+
+   if planner is not None:
+      cdhit = planner(counts.reads, counts.bases, out)
+      cdhit_options = (cdhit.word_size, cdhit.cdhit_memory, cdhit.threads)
+      if cdhit.shard_prefix and not shard_prefix:
+         (shard_prefix, num_shards, shard_files) = (cdhit.shard_prefix, cdhit.shards, None)
+      if cdhit.shard_prefix:
+         processes = cdhit.processes
+      low_memory = cdhit.extraction == 'low_memory'
+      memory_budget = cdhit.memory_budget
+      if low_memory or memory_budget or packed:
+         index = None
+
+   # Run CD-HIT, unless the cache already has its output
+
+   cached_seconds = None
+
+   if cache:
+      cache_params = [cdhit_run.cdhit_command('', '', cutoff, length, cdhit_options[0])]
+      if shard_prefix:
+         cache_params.extend(['sharded', shard_prefix, num_shards])
+      key = cdhit_cache.cache_key(input_digest, cache_params)
+      cached_seconds = cache.fetch(key, cdhit_output)
+
+   # While cd-hit runs, how far it has got is kept in progress.json in the
+   # output directory (see cdhit_run.Progress).
+
+   if engine == 'native' or cached_seconds is not None:
+      returncode = 0
+   elif shard_prefix:
+      if shard_files is None:
+         input_fasta_file = open(new_fasta_file)
+         try:
+            (shard_files, num_reads) = profile.run('shard', cdhit_run.write_shards, fasta.iterload(input_fasta_file),
+                                                   dirname+'/tmp', shard_prefix, num_shards)
+         finally:
+            input_fasta_file.close()
+         profile.count(num_reads)
+      progress = cdhit_run.Progress(dirname+'/progress.json', num_reads)
+      (returncode, stderr) = profile.run_child('cdhit', cdhit_run.run_sharded, shard_files, cdhit_output, cutoff, length, processes, progress,
+                                                 cdhit_options[0], cdhit_options[1])
+      profile.count(num_reads)
+   else:
+      progress = cdhit_run.Progress(dirname+'/progress.json', num_reads)
+      (returncode, stderr) = profile.run_child('cdhit', cdhit_run.run_cdhit, new_fasta_file, cdhit_output, cutoff, length, dirname+'/tmp/cd-hit', progress,
+                                                 *cdhit_options)
+      profile.count(num_reads)
+
+   if (returncode != 0):
+      raise DereplicationError('cd-hit failed\n%s' % (stderr,))
+
+   cdhit_time = time.time() - cdhit_start
+
+   if cache:
+      evicted = []
+      if cached_seconds is None:
+         evicted = cache.store(key, cdhit_output, cdhit_time)
+      cdhit_cache.log(dirname+'/tmp/cache.txt', key, cached_seconds, cdhit_time, evicted)
+
+   # Record how much work collapsing saved.  This is not measured (that would
+   # mean running cd-hit twice): cd-hit time grows at least linearly with the
+   # number of sequences, so the saving is estimated, as a lower bound, as the
+   # time per distinct sequence times the number of reads that were collapsed.
+
+   duplicate_reads = None
+
+   if collapse:
+      collapser.write(dirname+'/tmp/duplicates.txt')
+      duplicate_reads = collapser.duplicates()
+
+      collapse_report = 'Collapsed %d exact duplicate reads: cd-hit ran on %d of %d reads in %.1f s, saving an estimated %.1f s (not measured)\n' % (
+         collapser.collapsed(), collapser.distinct, collapser.reads, cdhit_time,
+         cdhit_time * collapser.collapsed() / max(collapser.distinct, 1))
+
+      fp = open(dirname+'/tmp/collapse.txt', 'w')
+      fp.write(collapse_report)
+      fp.close()
+
+      print >>out, collapse_report
+
+   extract_start = time.time()
+
+   # Evaluate CD-HIT files.  This runs extract_clusters in-process (the same code
+   # as extract-clusters-html.py) on an index of the input file, so the reads
+   # are not parsed again by a second interpreter.  In low-memory mode only the
+   # lengths and initial base pairs of the reads are kept, and the sequences are
+   # streamed from the input file again when the output is written.  With a
+   # memory budget the whole extraction, output files included, runs through
+   # sorted files in the tmp directory.  Packed reads are parsed in byte ranges
+   # of the input file, in 'processes' processes.  The rewritten file stands in
+   # for the input file if it was indexed as it was written.
 
+   try:
+      cluster_file = open(cdhit_output+'.clstr')
+      try:
+         if memory_budget:
+            (result, outputs) = profile.run('extract_external', extract_clusters.extract_external,
+                                            cluster_file, filename, bp_test,
+                                            dirname+'/extracted_clusters', filename, filename,
+                                            duplicate_reads, memory_budget << 20, dirname+'/tmp',
+                                            compress, processes)
+            profile.count(int(result.num_seq))
+         else:
+            if low_memory:
+               reads = profile.run('load', extract_clusters.scan_reads, filename, bp_test)
+            elif index is not None and num_reads:
+               reads = fasta.FastaIndex(new_fasta_file, index=index)
+            else:
+               reads = profile.run('load', extract_clusters.load_reads, filename, packed, processes)
+            profile.count(len(reads))
+            result = extract_clusters.extract(cluster_file, reads, bp_test, duplicate_reads, profile)
+      finally:
+         cluster_file.close()
+   except IOError, e:
+      raise DereplicationError('Cannot open %s' % (e.filename,))
+   except KeyError, e:
+      raise DereplicationError('\n%s is in the cd-hit output but not in %s\n' % (e.args[0], filename))
+   except ValueError, e:
+      raise DereplicationError(str(e))
+
+   print >>out, extract_clusters.report(result, 'text')
+   print >>out
+
+   if not memory_budget:
+      try:
+         outputs = profile.run('write', extract_clusters.write_outputs, result, dirname+'/extracted_clusters',
+                               filename, filename, compress, processes)
+         profile.count(len(result.cluster_set))
+      except IOError, e:
+         raise DereplicationError("There was a problem with the analysis.  Cannot write %s\n." % (e.filename,))
+      except ValueError, e:
+         raise DereplicationError(str(e))
+
+   timings = {
+      'cdhit': cdhit_time,
+      'cdhit_cached': cached_seconds is not None,
+      'extract': time.time() - extract_start,
+   }
+
+   return result, outputs, timings
+
+
+def main():
+   parser = OptionParser(usage=usage)
+   parser.add_option("--engine", dest="engine", type="choice", choices=["cdhit", "native"], default="cdhit",
+                     help="Replicate detection engine: 'cdhit' (the default) runs cd-hit-est, 'native' clusters the reads in-process without cd-hit.  The native engine ignores the sharding options.")
+   parser.add_option("--shard-prefix", dest="shard_prefix", type="int", default=0,
+                     help="Split the reads into shards by their first SHARD_PREFIX bases and run cd-hit on the shards in parallel.  Capped at the initial base pair requirement.  0 (the default) runs a single cd-hit.")
+   parser.add_option("--shards", dest="shards", type="int", default=0,
+                     help="Number of shard files to bucket the prefixes into (default: one per process)")
+   parser.add_option("--processes", dest="processes", type="int", default=None,
+                     help="Number of cd-hit processes to run at once in sharded mode (default: number of cores, or the slots granted by the grid engine)")
+   parser.add_option("--collapse-duplicates", dest="collapse", action="store_true", default=False,
+                     help="Send only one copy of each exact duplicate read to cd-hit, and put the copies back into its cluster afterwards")
+   parser.add_option("--cache-dir", dest="cache_dir", default=batch_replicates_config.cdhit_cache_dir,
+                     help="Directory to cache cd-hit results in, so reruns on the same reads and parameters skip cd-hit (default from batch_replicates_config.py)")
+   parser.add_option("--no-cache", dest="cache_dir", action="store_const", const=None,
+                     help="Always run cd-hit, even if a cache directory is configured")
+   parser.add_option("--compress-output", dest="compress", action="store_true", default=False,
+                     help="Write the output files gzip (BGZF) compressed, compressing on PROCESSES threads")
+   parser.add_option("--low-memory", dest="low_memory", action="store_true", default=False,
+                     help="Keep only the length and initial base pairs of each read in memory while extracting the clusters, and stream the sequences from the input file again to write the output (for very large runs)")
+   parser.add_option("--packed", dest="packed", action="store_true", default=False,
+                     help="Load the reads into memory packed 2 bits per base for extracting the clusters, parsing the input file in PROCESSES processes, rather than reading them from the input file as they are needed")
+   parser.add_option("--memory-budget", dest="memory_budget", type="int", default=0,
+                     help="Extract the clusters through sorted files in the tmp directory, using about MEMORY_BUDGET MB of memory (for runs too large for --low-memory)")
+   parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                     help="Also profile the Python stages with cProfile, into tmp/profile/ (the time and memory of each stage are always kept in tmp/profile.json)")
+   parser.add_option("--threads", dest="threads", type="int", default=0,
+                     help="Number of threads for cd-hit (default: planned from the reads, up to the cores available)")
+   parser.add_option("--memory", dest="memory", type="int", default=0,
+                     help="Memory in MB to plan the run within (default: the memory available).  The run is sharded, or extracted in low-memory or external mode, if it would not fit otherwise")
+   parser.add_option("--no-plan", dest="plan", action="store_false", default=True,
+                     help="Run cd-hit as '-n 8 -M 1000' on one thread, with only the sharding and extraction options given, rather than planning the run (see cdhit_plan.py)")
+
+   (options, args) = parser.parse_args()
+
+   if (len(args) != 5):
+
+      print usage
+      sys.exit(1)
+
+
+   filename = args[0]
+   cutoff_input = args[1]
+   length_input = args[2]
+   bp_input = args[3]
+   dirname = args[4]
+
+   filename_check = filename.split(" ")
+   if len(filename_check) > 1:
+      print '\nThe input filename should not contain spaces.  Please rename it, and try again.\n'
+      sys.exit(2)
 
 
-# Evaluate CD-HIT files
-prog2 = subprocess.Popen('Modules/tools/extract-clusters-html.py %s/tmp/cdhit_output_temp.clstr  %s %s/extracted_clusters %s text -i "%s"' % (dirname, filename, dirname, bp_input, filename), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+   # Check to make sure the sequence identity cutoff and length difference requirement values
+   # are within acceptable ranges
 
-(stdout, stderr) = prog2.communicate()
+   try:
+      cutoff_test = float(cutoff_input)
+      if (cutoff_test > 1.0 or cutoff_test < 0.85):
+         print "Please input a cutoff value between 0.85 and 1.0"
+         sys.exit(2)
+      else:
+         cutoff = cutoff_test
+
+   except ValueError:
+      print "Please input a cutoff value between 0.85 and 1.0"
+      sys.exit(2)
 
-if (prog2.returncode != 0):
-   print 'extract-clusters-html.py failed'
-   print stderr
-   sys.exit(2)
 
-#print './extract-clusters-html.py %s/tmp/cdhit_output_temp.clstr  %s %s/extracted_clus\
-#ters %s text -i "%s"' % (dirname, filename, dirname, bp_input, filename)
+   try:
+      length_test = float(length_input)
+      if (length_test > 1.0):
+         print "Please input a length requirement value between 0 and 1.0"
+         sys.exit(2)
+      else:
+         length = length_test
+   except ValueError:
+      print "Please input a length requirement value between 0 and 1.0"
+      sys.exit(2)
 
 
-print stdout
+   try:
+      bp_test = int(bp_input)
+      if (bp_test < 0):
+         print "Please input an initial base pair requirement of 0 or more"
+         sys.exit(2)
+   except ValueError:
+      print "Please input an initial base pair requirement of 0 or more"
+      sys.exit(2)
 
-fp = open(dirname+'/tmp/extract.err', 'w')
-fp.write(stderr)
-fp.close()
 
-if stderr:
-   print "There was a problem with the analysis.  Check %s/tmp/extract.err for details\n." % (dirname)
+   try:
+      dereplicate(filename, cutoff, length, bp_test, dirname, engine=options.engine,
+                  shard_prefix=options.shard_prefix, shards=options.shards,
+                  processes=options.processes, collapse=options.collapse,
+                  cache_dir=options.cache_dir, compress=options.compress,
+                  low_memory=options.low_memory, memory_budget=options.memory_budget,
+                  packed=options.packed, profile=options.profile,
+                  threads=options.threads or None, memory=options.memory or None, plan=options.plan)
+   except DereplicationError, e:
+      print e
+      sys.exit(e.exit_code)
 
-else:
    print "Your results are in the directory: %s\n" % (dirname)
    print "See the README file for more information on the output files.\n"
 
 
-
-
+if __name__ == '__main__':
+   main()
@@ -8,9 +8,14 @@
 # Version: "2009-0611", current as of 2011/08/24
 # - semenko
 
-import string, re, sys, cStringIO
+import string, re, sys, os, mmap
+import multiprocessing
 from array import array
 
+import bgzf
+import resources
+import read_ids
+
 __printdebug__ = 0
 
 legal_dna = "ACGTNX-"
@@ -18,6 +23,106 @@ legal_protein = "ABCDEFGHIKLMNPQRSTUVWXYZ-"
 
 complementTranslation = string.maketrans('ACTG', 'TGAC')
 
+#
+# open_fasta
+#
+
+def open_fasta(filename):
+    """
+    Opens a FASTA file for reading.  gzip and BGZF files are recognized by
+    their contents (not their name) and decompressed as they are read.
+    """
+    f = open(filename, 'rb')
+    if f.read(2) == bgzf.gzip_magic:
+        f.seek(0)
+        return bgzf.GzipReader(f)
+    f.seek(0)
+    return f
+
+#
+# iterload
+#
+
+def iterload(f, strict=0, blocksize=1 << 20):
+    """
+    Reads sequences in FASTA format from the given file object, yielding
+    (name, sequence) tuples one record at a time.
+
+    The file is read in blocks of 'blocksize' bytes, so memory use is
+    bounded by the longest record rather than the size of the file.  Mac
+    EOL characters (^M) are translated block by block.  Sequences are
+    upper-cased and stripped of whitespace, exactly as load() does.
+
+    The 'strict' option has the same meaning as for load().
+    """
+    macEOL = '%c' % (13,)
+
+    name = None
+    chunks = []
+    tail = ''
+
+    while 1:
+        block = f.read(blocksize)
+        if block:
+            if macEOL in block:
+                block = block.replace(macEOL, '\n')
+            lines = (tail + block).split('\n')
+            tail = lines.pop()
+        elif tail:
+            lines = [tail]
+            tail = ''
+        else:
+            break
+
+        for i in xrange(len(lines)):
+            l = lines[i]
+            if l[:1] == '>':
+                if name is not None:
+                    record = _make_record(name, chunks, strict)
+                    if record:
+                        yield record
+                name = l[1:].rstrip()
+                chunks = []
+            elif name is not None:
+                chunks.append(l)
+            elif strict:
+                raise ValueError("""
+
+ERROR!  This doesn't look like a fasta file...
+
+The first several lines are:
+--------------------
+%s
+...
+--------------------
+</pre>
+
+""" % ('\n'.join(lines[i:i + 5]),))
+            # else: non-FASTA gobbledygook at the top, ignore it
+
+    if name is None:
+        raise ValueError("Error! no beginning '>'")
+
+    record = _make_record(name, chunks, strict)
+    if record:
+        yield record
+# end iterload
+
+def _make_record(name, chunks, strict):
+    """
+    Builds a (name, sequence) tuple from the raw sequence lines of one
+    record, or returns None if the record is empty.
+    """
+    sequence = ''.join(''.join(chunks).upper().split())
+
+    if not (len(name) and len(sequence)):
+        return None
+
+    if strict and not (is_protein(sequence) or is_dna(sequence)):
+        raise ValueError("Error, sequence contains illegal characters.")
+
+    return name, sequence
+
 #
 # load
 #
@@ -30,92 +135,695 @@ def load(f, strict=0):
     The 'strict' option forces the file to be in a stricter FASTA format,
     i.e. it must contain ONLY sequences, and they must be ONLY
     DNA or Protein sequences.
+
+    This is a thin wrapper around iterload(); use that directly to avoid
+    holding the whole file in memory.
     """
-    d= {}
+    d = {}
+    for name, sequence in iterload(f, strict):
+        d[name] = sequence
 
-    # read name
-    l = f.readline()
+    return d
+# end load
 
-    # check for Mac EOL characters.  Note that this assumes that the first
-    # line we're getting is representative of the file, which will usually
-    # be the case, because 'readline' seems to pay attention to platform-
-    # specific EOLs.
-    #
-    # If we do find a Mac EOL (^M, character # 13) then reconstruct the
-    # file into a cStringIO object.  Unless people are dealing with > 20 MB
-    # of sequence, that should work fine ;).
-    #
-    macEOL = '%c' % (13,)
-    if macEOL in l:
-        l = l + f.read()                # get all of the file
-        
-        l = l.replace(macEOL, "\n")     # replace EOL characters with \n
-        
-        f = cStringIO.StringIO(l)       # replace file with StringIO
+#
+# SequenceStore
+#
 
-    #
-    # Read through the file and pick out the good lines.  Ignore
-    # non-FASTA gobbledygook at the top.
-    #
+class SequenceStore(object):
+    """
+    In-memory read store.  Reads are interned in a read_ids.ReadIds table
+    ('ids') and addressed by integer ID:
+
+      sequence(i)       the sequence of read i
+      length(i)         its length
+      prefix(i, n)      its first n bases
+      prefix_key(i, n)  a key that is equal for two reads exactly when their
+                        first n bases are, for grouping reads by prefix
+
+    store[name] also works, for code that still looks reads up by name.
+    FastaIndex provides the same interface for reads kept on disk, and
+    PackedReadStore for reads packed 2 bits per base.
+    """
+
+    def __init__(self):
+        self.ids = read_ids.ReadIds()
+        self.sequences = []
+
+    def add(self, name, sequence):
+        """
+        Adds a read, replacing any earlier read with the same name.
+        Returns its ID.
+        """
+        i = self.ids.intern(name)
+        if i == len(self.sequences):
+            self.sequences.append(sequence)
+        else:
+            self.sequences[i] = sequence
+        return i
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __getitem__(self, name):
+        return self.sequences[self.ids[name]]
+
+    def sequence(self, i):
+        return self.sequences[i]
+
+    def length(self, i):
+        return len(self.sequences[i])
+
+    def prefix(self, i, n):
+        return self.sequences[i][0:n]
+
+    prefix_key = prefix
+# end SequenceStore
+
+def load_store(f, strict=0):
+    """
+    Loads sequences in FASTA format from the given file object into a
+    SequenceStore, keyed (like cd-hit) on the header up to the first space.
+    """
+    store = SequenceStore()
+    for name, sequence in iterload(f, strict):
+        store.add(name.split(' ')[0], sequence)
+    return store
+
+#
+# FASTA offset index
+#
+# An index maps each read ID (the header up to the first space, which is also
+# the name cd-hit reports) to where its sequence lives in the file, in the
+# same spirit as a samtools .fai file.  Each line holds:
+#
+#   name  length  offset  linebases  linewidth  span
+#
+# 'length' is the number of bases, 'offset' the byte offset of the first
+# base, 'linebases'/'linewidth' the bases and bytes per full sequence line
+# (0 if the record's lines are ragged) and 'span' the number of bytes from
+# 'offset' to the end of the last sequence line.  The first line records the
+# size and mtime of the FASTA file, so a stale index is detected and rebuilt.
+#
+# In memory the columns are kept as parallel array('l')s indexed by read ID.
+#
 
-    if not strict:
-        while l and l[0] != '>':
-            l = f.readline()
+index_suffix = '.fxi'
+index_magic = '#fxi'
+index_columns = 5
+
+def _new_columns():
+    return tuple([array('l') for x in range(index_columns)])
+
+def build_index(f):
+    """
+    Scans an open FASTA file object and returns (ids, columns): a
+    read_ids.ReadIds table and the five index columns (length, offset,
+    linebases, linewidth, span) as arrays indexed by read ID.
+
+    Like load(), junk before the first '>' is ignored, empty records are
+    skipped and a later record replaces an earlier one with the same ID.
+    """
+    ids = read_ids.ReadIds()
+    columns = _new_columns()
+
+    pos = 0
+    name = None
+
+    for l in f:
+        if '\r' in l.rstrip('\r\n'):
+            raise ValueError("Cannot index a FASTA file with Mac EOL characters")
+
+        if l[:1] == '>':
+            if name is not None:
+                _index_record(ids, columns, name, offset, lines, pos)
+            name = l[1:].rstrip().split(' ')[0]
+            offset = pos + len(l)
+            lines = []
+        elif name is not None:
+            bases = l.strip()
+            if ' ' in bases or '\t' in bases:
+                # Whitespace inside a line; count it out and mark the
+                # record as ragged.
+                lines.append((len(''.join(bases.split())), -1))
+            else:
+                lines.append((len(bases), len(l)))
+        pos = pos + len(l)
+
+    if name is None:
+        raise ValueError("Error! no beginning '>'")
+
+    _index_record(ids, columns, name, offset, lines, pos)
+
+    return ids, columns
+# end build_index
+
+def _index_record(ids, columns, name, offset, lines, end):
+    """
+    Adds one record to the index, given the (bases, bytes) of each of its
+    sequence lines.
+    """
+    length = 0
+    for (bases, width) in lines:
+        length = length + bases
+
+    if not (len(name) and length):
+        return
+
+    # Trailing blank lines belong to the record but hold no sequence.
+    while not lines[-1][0]:
+        end = end - lines.pop()[1]
+
+    linebases, linewidth = lines[0]
+    for (bases, width) in lines[1:-1]:
+        if bases != linebases or width != linewidth:
+            linebases, linewidth = 0, 0
+            break
+    else:
+        if len(lines) > 1 and lines[-1][0] > linebases:
+            linebases, linewidth = 0, 0
+
+    if linewidth < 0 or lines[-1][1] < 0:
+        linebases, linewidth = 0, 0
+
+    _set_row(ids, columns, name, (length, offset, linebases, linewidth, end - offset))
+
+def new_index():
+    """
+    An empty (ids, columns) index, for index_record().
+    """
+    return read_ids.ReadIds(), _new_columns()
 
-    if not l:
-        raise "Error! no beginning '>'" 
+def index_record(index, name, offset, length):
+    """
+    Adds a record that was written with its sequence of 'length' bases on
+    one line starting at byte 'offset' to an (ids, columns) index, as
+    build_index() would have indexed it.  For indexing a FASTA file as it
+    is written, without scanning it again.
+    """
+    _set_row(index[0], index[1], name.split(' ')[0], (length, offset, length, length + 1, length + 1))
+
+def _set_row(ids, columns, name, row):
+    i = ids.intern(name)
+    if i == len(columns[0]):
+        for c in range(index_columns):
+            columns[c].append(row[c])
+    else:
+        for c in range(index_columns):
+            columns[c][i] = row[c]
+
+def write_index(ids, columns, path, size, mtime):
+    """
+    Writes an index to 'path', stamped with the size and mtime of the
+    FASTA file it describes.
+    """
+    out = open(path, 'w')
+    out.write('%s\t%d\t%d\n' % (index_magic, size, mtime))
+    for i in xrange(len(columns[0])):
+        out.write('%s\t%d\t%d\t%d\t%d\t%d\n' % ((ids.names[i],) + tuple([c[i] for c in columns])))
+    out.close()
 
+def read_index(path, size, mtime):
+    """
+    Reads an index written by write_index() and returns (ids, columns).
+    Returns None if the index is missing, unreadable or does not match the
+    given FASTA size and mtime.
+    """
     try:
-        assert(l[0] == '>')
-    except:
-        errorMsg = """
+        f = open(path)
+    except IOError:
+        return None
 
-ERROR!  This doesn't look like a fasta file...
+    header = f.readline().rstrip('\n').split('\t')
+    if header != [index_magic, str(size), str(mtime)]:
+        f.close()
+        return None
 
-The first several lines are:
---------------------
-%s%s%s%s%s
-...
---------------------
-</pre>
+    ids = read_ids.ReadIds()
+    columns = _new_columns()
+
+    for l in f:
+        fields = l.rstrip('\n').split('\t')
+        _set_row(ids, columns, fields[0], [int(x) for x in fields[1:]])
+    f.close()
+
+    return ids, columns
+
+class FastaIndex(object):
+    """
+    Read-only access to the sequences of a FASTA file through an on-disk
+    offset index and an mmap of the file.  It has the same interface as
+    SequenceStore: reads are addressed by the integer IDs in 'ids', and
+    sequence(i), length(i) and prefix(i, n) return the upper-cased
+    sequence, its length and its first n bases.  prefix() reads only the
+    bytes it needs.  fasta_index[name] also works.
+
+    Only the index is held in memory.  It is stored as <fasta file>.fxi and
+    reused as long as the FASTA file's size and mtime still match; otherwise
+    it is rebuilt.  If it can't be written next to the FASTA file, it is
+    simply kept in memory.  An (ids, columns) 'index' the caller already
+    has (see index_record()) is used as it is, and not stored.
+    """
 
-""" % (l, f.readline(), f.readline(), f.readline(), f.readline())
-        raise errorMsg
+    def __init__(self, filename, index_filename=None, index=None):
+        self.filename = filename
+        if index_filename is None:
+            index_filename = filename + index_suffix
+        self.index_filename = index_filename
+
+        if bgzf.is_gzip(filename):
+            raise ValueError('%s is compressed and cannot be indexed' % (filename,))
+
+        st = os.stat(filename)
+        size, mtime = st.st_size, int(st.st_mtime)
+
+        if index is None:
+            index = read_index(index_filename, size, mtime)
+        if index is None:
+            f = open(filename, 'rb')
+            try:
+                index = build_index(f)
+            finally:
+                f.close()
+            try:
+                write_index(index[0], index[1], index_filename, size, mtime)
+            except IOError:
+                pass
+        self.ids = index[0]
+        (self.lengths, self.offsets, self.linebases,
+         self.linewidths, self.spans) = index[1]
+
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __getitem__(self, name):
+        return self.sequence(self.ids[name])
+
+    def sequence(self, i):
+        offset = self.offsets[i]
+        raw = self._map[offset:offset + self.spans[i]]
+        return ''.join(raw.split()).upper()
+
+    def length(self, i):
+        return self.lengths[i]
+
+    def prefix(self, i, n):
+        """
+        Returns the first n bases of read i, reading only as many bytes of
+        the file as are needed.
+        """
+        offset, span, linebases = self.offsets[i], self.spans[i], self.linebases[i]
+        if linebases:
+            nbytes = min(span, n + (n // linebases) * (self.linewidths[i] - linebases) + self.linewidths[i])
+        else:
+            nbytes = span
+        raw = self._map[offset:offset + nbytes]
+        return ''.join(raw.split()).upper()[:n]
+
+    prefix_key = prefix
+# end FastaIndex
 
-    nextName = l
-    sequence = ""
+#
+# PrefixStore
+#
 
-    while nextName:
-        name = string.rstrip(nextName[1:])
-        while 1:
-            l = f.readline()
-            if not l:                   # end of file
-                nextName = None
+class PrefixStore(object):
+    """
+    The smallest read store that cluster extraction can run on: besides
+    the read names, only the length and the first 'width' bases of each
+    read are kept, in compact arrays, so memory doesn't grow with the
+    length of the reads.  length(i), prefix(i, n) and prefix_key(i, n)
+    (for n up to 'width') work as for SequenceStore, but there is no
+    sequence(i); the sequences are read again, in file order, through
+    records().
+
+    Unlike FastaIndex it works on any file load_store() reads, including
+    gzip and BGZF files and files with Mac EOLs.  Raises ValueError if the
+    file isn't FASTA.
+    """
+
+    def __init__(self, filename, width):
+        self.filename = filename
+        self.width = width
+        self.ids = read_ids.ReadIds()
+        self.lengths = array('l')
+        # First 'width' bases of read i at [i * width, (i + 1) * width),
+        # padded with NULs if the read is shorter
+        self.prefixes = bytearray()
+        # Reads whose name appears more than once, and how many times; as in
+        # load_store(), the last record wins
+        self.repeated = {}
+
+        f = open_fasta(filename)
+        try:
+            for name, sequence in iterload(f):
+                i = self.ids.intern(name.split(' ')[0])
+                if i == len(self.lengths):
+                    self.lengths.append(len(sequence))
+                    self.prefixes += sequence[:width].ljust(width, '\0')
+                else:
+                    self.lengths[i] = len(sequence)
+                    self.prefixes[i * width:(i + 1) * width] = sequence[:width].ljust(width, '\0')
+                    self.repeated[i] = self.repeated.get(i, 1) + 1
+        finally:
+            f.close()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def length(self, i):
+        return self.lengths[i]
+
+    def prefix(self, i, n):
+        if n > self.width:
+            raise ValueError('only the first %d bases of each read are kept' % (self.width,))
+        start = i * self.width
+        return str(self.prefixes[start:start + n]).rstrip('\0')
+
+    prefix_key = prefix
+
+    def records(self):
+        """
+        Reads the FASTA file again and yields (ID, sequence) for each read
+        in file order, skipping records replaced by a later one with the
+        same name.  Raises ValueError if the file has changed since the
+        store was built.
+        """
+        repeated = dict(self.repeated)
+        f = open_fasta(self.filename)
+        try:
+            for name, sequence in iterload(f):
+                i = self.ids.get(name.split(' ')[0])
+                if i in repeated:
+                    repeated[i] = repeated[i] - 1
+                    if repeated[i]:
+                        continue
+                if i is None or len(sequence) != self.lengths[i]:
+                    raise ValueError('%s has changed since it was first read' % (self.filename,))
+                yield i, sequence
+        finally:
+            f.close()
+# end PrefixStore
+
+#
+# Packed sequences
+#
+# Sequences are packed 2 bits per base (A=0, C=1, G=2, T=3, first base in the
+# high bits) into one bytearray, each starting on a byte boundary, with the
+# byte offset and length of each in array('l')s.  Anything else (N, IUPAC
+# codes, gaps) is packed as an A and recorded as a (position, bases) run in a
+# side table, which most reads have no entry in.  A read costs a quarter of a
+# byte per base plus 16 bytes, against about a byte per base plus 40 bytes for
+# a str.
+#
+
+def _packing_tables():
+    """
+    Returns a dict from every 4 base string to its packed byte, and a list
+    from every byte value to its 4 bases.
+    """
+    pack = {}
+    unpack = []
+    for code in range(256):
+        bases = ''.join(['ACGT'[(code >> shift) & 3] for shift in (6, 4, 2, 0)])
+        pack[bases] = chr(code)
+        unpack.append(bases)
+    return pack, unpack
+
+_pack, _unpack = _packing_tables()
+
+_not_acgt = re.compile('[^ACGT]+')
+
+class PackedSequences(object):
+    """
+    A list of DNA sequences packed 2 bits per base.  append(sequence)
+    returns its index i; sequence(i), length(i), prefix(i, n) and
+    prefix_key(i, n) work as for SequenceStore.  prefix() only unpacks the
+    bytes it needs, and prefix_key() doesn't unpack at all: it compares the
+    packed bytes.  Any characters can be stored, but only A, C, G and T
+    are packed.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('l')
+        self.lengths = array('l')
+        self.exceptions = {}
+
+    def append(self, sequence):
+        self.offsets.append(0)
+        self.lengths.append(0)
+        i = len(self.offsets) - 1
+        self.replace(i, sequence)
+        return i
+
+    def replace(self, i, sequence):
+        """
+        Replaces sequence i.  The old sequence's bytes are not reused.
+        """
+        runs = [(m.start(), m.group()) for m in _not_acgt.finditer(sequence)]
+        if runs:
+            self.exceptions[i] = tuple(runs)
+            sequence = _not_acgt.sub(lambda m: 'A' * len(m.group()), sequence)
+        elif i in self.exceptions:
+            del self.exceptions[i]
+
+        whole = len(sequence) & ~3
+        pack = _pack
+        self.offsets[i] = len(self.data)
+        self.lengths[i] = len(sequence)
+        self.data += ''.join([pack[sequence[k:k + 4]] for k in xrange(0, whole, 4)])
+        if whole < len(sequence):
+            self.data += pack[sequence[whole:].ljust(4, 'A')]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _decode(self, i, n):
+        """
+        The first n bases of sequence i, with the exceptions put back.
+        """
+        offset = self.offsets[i]
+        raw = self.data[offset:offset + (n + 3) // 4]
+        bases = ''.join([_unpack[b] for b in raw])[:n]
+        for (position, run) in self.exceptions.get(i, ()):
+            if position >= n:
                 break
-            elif l[0] == '>':           # end of sequence
-                nextName = l
+            bases = bases[:position] + run + bases[position + len(run):]
+        return bases[:n]
+
+    def sequence(self, i):
+        return self._decode(i, self.lengths[i])
+
+    def length(self, i):
+        return self.lengths[i]
+
+    def prefix(self, i, n):
+        return self._decode(i, min(n, self.lengths[i]))
+
+    def prefix_key(self, i, n):
+        """
+        The packed bytes of the first n bases of sequence i, with the unused
+        bits of the last byte cleared.  A sequence shorter than n, or with
+        other bases in its first n, gets a tuple that also holds the number
+        of bases and the other bases, so keys are only equal when the
+        prefixes are.
+        """
+        m = min(n, self.lengths[i])
+        offset = self.offsets[i]
+        raw = self.data[offset:offset + (m + 3) // 4]
+        if m & 3:
+            raw[-1] = raw[-1] & (0xff << (8 - 2 * (m & 3))) & 0xff
+        key = str(raw)
+
+        runs = self.exceptions.get(i)
+        if runs and runs[0][0] < m:
+            return (key, m, tuple([(position, run[:m - position]) for (position, run) in runs if position < m]))
+        if m < n:
+            return (key, m, ())
+        return key
+# end PackedSequences
+
+class PackedReadStore(PackedSequences):
+    """
+    A read store (see SequenceStore) holding its reads as PackedSequences,
+    for keeping large read sets in memory.  Reads are interned in a
+    read_ids.ReadIds table ('ids'); add(name, sequence) replaces an earlier
+    read with the same name.
+    """
+
+    def __init__(self):
+        PackedSequences.__init__(self)
+        self.ids = read_ids.ReadIds()
+
+    def add(self, name, sequence):
+        i = self.ids.intern(name)
+        if i == len(self.offsets):
+            self.append(sequence)
+        else:
+            self.replace(i, sequence)
+        return i
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __getitem__(self, name):
+        return self.sequence(self.ids[name])
+
+    def extend(self, names, sequences):
+        """
+        Adds the reads of a PackedSequences, named by the list 'names', as
+        add() would one at a time, but without unpacking them.
+        """
+        shift = len(self.data)
+        self.data += sequences.data
+        for k in xrange(len(names)):
+            i = self.ids.intern(names[k])
+            if i == len(self.offsets):
+                self.offsets.append(sequences.offsets[k] + shift)
+                self.lengths.append(sequences.lengths[k])
+            else:
+                self.offsets[i] = sequences.offsets[k] + shift
+                self.lengths[i] = sequences.lengths[k]
+                if i in self.exceptions:
+                    del self.exceptions[i]
+            if k in sequences.exceptions:
+                self.exceptions[i] = sequences.exceptions[k]
+# end PackedReadStore
+
+def load_packed(f, strict=0):
+    """
+    Loads sequences in FASTA format from the given file object into a
+    PackedReadStore, keyed (like cd-hit) on the header up to the first space.
+    """
+    store = PackedReadStore()
+    for name, sequence in iterload(f, strict):
+        store.add(name.split(' ')[0], sequence)
+    return store
+
+#
+# Parallel loading
+#
+# A FASTA file is split into byte ranges that each start at a record (a '>'
+# at the start of a line), the ranges are parsed in a pool of processes into
+# PackedSequences, and those are merged in file order, so the read IDs come
+# out in the same order as from load_packed().  Each worker returns its
+# sequences already packed, so a quarter of the sequence data is passed back.
+#
+
+def record_ranges(filename, parts):
+    """
+    Splits a FASTA file into at most 'parts' (start, end) byte ranges
+    that each begin with a record, covering every record in the file.
+    Raises ValueError if there are no records.
+    """
+    size = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    try:
+        starts = [_next_record(f, 0)]
+        if starts[0] < 0:
+            raise ValueError("Error! no beginning '>'")
+        for k in range(1, parts):
+            start = _next_record(f, max(size * k // parts, starts[-1] + 1))
+            if start < 0:
                 break
+            if start > starts[-1]:
+                starts.append(start)
+    finally:
+        f.close()
 
-            sequence = sequence + string.rstrip(l)
-        # end while 1
+    return zip(starts, starts[1:] + [size])
+
+def _next_record(f, pos, blocksize=1 << 16):
+    """
+    The offset of the first record starting at or after 'pos', or -1.
+    """
+    if pos == 0:
+        f.seek(0)
+        if f.read(1) == '>':
+            return 0
+        pos = 1
+    f.seek(pos - 1)
+    carry = ''
+    base = pos - 1
+    while 1:
+        block = f.read(blocksize)
+        if not block:
+            return -1
+        found = (carry + block).find('\n>')
+        if found >= 0:
+            return base - len(carry) + found + 1
+        carry = block[-1:]
+        base = base + len(block)
+
+class _RangeReader(object):
+    """
+    A file object reading only bytes [start, end) of a file.
+    """
 
-        sequence = string.upper(sequence)
-        sequence = string.join(string.split(sequence), '')
+    def __init__(self, f, start, end):
+        self._file = f
+        self._left = end - start
+        f.seek(start)
+
+    def read(self, size):
+        data = self._file.read(min(size, self._left))
+        self._left = self._left - len(data)
+        return data
+
+def _load_range(args):
+    (filename, start, end) = args
+    names = []
+    sequences = PackedSequences()
+    f = open(filename, 'rb')
+    try:
+        for name, sequence in iterload(_RangeReader(f, start, end)):
+            names.append(name.split(' ')[0])
+            sequences.append(sequence)
+    finally:
+        f.close()
+    return names, sequences
+
+def load_parallel(filename, processes=None):
+    """
+    Loads a FASTA file into a PackedReadStore, as load_packed() does,
+    parsing it in 'processes' processes (by default one per core available).
+    gzip and BGZF files can't be split, so they are loaded serially.
+    """
+    processes = processes or resources.available_cores()
+    if processes == 1 or bgzf.is_gzip(filename):
+        return load_packed(open_fasta(filename))
 
-        if len(name) and len(sequence):
-            if strict and (is_protein(sequence) or is_dna(sequence)):
-                d[name] = sequence
-            elif not strict:
-                d[name] = sequence
-            else:
-                raise "Error, sequence contains illegal characters."
-            
-            sequence = ""
-            
-    # end while name
+    # A few ranges per process, so one slow range doesn't hold up the rest
+    ranges = record_ranges(filename, processes * 4)
 
-    return d
-# end load
+    pool = multiprocessing.Pool(processes)
+    try:
+        parts = pool.map(_load_range, [(filename, start, end) for (start, end) in ranges])
+    finally:
+        pool.close()
+        pool.join()
+
+    store = PackedReadStore()
+    for (names, sequences) in parts:
+        store.extend(names, sequences)
+    return store
 
 #
 # is_protein
@@ -214,5 +922,79 @@ def gc_content(sequence):
     gc_content = gc_count/seq_length
     return gc_content
 
+#
+# Batch versions
+#
+# The functions above test one character at a time in Python, and take one
+# sequence at a time.  These take a whole collection of sequences (a list, or
+# any iterable of them, e.g. from iterload() or a read store) and return the
+# results for all of them, with the per-character work done by str.translate()
+# in C: translating with the characters of interest deleted and comparing the
+# lengths checks or counts them in one pass over the sequence.  The functions
+# that upper-case first instead delete both cases, or (for the complement)
+# upper-case in the same translation.
+#
+# The results are the same as from the functions above, except where those
+# would raise an AssertionError for a sequence that isn't DNA (or a
+# ZeroDivisionError for an empty one): batch_reverse_complement() gives None for
+# it, and batch_gc_content() NaN.
+#
+
+_identity = string.maketrans('', '')
+_either_case_dna = legal_dna + legal_dna.lower()
+_complement_upper = string.maketrans(string.ascii_lowercase + 'ACTGactg',
+                                     string.ascii_uppercase + 'TGACTGAC')
+
+def batch_is_dna(sequences):
+    """
+    Returns an array of is_dna() for each sequence.
+    """
+    identity = _identity
+    return array('b', [not seq.translate(identity, legal_dna) for seq in sequences])
+
+def batch_is_protein(sequences):
+    """
+    Returns an array of is_protein() for each sequence.
+    """
+    identity = _identity
+    return array('b', [bool(seq.translate(identity, legal_dna)) and not seq.translate(identity, legal_protein)
+                       for seq in sequences])
 
+_force_dna = string.maketrans(''.join([chr(c) for c in range(256) if chr(c) not in legal_dna]),
+                              'N' * (256 - len(legal_dna)))
+
+def batch_force_dna(sequences):
+    """
+    Returns a list of force_dna() of each sequence.
+    """
+    table = _force_dna
+    return [' '.join(seq.split()).translate(table) for seq in sequences]
 
+def batch_reverse_complement(sequences):
+    """
+    Returns a list of reverse_complement() of each sequence, with None for
+    a sequence that isn't DNA.
+    """
+    identity = _identity
+    complements = []
+    for seq in sequences:
+        if seq.translate(identity, _either_case_dna):
+            complements.append(None)
+        else:
+            complements.append(seq[::-1].translate(_complement_upper))
+    return complements
+
+def batch_gc_content(sequences):
+    """
+    Returns an array of gc_content() for each sequence, with NaN for a
+    sequence that isn't DNA or is empty.
+    """
+    identity = _identity
+    nan = float('nan')
+    fractions = array('d')
+    for seq in sequences:
+        if not seq or seq.translate(identity, _either_case_dna):
+            fractions.append(nan)
+        else:
+            fractions.append((len(seq) - len(seq.translate(identity, 'GCgc'))) / float(len(seq)))
+    return fractions
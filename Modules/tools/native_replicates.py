@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+#
+# In-process replicate detection, as an alternative to running cd-hit-est.
+#
+# Artificial replicates are reads that start at the same position and are
+# nearly identical, so instead of clustering the whole run with cd-hit this
+# engine:
+#
+#   1. buckets the reads by their first <initial base pair requirement> bases
+#      (reads in different buckets can never end up in the same replicate
+#      cluster),
+#   2. clusters each bucket greedily the way cd-hit does: longest reads
+#      first, each read joining the first representative it matches and
+#      otherwise becoming a new representative,
+#   3. finds candidate representatives by counting shared k-mers through an
+#      inverted index (with NumPy, when it is installed, to do the counting),
+#      and confirms them with a prefix/Hamming check, falling back to a
+#      banded alignment that allows for 454 homopolymer indels.
+#
+# Until its bucket is clustered, each read is held packed 2 bits per base in a
+# fasta.PackedSequences, so the whole run takes about a quarter of the memory
+# it would as strings.
+#
+# Identity is computed as cd-hit does: identical bases divided by the length
+# of the shorter read.  The results are written as a cd-hit style *.clstr
+# file plus representative FASTA, so extract-clusters-html.py treats them
+# exactly like cd-hit output.
+#
+
+"""
+Usage: native_replicates.py validate <first.clstr> <second.clstr>
+
+Compares two clusterings of the same reads (e.g. native engine vs cd-hit)
+and reports how well they agree.
+"""
+
+import sys
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import cdhit_parse
+import fasta
+
+
+# Word size, as for cd-hit-est -n 8
+word_size = 8
+
+
+#
+# Similarity checks
+#
+
+def kmers(sequence, k=word_size):
+    return set([sequence[i:i + k] for i in xrange(len(sequence) - k + 1)])
+
+
+def mismatches(short, longer, limit):
+    """
+    Counts mismatching positions of 'short' against the start of 'longer',
+    giving up (returning limit + 1) once more than 'limit' are found.
+    """
+    count = 0
+    for (a, b) in izip(short, longer):
+        if a != b:
+            count = count + 1
+            if count > limit:
+                break
+    return count
+
+
+def banded_edits(short, longer, limit):
+    """
+    Edit distance between 'short' and the best-matching prefix of 'longer',
+    computed only within 'limit' diagonals of the main one.  Returns
+    limit + 1 if it is more than 'limit'.
+    """
+    m, n = len(short), len(longer)
+    over = limit + 1
+
+    # previous[j - i + limit] holds the distance for short[:i] / longer[:j]
+    width = 2 * limit + 1
+    previous = [over] * limit + range(0, limit + 1)
+
+    for i in xrange(1, m + 1):
+        current = [over] * width
+        a = short[i - 1]
+        best = over
+        for d in xrange(width):
+            j = i + d - limit
+            if j < 0 or j > n:
+                continue
+            if j == 0:
+                cost = i
+            else:
+                cost = previous[d] + (a != longer[j - 1])
+                if d + 1 < width and previous[d + 1] + 1 < cost:
+                    cost = previous[d + 1] + 1
+                if d > 0 and current[d - 1] + 1 < cost:
+                    cost = current[d - 1] + 1
+            if cost > over:
+                cost = over
+            current[d] = cost
+            if cost < best:
+                best = cost
+        if best > limit:
+            return over
+        previous = current
+
+    return min(previous)
+
+
+def identity(short, longer, cutoff):
+    """
+    Returns the identity of 'short' against 'longer' if it is at least
+    'cutoff', otherwise None.
+    """
+    limit = int((1.0 - cutoff) * len(short) + 1e-9)
+
+    if longer.startswith(short):
+        return 1.0
+
+    edits = mismatches(short, longer, limit)
+    if edits > limit:
+        edits = banded_edits(short, longer, limit)
+        if edits > limit:
+            return None
+
+    return 1.0 - float(edits) / len(short)
+
+
+#
+# Clustering
+#
+
+class Bucket(object):
+    """
+    Greedy clustering of the reads that share one prefix.  Reads must be
+    added longest first.
+    """
+
+    def __init__(self, cutoff, length):
+        self.cutoff = cutoff
+        self.length = length
+        self.representatives = []
+        self.clusters = []
+        self.postings = {}
+
+    def _candidates(self, words, need):
+        """
+        Representatives sharing at least 'need' distinct k-mers with a read,
+        in the order they were created.
+        """
+        hits = []
+        for word in words:
+            posting = self.postings.get(word)
+            if posting:
+                hits.extend(posting)
+
+        if not hits:
+            return []
+
+        if numpy is not None:
+            counts = numpy.bincount(numpy.array(hits), minlength=len(self.representatives))
+            return numpy.flatnonzero(counts >= need).tolist()
+
+        counts = {}
+        for r in hits:
+            counts[r] = counts.get(r, 0) + 1
+        return sorted([r for r in counts if counts[r] >= need])
+
+    def add(self, name, sequence):
+        words = kmers(sequence)
+
+        # Every edit destroys at most word_size of the read's k-mers
+        limit = int((1.0 - self.cutoff) * len(sequence) + 1e-9)
+        need = len(words) - word_size * limit
+
+        if need > 0:
+            candidates = self._candidates(words, need)
+        else:
+            candidates = range(len(self.representatives))
+
+        for r in candidates:
+            (rep_name, rep_sequence) = self.representatives[r]
+            if len(sequence) < self.length * len(rep_sequence):
+                continue
+            ident = identity(sequence, rep_sequence, self.cutoff)
+            if ident is not None:
+                self.clusters[r].append((name, len(sequence), ident))
+                return
+
+        r = len(self.representatives)
+        self.representatives.append((name, sequence))
+        self.clusters.append([(name, len(sequence), None)])
+        for word in words:
+            self.postings.setdefault(word, []).append(r)
+
+
+def cluster(records, output_file, cutoff, length, prefix_length):
+    """
+    Clusters (name, sequence) records and writes cd-hit style output:
+    representative sequences to output_file and clusters to
+    output_file.clstr.  Returns (reads, clusters).
+    """
+    reads = fasta.PackedSequences()
+    names = []
+    buckets = {}
+    for (name, sequence) in records:
+        buckets.setdefault(sequence[:prefix_length], array('l')).append(reads.append(sequence))
+        names.append(name.split(' ')[0])
+    num_reads = len(reads)
+
+    clstr = open(output_file + '.clstr', 'w')
+    representatives = open(output_file, 'w')
+
+    cluster_id = 0
+    for key in sorted(buckets):
+        # Longest first; sort is stable, so ties keep input order
+        members = sorted(buckets.pop(key), key=reads.length, reverse=True)
+
+        bucket = Bucket(cutoff, length)
+        for i in members:
+            bucket.add(names[i], reads.sequence(i))
+
+        for r in xrange(len(bucket.representatives)):
+            clstr.write('>Cluster %d\n' % cluster_id)
+            for (i, (name, seq_length, ident)) in enumerate(bucket.clusters[r]):
+                if ident is None:
+                    clstr.write('%d\t%dnt, >%s... *\n' % (i, seq_length, name))
+                else:
+                    clstr.write('%d\t%dnt, >%s... at +/%.2f%%\n' % (i, seq_length, name, ident * 100))
+            representatives.write('>%s\n%s\n' % bucket.representatives[r])
+            cluster_id = cluster_id + 1
+
+    clstr.close()
+    representatives.close()
+
+    return num_reads, cluster_id
+
+
+#
+# Validation
+#
+
+def compare_clusterings(first, second):
+    """
+    Compares two *.clstr file objects covering the same reads.  Returns a
+    dict with pair-counting agreement: the number of read pairs clustered
+    together in both, in only one of them, the pair precision/recall of
+    'first' against 'second', the fraction of clusters that are identical
+    and the fraction of reads whose whole cluster is identical.
+    """
+    labels = {}
+    first_clusters = []
+    for c in cdhit_parse.iter_clusters(first):
+        for name in c.members:
+            labels[name] = len(first_clusters)
+        first_clusters.append(frozenset(c.members))
+
+    second_clusters = []
+    for c in cdhit_parse.iter_clusters(second):
+        second_clusters.append(frozenset(c.members))
+
+    pairs = lambda n: n * (n - 1) // 2
+
+    first_pairs = sum([pairs(len(c)) for c in first_clusters])
+    second_pairs = sum([pairs(len(c)) for c in second_clusters])
+
+    both = 0
+    for c in second_clusters:
+        overlap = {}
+        for name in c:
+            label = labels.get(name)
+            if label is not None:
+                overlap[label] = overlap.get(label, 0) + 1
+        both = both + sum([pairs(n) for n in overlap.itervalues()])
+
+    first_set = set(first_clusters)
+    same = [c for c in second_clusters if c in first_set]
+
+    return {
+        'reads': len(labels),
+        'first_clusters': len(first_clusters),
+        'second_clusters': len(second_clusters),
+        'pairs_both': both,
+        'pairs_first_only': first_pairs - both,
+        'pairs_second_only': second_pairs - both,
+        'pair_precision': float(both) / first_pairs if first_pairs else 1.0,
+        'pair_recall': float(both) / second_pairs if second_pairs else 1.0,
+        'identical_clusters': float(len(same)) / max(len(second_clusters), 1),
+        'reads_in_identical_clusters': float(sum([len(c) for c in same])) / max(len(labels), 1),
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'validate':
+        print __doc__
+        sys.exit(1)
+
+    result = compare_clusterings(open(sys.argv[2]), open(sys.argv[3]))
+
+    for key in ('reads', 'first_clusters', 'second_clusters', 'pairs_both',
+                'pairs_first_only', 'pairs_second_only', 'pair_precision',
+                'pair_recall', 'identical_clusters', 'reads_in_identical_clusters'):
+        print '%s\t%s' % (key, result[key])
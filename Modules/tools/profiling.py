@@ -0,0 +1,137 @@
+#
+# Per-stage instrumentation for the replicate filter scripts.
+#
+# A Profile runs the stages of a dereplication run (writing the reads for
+# cd-hit, cd-hit itself, loading the reads, parsing the *.clstr file, splitting
+# the clusters, writing the outputs) and records the wall time, CPU time, peak
+# RSS and number of items of each, so the time and memory a run needs (e.g.
+# its h_vmem request) can be read off earlier runs.  cd-hit runs as a child
+# process, so its CPU time and peak RSS are taken from the usage of the
+# children.  Peak RSS is the high-water mark of the process, so a stage's
+# figure includes the stages before it.
+#
+# The record is rewritten as JSON (atomically) as each stage starts and ends,
+# naming the stage that is running, so a run that is killed (for going over
+# its h_vmem, say) still shows where it was.
+#
+# With a cProfile directory, the Python stages are also run under cProfile,
+# each dumping its statistics to <stage>.prof (for pstats) and its most
+# expensive functions to <stage>.txt.
+#
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import resource
+
+import atomic
+
+
+def _usage(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+
+class Profile(object):
+    """
+    Records the stages run through it, writing the record to 'path' (if
+    given) as it goes, and profiling the Python stages with cProfile into
+    'cprofile_dir' (if given).
+    """
+
+    # The number of functions listed in each <stage>.txt
+    top = 40
+
+    def __init__(self, path=None, cprofile_dir=None):
+        self.path = path
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+        self.running = None
+        self.start = time.time()
+
+        if cprofile_dir and not os.path.isdir(cprofile_dir):
+            os.makedirs(cprofile_dir)
+
+    def run(self, name, function, *args):
+        """
+        Runs function(*args) as the stage 'name', and returns its result.
+        """
+        if self.cprofile_dir:
+            profiler = cProfile.Profile()
+            result = self._run(name, profiler.runcall, function, *args)
+            self._dump(name, profiler)
+            return result
+        return self._run(name, function, *args)
+
+    def run_child(self, name, function, *args):
+        """
+        As run(), for a stage whose work is done by a child process (so
+        there is nothing for cProfile to see).
+        """
+        return self._run(name, function, *args)
+
+    def count(self, items):
+        """
+        Sets the number of items (reads, clusters) the last stage handled.
+        """
+        self.stages[-1]['items'] = items
+        self.write()
+
+    def _run(self, name, function, *args):
+        self.running = name
+        self.write()
+
+        wall = time.time()
+        (cpu, rss) = _usage(resource.RUSAGE_SELF)
+        (child_cpu, child_rss) = _usage(resource.RUSAGE_CHILDREN)
+
+        result = function(*args)
+
+        stage = {
+            'stage': name,
+            'wall': time.time() - wall,
+            'items': None,
+        }
+        (stage['cpu'], stage['peak_rss_mb']) = _usage(resource.RUSAGE_SELF)
+        (stage['child_cpu'], stage['child_peak_rss_mb']) = _usage(resource.RUSAGE_CHILDREN)
+        stage['cpu'] = stage['cpu'] - cpu
+        stage['child_cpu'] = stage['child_cpu'] - child_cpu
+
+        self.stages.append(stage)
+        self.running = None
+        self.write()
+        return result
+
+    def _dump(self, name, profiler):
+        prefix = os.path.join(self.cprofile_dir, name)
+        profiler.dump_stats(prefix + '.prof')
+        out = open(prefix + '.txt', 'w')
+        try:
+            pstats.Stats(prefix + '.prof', stream=out).sort_stats('cumulative').print_stats(self.top)
+        finally:
+            out.close()
+
+    def record(self):
+        """
+        The record as a dict: the stages so far, the one running (if any),
+        and the totals.
+        """
+        (cpu, rss) = _usage(resource.RUSAGE_SELF)
+        (child_cpu, child_rss) = _usage(resource.RUSAGE_CHILDREN)
+        return {
+            'stages': self.stages,
+            'running': self.running,
+            'wall': time.time() - self.start,
+            'cpu': cpu,
+            'child_cpu': child_cpu,
+            'peak_rss_mb': rss,
+            'child_peak_rss_mb': child_rss,
+            'python': sys.version.split()[0],
+            'updated': time.time(),
+        }
+
+    def write(self):
+        if self.path:
+            atomic.write_json(self.path, self.record())
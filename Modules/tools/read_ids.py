@@ -0,0 +1,47 @@
+#
+# Read ID interning for the replicate filter scripts.
+#
+# Read names like FLTSILN01EJKEM are stored once here and every other
+# structure (FASTA indexes, cluster tables) refers to a read by its integer
+# ID, which can be held in a compact array('l').
+#
+
+
+class ReadIds(object):
+    """
+    Interns read names to consecutive integer IDs, starting at 0 in the
+    order the names are first seen.
+
+    ids[name] returns the ID of a known name (KeyError otherwise), and
+    ids.names[i] the name for an ID.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._ids = {}
+
+    def intern(self, name):
+        """
+        Returns the ID for 'name', assigning the next free ID if it is new.
+        """
+        i = self._ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self._ids[name] = i
+            self.names.append(name)
+        return i
+
+    def get(self, name, default=None):
+        return self._ids.get(name, default)
+
+    def __getitem__(self, name):
+        return self._ids[name]
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
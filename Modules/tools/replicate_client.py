@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+#
+# Sends a dereplication job to replicate_server.py and waits for it.
+#
+# Takes the same arguments as extract_replicates.py, so it can stand in for it
+# wherever a server is running; the job runs in one of the server's warm
+# workers instead of a new interpreter (or a new qsub job).
+#
+
+"""
+Usage: replicate_client.py [options] <input filename> <sequence identity cutoff> <length difference requirement> <initial base pair requirement> <output directory>
+       replicate_client.py [options] --status
+       replicate_client.py [options] --print-socket
+
+Exit codes:
+  0   the job completed (or, with --no-wait, was accepted)
+  1   the job failed; the error is printed to stderr
+  2   the server can't be reached (Dereplicate.pm then submits the job with qsub)
+  64  the arguments are wrong
+
+With --output NAME, prints the path of that output file (e.g. cluster_summary)
+instead of the summary.  --print-socket prints the socket the server is
+expected on, for callers that check for it before submitting (Dereplicate.pm).
+"""
+
+import os
+import sys
+import json
+import socket
+from optparse import OptionParser
+
+import batch_replicates_config
+import extract_replicates
+import wait_for_manifest
+
+
+# Exit codes (see the usage above); 64 is EX_USAGE from sysexits.h, as optparse
+# would otherwise exit with 2 for bad options too
+exit_failed = 1
+exit_unreachable = 2
+exit_usage = 64
+
+
+class ClientOptionParser(OptionParser):
+    """
+    An OptionParser that exits with exit_usage on a usage error.
+    """
+
+    def error(self, msg):
+        self.print_usage(sys.stderr)
+        self.exit(exit_usage, '%s: error: %s\n' % (self.get_prog_name(), msg))
+
+
+def request(socket_path, message):
+    """
+    Sends one request to the server and returns its reply.  Raises
+    socket.error if the server can't be reached.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(message) + '\n')
+        reply = connection.makefile('r').readline()
+    finally:
+        connection.close()
+
+    if not reply:
+        raise socket.error('the server closed the connection')
+    return json.loads(reply)
+
+
+def submit(socket_path, fasta_file, cutoff, length, bp, dirname, wait=True, **settings):
+    """
+    Submits a job and returns the server's reply: the job's result if
+    'wait', otherwise its acceptance.
+    """
+    return request(socket_path, {
+        'input': os.path.abspath(fasta_file),
+        'output_directory': os.path.abspath(dirname),
+        'cutoff': cutoff,
+        'length': length,
+        'bp': bp,
+        'wait': wait,
+        'settings': settings,
+    })
+
+
+if __name__ == '__main__':
+    parser = ClientOptionParser(usage=__doc__)
+    parser.add_option("--socket", dest="socket", default=batch_replicates_config.server_socket,
+                      help="Unix socket the server listens on (default from batch_replicates_config.py)")
+    parser.add_option("--status", dest="status", action="store_true", default=False,
+                      help="Print the server's job counts")
+    parser.add_option("--print-socket", dest="print_socket", action="store_true", default=False,
+                      help="Print the socket the server listens on and exit")
+    parser.add_option("--no-wait", dest="wait", action="store_false", default=True,
+                      help="Return once the job is queued; its completion.json marks the end")
+    parser.add_option("--output", dest="output",
+                      help="Print the path of this output file once the job is done")
+    parser.add_option("--engine", dest="engine", type="choice", choices=["cdhit", "native"], default="cdhit",
+                      help="Replicate detection engine, as for extract_replicates.py")
+    parser.add_option("--collapse-duplicates", dest="collapse", action="store_true", default=False,
+                      help="Collapse exact duplicate reads before cd-hit, as for extract_replicates.py")
+    parser.add_option("--compress-output", dest="compress", action="store_true", default=False,
+                      help="Write the output files gzip (BGZF) compressed")
+    parser.add_option("--low-memory", dest="low_memory", action="store_true", default=False,
+                      help="Extract the clusters in low-memory mode, as for extract_replicates.py")
+    parser.add_option("--memory-budget", dest="memory_budget", type="int", default=0,
+                      help="Extract the clusters through sorted files on disk in about MEMORY_BUDGET MB, as for extract_replicates.py")
+    parser.add_option("--packed", dest="packed", action="store_true", default=False,
+                      help="Load the reads into memory packed 2 bits per base, as for extract_replicates.py")
+
+    (options, args) = parser.parse_args()
+
+    if options.print_socket:
+        print options.socket
+        sys.exit(0)
+
+    try:
+        if options.status:
+            reply = request(options.socket, {'command': 'status'})
+            print 'queued %(queued)s  done %(done)s  failed %(failed)s' % reply
+            sys.exit(0)
+
+        if len(args) != 5:
+            parser.error('expected 5 arguments, got %d' % (len(args),))
+
+        (filename, cutoff, length, bp, dirname) = args
+        reply = submit(options.socket, filename, cutoff, length, bp, dirname, options.wait,
+                       engine=options.engine, collapse=options.collapse, compress=options.compress,
+                       low_memory=options.low_memory, memory_budget=options.memory_budget,
+                       packed=options.packed)
+    except socket.error, e:
+        sys.stderr.write('Cannot reach the replicate server on %s: %s\n' % (options.socket, e))
+        sys.exit(exit_unreachable)
+
+    if reply['status'] in ('error', 'failed'):
+        sys.stderr.write('%s\n' % (reply['error'],))
+        sys.exit(exit_failed)
+
+    if reply['status'] == 'accepted':
+        print 'Job %s accepted; %s/%s will mark its end' % (reply['id'], dirname, extract_replicates.manifest_name)
+        sys.exit(0)
+
+    if options.output:
+        manifest = wait_for_manifest.read_manifest(reply['manifest'])
+        print manifest['outputs'][options.output]
+    else:
+        print 'Number of reads: %(reads)s \nNumber of unique reads: %(unique)s \nPercent of reads that are replicates: %(percent)s %%\n' % reply
+        print "Your results are in the directory: %s\n" % (dirname)
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+#
+# A long-running dereplication service.
+#
+# Started once per node, it keeps a pool of worker processes with the
+# dereplication code already imported and takes jobs over a local Unix socket,
+# so a sample costs a socket round trip instead of a qsub, a job file and an
+# interpreter start.  replicate_client.py submits jobs; Dereplicate.pm uses it
+# when the server's socket exists.
+#
+# The protocol is one JSON object per line.  A job request is
+#
+#   {"input": <fasta file>, "cutoff": 0.97, "length": 0, "bp": 20,
+#    "output_directory": <dir>, "wait": true, "settings": {...}}
+#
+# where the paths are absolute, and "settings" holds optional keyword arguments
+# for extract_replicates.dereplicate() (engine, collapse, cache_dir, compress,
+# low_memory, memory_budget, packed).  A job without a cache_dir setting uses
+# batch_replicates_config.cdhit_cache_dir, as extract_replicates.py and
+# batch_replicates.py do; "cache_dir": null turns the cache off.
+# With "wait" the reply comes when the job is done:
+#
+#   {"status": "complete", "id": 3, "reads": ..., "unique": ..., "percent": ...,
+#    "seconds": ..., "manifest": <output dir>/completion.json}
+#
+# or {"status": "failed", "error": ...}; without it the reply is
+# {"status": "accepted", "id": 3} and the completion manifest signals the end.
+# {"command": "status"} returns the number of jobs queued, running and done.
+#
+
+"""
+Usage: replicate_server.py [options]
+
+Serves dereplication jobs on a Unix socket until interrupted.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import threading
+import SocketServer
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import batch_replicates
+import batch_replicates_config
+import resources
+import extract_replicates
+
+
+# Settings a job may pass through to extract_replicates.dereplicate()
+job_settings = ('engine', 'collapse', 'cache_dir', 'compress', 'low_memory', 'memory_budget', 'packed')
+
+
+def check_job(request):
+    """
+    Returns the dereplicate() arguments of a job request, or raises
+    ValueError with what is wrong with it.
+    """
+    try:
+        fasta_file = request['input']
+        dirname = request['output_directory']
+        cutoff = float(request['cutoff'])
+        length = float(request['length'])
+        bp = int(request['bp'])
+    except KeyError, e:
+        raise ValueError('the request has no %s' % (e.args[0],))
+    except (TypeError, ValueError):
+        raise ValueError('cutoff, length and bp must be numbers')
+
+    if not os.path.isabs(fasta_file) or not os.path.isabs(dirname):
+        raise ValueError('input and output_directory must be absolute paths')
+    if cutoff > 1.0 or cutoff < 0.85:
+        raise ValueError('cutoff must be between 0.85 and 1.0')
+    if length > 1.0:
+        raise ValueError('length must be between 0 and 1.0')
+    if bp < 0:
+        raise ValueError('bp must be 0 or more')
+
+    settings = {}
+    for (key, value) in (request.get('settings') or {}).iteritems():
+        if key not in job_settings:
+            raise ValueError('unknown setting %s' % (key,))
+        settings[str(key)] = value
+    settings.setdefault('cache_dir', batch_replicates_config.cdhit_cache_dir)
+
+    return fasta_file, dirname, cutoff, length, bp, settings
+
+
+class Jobs(object):
+    """
+    The server's pool of dereplication workers and its job counts.
+    """
+
+    def __init__(self, processes):
+        self.pool = Pool(processes)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.queued = 0
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, fasta_file, dirname, cutoff, length, bp, settings):
+        """
+        Queues a job and returns (id, AsyncResult).
+        """
+        self.lock.acquire()
+        try:
+            self.next_id = self.next_id + 1
+            job_id = self.next_id
+            self.queued = self.queued + 1
+        finally:
+            self.lock.release()
+
+        args = (job_id, fasta_file, dirname, cutoff, length, bp, settings)
+        return job_id, self.pool.apply_async(batch_replicates.run_sample, (args,), callback=self._finished)
+
+    def _finished(self, result):
+        (job_id, num_seq, num_unique, percent, error, seconds) = result
+        self.lock.acquire()
+        try:
+            self.queued = self.queued - 1
+            self.done = self.done + 1
+            if error:
+                self.failed = self.failed + 1
+        finally:
+            self.lock.release()
+        log('job %d %s in %.1f s' % (job_id, error and 'failed: ' + error or 'complete', seconds))
+
+    def status(self):
+        return {'status': 'ok', 'queued': self.queued, 'done': self.done, 'failed': self.failed}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def reply_for(dirname, result):
+    (job_id, num_seq, num_unique, percent, error, seconds) = result
+    reply = {
+        'id': job_id,
+        'seconds': seconds,
+        'manifest': os.path.join(dirname, extract_replicates.manifest_name),
+    }
+    if error:
+        reply.update({'status': 'failed', 'error': error})
+    else:
+        reply.update({'status': 'complete', 'reads': num_seq, 'unique': num_unique, 'percent': percent})
+    return reply
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        jobs = self.server.jobs
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a request must be a JSON object')
+                if request.get('command') == 'status':
+                    reply = jobs.status()
+                else:
+                    args = check_job(request)
+                    (job_id, pending) = jobs.submit(*args)
+                    log('job %d: %s -> %s' % (job_id, args[0], args[1]))
+                    if request.get('wait'):
+                        reply = reply_for(args[1], pending.get())
+                    else:
+                        reply = {'status': 'accepted', 'id': job_id}
+            except ValueError, e:
+                reply = {'status': 'error', 'error': str(e)}
+
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def log(message):
+    sys.stdout.write('%s\t%s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+    sys.stdout.flush()
+
+
+def serve(socket_path, processes):
+    """
+    Serves jobs on socket_path with a pool of 'processes' workers until
+    interrupted.
+    """
+    # A socket left behind by a server that died is replaced; a live one isn't
+    if os.path.exists(socket_path):
+        import socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise SystemExit('A server is already listening on %s' % (socket_path,))
+        except socket.error:
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    # Workers are forked before the server starts, and ignore SIGINT so an
+    # interrupt stops the server cleanly
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    jobs = Jobs(processes)
+    signal.signal(signal.SIGINT, handler)
+
+    server = Server(socket_path, RequestHandler)
+    server.jobs = jobs
+    os.chmod(socket_path, 0660)
+
+    log('serving on %s with %d workers' % (socket_path, processes))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        jobs.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--socket", dest="socket", default=batch_replicates_config.server_socket,
+                      help="Unix socket to listen on (default from batch_replicates_config.py)")
+    parser.add_option("--processes", dest="processes", type="int", default=0,
+                      help="Number of jobs to run at once (default: number of cores, or the slots granted by the grid engine, limited by memory)")
+
+    (options, args) = parser.parse_args()
+
+    # Sized as for a batch with one sample per core
+    processes = batch_replicates.pool_size(range(options.processes or resources.available_cores()),
+                                           options.processes)
+
+    try:
+        serve(options.socket, processes)
+    except KeyboardInterrupt:
+        log('stopped')
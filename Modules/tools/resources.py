@@ -0,0 +1,53 @@
+#
+# The cores and memory a replicate filter process may use.
+#
+# Kept apart from cdhit_plan.py, with no imports from the other scripts, so
+# that the low-level modules (fasta.py, bgzf.py) can size their thread and
+# process pools without depending on the planner, which itself imports them.
+#
+
+import os
+import resource
+import multiprocessing
+
+
+# Virtual memory (which h_vmem limits) over resident memory: the shared
+# libraries, and the malloc arena and stack reserved for each thread
+vmem_fixed_mb = 128
+vmem_thread_mb = 64
+
+
+def available_cores():
+    """
+    The cores this process may use: the slots the grid engine granted the
+    job (NSLOTS), or the machine's.
+    """
+    try:
+        return max(int(os.environ['NSLOTS']), 1)
+    except (KeyError, ValueError):
+        return multiprocessing.cpu_count()
+
+
+def available_memory():
+    """
+    Memory available for new processes in MB, from /proc/meminfo, and
+    within the address space limit, if there is one (the grid engine sets
+    it to h_vmem), less the virtual memory overhead.  None if neither can
+    be read.
+    """
+    memory = None
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                memory = int(line.split()[1]) // 1024
+                break
+    except (IOError, ValueError):
+        pass
+
+    limit = resource.getrlimit(resource.RLIMIT_AS)[0]
+    if limit != resource.RLIM_INFINITY:
+        limit = max((limit >> 20) - vmem_fixed_mb, 0)
+        if memory is None or limit < memory:
+            memory = limit
+
+    return memory
@@ -0,0 +1,197 @@
+#! /usr/bin/env python
+#
+# Parameter sweep for the 454 replicate filter.
+#
+# Tuning the sequence identity cutoff (REPLICATE_PERCENT) and the initial base
+# pair requirement (REPLICATE_START) by calling extract_replicates.py once per
+# combination re-reads the FASTA and re-runs cd-hit every time.  This script
+# runs cd-hit once per cutoff (in parallel, and through the cd-hit cache when
+# one is configured), parses each *.clstr once, and counts the unique reads for
+# every initial base pair requirement from the same clusters.
+#
+
+"""
+Usage: sweep_replicates.py <input filename> <sequence identity cutoffs> <length difference requirement> <initial base pair requirements> <output directory>
+
+The cutoffs and initial base pair requirements are comma separated lists,
+e.g. 0.9,0.95,0.97 and 0,3,10,20.  The other arguments are as for
+extract_replicates.py.
+
+Writes <output directory>/sweep.txt, a table of the number of reads, unique
+reads and percent of replicates for every combination.
+"""
+
+import os
+import sys
+import time
+import hashlib
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import batch_replicates_config
+import cdhit_cache
+import resources
+import cdhit_run
+import extract_clusters
+import fasta
+
+
+def _run_cutoff(args):
+    (input_file, output_file, cutoff, length) = args
+    start = time.time()
+    (returncode, stderr) = cdhit_run.run_cdhit(input_file, output_file, cutoff, length, output_file + '.cd-hit')
+    return returncode, stderr, time.time() - start
+
+
+def run_cutoffs(input_file, output_files, cutoffs, length, processes, cache=None, input_digest=None):
+    """
+    Runs cd-hit-est on input_file once for each cutoff, writing the
+    corresponding output_files, with up to 'processes' at once.  Results
+    are taken from and added to 'cache' when it is given.
+
+    Returns (returncode, stderr) of the first run that failed, or (0, '').
+    """
+    keys = {}
+    todo = []
+    for (cutoff, output_file) in zip(cutoffs, output_files):
+        if cache:
+            keys[cutoff] = cdhit_cache.cache_key(input_digest, [cdhit_run.cdhit_command('', '', cutoff, length)])
+            if cache.fetch(keys[cutoff], output_file) is not None:
+                continue
+        todo.append((input_file, output_file, cutoff, length))
+
+    pool = Pool(max(min(processes, len(todo)), 1))
+    try:
+        results = pool.map(_run_cutoff, todo, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    for ((input_file, output_file, cutoff, length), (returncode, stderr, seconds)) in zip(todo, results):
+        if returncode != 0:
+            return returncode, 'cutoff %s: %s' % (cutoff, stderr)
+        if cache:
+            cache.store(keys[cutoff], output_file, seconds)
+
+    return 0, ''
+
+
+def sweep(cluster_files, reads, bp_values):
+    """
+    Returns (cutoff index, bp, unique reads) rows for every *.clstr file in
+    cluster_files and every initial base pair requirement in bp_values.
+    """
+    rows = []
+    for (i, cluster_file) in enumerate(cluster_files):
+        cluster_table = extract_clusters.parse_clusters(open(cluster_file), reads)
+        counts = extract_clusters.count_unique(cluster_table, reads, bp_values)
+        for bp in bp_values:
+            rows.append((i, bp, counts[bp]))
+    return rows
+
+
+def _parse_list(value, kind):
+    return [kind(v) for v in value.split(',') if v.strip()]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--processes", dest="processes", type="int", default=resources.available_cores(),
+                      help="Number of cd-hit processes to run at once (default: number of cores, or the slots granted by the grid engine)")
+    parser.add_option("--cache-dir", dest="cache_dir", default=batch_replicates_config.cdhit_cache_dir,
+                      help="Directory to cache cd-hit results in (default from batch_replicates_config.py)")
+    parser.add_option("--no-cache", dest="cache_dir", action="store_const", const=None,
+                      help="Always run cd-hit, even if a cache directory is configured")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 5:
+        print __doc__
+        sys.exit(1)
+
+    (filename, cutoff_input, length_input, bp_input, dirname) = args
+
+    try:
+        cutoffs = _parse_list(cutoff_input, float)
+        length = float(length_input)
+        bp_values = sorted(set(_parse_list(bp_input, int)))
+    except ValueError:
+        print __doc__
+        sys.exit(2)
+
+    if not cutoffs or [c for c in cutoffs if c > 1.0 or c < 0.85]:
+        print "Please input cutoff values between 0.85 and 1.0"
+        sys.exit(2)
+
+    if length > 1.0:
+        print "Please input a length requirement value between 0 and 1.0"
+        sys.exit(2)
+
+    if not bp_values or bp_values[0] < 0:
+        print "Please input initial base pair requirements of 0 or more"
+        sys.exit(2)
+
+    try:
+        os.mkdir(dirname)
+        os.mkdir(dirname + '/tmp')
+    except OSError:
+        print "\nCannot make the directory", dirname, ".  Does it already exist?\n"
+        sys.exit(2)
+
+    try:
+        fasta_file = fasta.open_fasta(filename)
+    except IOError:
+        print "This file could not be opened"
+        sys.exit(2)
+
+    # Write the reads out once for all the cd-hit runs
+
+    start = time.time()
+
+    cache = None
+    input_digest = None
+    records = fasta.iterload(fasta_file)
+    if options.cache_dir:
+        cache = cdhit_cache.CdhitCache(options.cache_dir, batch_replicates_config.cdhit_cache_size)
+        input_digest = hashlib.sha1()
+        records = cdhit_cache.hashed(records, input_digest)
+
+    new_fasta_file = dirname + '/tmp/input_fasta_file.fa'
+    input_fasta_file = open(new_fasta_file, 'w')
+    try:
+        for (name, sequence) in records:
+            input_fasta_file.write('>%s\n%s\n' % (name, sequence))
+    except ValueError:
+        print 'This file does not seem to be a fasta file.  Please try again with a fasta file'
+        sys.exit(2)
+    input_fasta_file.close()
+
+    # Cluster once per cutoff
+
+    outputs = [dirname + '/tmp/cdhit_output_%s' % (cutoff,) for cutoff in cutoffs]
+
+    (returncode, stderr) = run_cutoffs(new_fasta_file, outputs, cutoffs, length, options.processes, cache, input_digest)
+    if returncode != 0:
+        print 'cd-hit failed'
+        print stderr
+        sys.exit(2)
+
+    # Count the unique reads for every combination
+
+    reads = extract_clusters.load_reads(new_fasta_file)
+    num_seq = float(len(reads))
+
+    table = open(dirname + '/sweep.txt', 'w')
+    table.write('File analyzed: %s\nLength difference requirement: %s\n' % (filename, length))
+    table.write('Cutoff\tInitial bp\tNumber of sequences\tNumber of unique reads\tPercent of repeats\n')
+
+    for (i, bp, num_unique) in sweep([o + '.clstr' for o in outputs], reads, bp_values):
+        percent = round((num_seq - num_unique) / num_seq * 100, 2)
+        line = '%s\t%s\t%d\t%d\t%s' % (cutoffs[i], bp, num_seq, num_unique, percent)
+        table.write(line + '\n')
+        print line
+
+    table.close()
+
+    print "\n%d combinations in %.1f s.  Your results are in the directory: %s\n" % (
+        len(cutoffs) * len(bp_values), time.time() - start, dirname)
@@ -0,0 +1,124 @@
+#
+# Checks that collapsing exact duplicates before cd-hit doesn't change the
+# outputs: extracting the clusters of the collapsed reads, with the
+# duplicates put back, writes the same four files, byte for byte, as
+# extracting the clusters of all the reads.
+#
+# Run from Modules/tools with:  python -m unittest discover -s tests
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import duplicates
+import extract_clusters
+import fasta
+
+from test_extract_clusters import write_clusters
+
+
+def write_collapsed(clstr_path, collapsed_path, duplicate_reads):
+    """
+    Writes the clusters in clstr_path to collapsed_path as cd-hit-est would
+    have written them for the collapsed reads, i.e. without the duplicates.
+    """
+    dropped = set()
+    for names in duplicate_reads.itervalues():
+        dropped.update(names)
+
+    out = open(collapsed_path, 'w')
+    m = 0
+    for line in open(clstr_path):
+        if line.startswith('>'):
+            out.write(line)
+            m = 0
+            continue
+        (number, rest) = line.split('\t', 1)
+        name = rest.split('>', 1)[1].split('...', 1)[0]
+        if name not in dropped:
+            out.write('%d\t%s' % (m, rest))
+            m = m + 1
+    out.close()
+
+
+class CollapseTest(unittest.TestCase):
+
+    bp_values = (0, 3, 20)
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fasta_path = os.path.join(self.dirname, 'reads.fa')
+        self.clstr_path = os.path.join(self.dirname, 'reads.clstr')
+        self.collapsed_path = os.path.join(self.dirname, 'collapsed.clstr')
+        write_clusters(self.fasta_path, self.clstr_path)
+
+        collapser = duplicates.DuplicateCollapser()
+        f = open(self.fasta_path)
+        try:
+            for record in collapser.collapse(fasta.iterload(f)):
+                pass
+        finally:
+            f.close()
+        self.duplicates = collapser.duplicates()
+        self.assertTrue(collapser.collapsed() > 0)
+        write_collapsed(self.clstr_path, self.collapsed_path, self.duplicates)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def read_outputs(self, outputs):
+        contents = {}
+        for key in ('cluster_summary', 'cluster_sizes', 'unique', 'fasta_clusters'):
+            contents[key] = open(outputs[key]).read()
+        return contents
+
+    def extract(self, clstr_path, reads, bp_match, duplicate_reads=None):
+        outfile = os.path.join(self.dirname, 'extracted_clusters')
+        cluster_file = open(clstr_path)
+        try:
+            result = extract_clusters.extract(cluster_file, reads, bp_match, duplicate_reads)
+        finally:
+            cluster_file.close()
+        return self.read_outputs(extract_clusters.write_outputs(result, outfile, self.fasta_path, self.fasta_path))
+
+    def assertCollapsedOutputs(self, load):
+        for bp_match in self.bp_values:
+            expected = self.extract(self.clstr_path, load(bp_match), bp_match)
+            outputs = self.extract(self.collapsed_path, load(bp_match), bp_match, self.duplicates)
+            for key in expected:
+                self.assertEqual(outputs[key], expected[key], '%s differs at bp %d' % (key, bp_match))
+
+    def test_index(self):
+        self.assertCollapsedOutputs(lambda bp_match: extract_clusters.load_reads(self.fasta_path))
+
+    def test_packed(self):
+        self.assertCollapsedOutputs(lambda bp_match: extract_clusters.load_reads(self.fasta_path, True))
+
+    def test_low_memory(self):
+        self.assertCollapsedOutputs(lambda bp_match: extract_clusters.scan_reads(self.fasta_path, bp_match))
+
+    def test_external(self):
+        outfile = os.path.join(self.dirname, 'extracted_clusters')
+        for bp_match in self.bp_values:
+            contents = []
+            for (clstr_path, duplicate_reads) in ((self.clstr_path, None), (self.collapsed_path, self.duplicates)):
+                cluster_file = open(clstr_path)
+                try:
+                    (summary, outputs) = extract_clusters.extract_external(cluster_file, self.fasta_path, bp_match,
+                                                                           outfile, self.fasta_path, self.fasta_path,
+                                                                           duplicate_reads, memory=1 << 16,
+                                                                           tmp_dir=self.dirname)
+                finally:
+                    cluster_file.close()
+                contents.append(self.read_outputs(outputs))
+            for key in contents[0]:
+                self.assertEqual(contents[1][key], contents[0][key], '%s differs at bp %d' % (key, bp_match))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+#
+# Checks that extract_clusters.py writes the same four output files, byte for
+# byte, as the original extract-clusters-html.py, whose clustering and output
+# code is kept below as it was.
+#
+# Run from Modules/tools with:  python -m unittest discover -s tests
+#
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+from operator import itemgetter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import extract_clusters
+import fasta
+
+
+#
+# The original extract-clusters-html.py
+#
+
+def original_read_clusters(cluster_list):
+    cluster_db = {}
+    cluster_db_count = {}
+
+    unique_list = []
+
+    clusters  = cluster_list.split('>Cluster ')
+
+    for line in clusters:
+        line = line.rstrip('\n')
+
+        sequences = []
+        count = 0
+
+        if len(line) > 0:
+            hits = line.split('\n')
+
+            for i in hits:
+                new = i.split(' ')
+
+                if len(new) == 1:
+                    key = new[0]
+                elif new[2] == '*':
+                    reference = new[1]
+                    reference = reference[:-3]
+                    reference = reference.lstrip('>')
+                    count = count + 1
+                    unique_list.append(reference)
+                elif len(new) == 4:
+                    seq = new[1]
+                    seq = seq[:-3]
+                    seq = seq.lstrip('>')
+                    sequences.append(seq)
+                    count = count + 1
+
+            sequences.insert(0, reference)
+
+            cluster_db[key] = sequences
+            cluster_db_count[key] = count
+
+    return cluster_db, cluster_db_count, unique_list
+
+
+def original_outputs(clstr_path, fasta_path, bp_match, input_name):
+    """
+    The four files extract-clusters-html.py wrote, keyed as in
+    extract_clusters.output_names().
+    """
+    fasta_dict_raw = fasta.load(open(fasta_path))
+    fasta_dict = {}
+    for fasta_key in fasta_dict_raw:
+        fasta_dict[fasta_key.split(' ')[0]] = fasta_dict_raw[fasta_key]
+
+    cluster_db, cluster_db_count, unique_list = original_read_clusters(open(clstr_path).read())
+    cluster_size_db = {}
+    cluster_keys = sorted(cluster_db_count.iteritems(), key=itemgetter(1), reverse=True)
+
+    def compare_bp(cluster_sequences, fasta_dictionary):
+        template_seq = fasta_dictionary[cluster_sequences[0]]
+        template = template_seq[0:bp_match]
+        new_cluster_list = []
+        revised_cluster_list = []
+        bp3_dict = {}
+        for seq in cluster_sequences:
+            bp3 = fasta_dictionary[seq][0:bp_match]
+            bp3_dict[seq] = bp3
+        for bp3_key in bp3_dict:
+            if bp3_dict[bp3_key] == template:
+                new_cluster_list.append(bp3_key)
+            elif bp3_dict[bp3_key] != template:
+                revised_cluster_list.append(bp3_key)
+        return new_cluster_list, revised_cluster_list
+
+    new_key = 0
+    cluster_set = {}
+    for cluster in cluster_keys:
+        new_key = new_key + 1
+        cluster_seqs = cluster_db[cluster[0]]
+        (new_cluster_list, revised_cluster_list) = compare_bp(cluster_seqs, fasta_dict)
+        cluster_set[new_key] = new_cluster_list
+        while revised_cluster_list:
+            (new_rev_cl, rev_rev_cl) = compare_bp(revised_cluster_list, fasta_dict)
+            new_key = new_key + 1
+            cluster_set[new_key] = new_rev_cl
+            if rev_rev_cl:
+                revised_cluster_list = rev_rev_cl
+                continue
+            else:
+                break
+
+    cluster_num_seq = {}
+    cluster_ref_seq = {}
+    for j in cluster_set:
+        ref_seq = cluster_set[j][0]
+        ref_seq_fasta = fasta_dict[cluster_set[j][0]]
+        for s in cluster_set[j]:
+            if (len(fasta_dict[s]) > len(ref_seq_fasta)):
+                ref_seq = s
+        cluster_ref_seq[j] = ref_seq
+        cluster_num_seq[j] = len(cluster_set[j])
+
+    num_seq = float(len(fasta_dict))
+    num_unique = float(len(cluster_set.keys()))
+    percent_float = (num_seq - num_unique)/num_seq*100
+    percent = round(percent_float, 2)
+
+    output = []
+    output_summary = []
+    output_clstr_size = []
+    output_unique = []
+
+    output_summary.append('File analyzed: %s\n454 Replicate Filter version 0.3\nNumber of sequences: %s  Number of unique reads: %s  Percent of repeats %s\n' % (input_name, num_seq, num_unique, percent,))
+    output_summary.append('Cluster\tRef sequence\tNum of seq\n')
+
+    output.append('File analyzed: %s' % (input_name))
+    for cluster_id in cluster_set:
+        output.append('\n----------------------------------------\nCluster %s   Reference sequence: %s Number of sequences: %s\n' % (cluster_id, cluster_ref_seq[cluster_id], cluster_num_seq[cluster_id],))
+        for item in cluster_set[cluster_id]:
+            output.append('>%s\n%s\n' % (item, fasta_dict[item],))
+        output_summary.append('%s\t%s\t%s\n' % (cluster_id, cluster_ref_seq[cluster_id], cluster_num_seq[cluster_id],))
+        if cluster_size_db.has_key(cluster_num_seq[cluster_id]):
+            cluster_size_db[cluster_num_seq[cluster_id]] = cluster_size_db[cluster_num_seq[cluster_id]] + 1
+        else:
+            cluster_size_db[cluster_num_seq[cluster_id]] = 1
+
+    output_clstr_size.append('File analyzed:\n%s\nCluster size\tNumber of clusters\n' % (fasta_path,))
+    for clstr_num_temp in sorted(cluster_size_db.iteritems(), reverse=False):
+        clstr_num = clstr_num_temp[0]
+        output_clstr_size.append('%s\t%s\n' % (clstr_num, cluster_size_db[clstr_num],))
+
+    for q in cluster_ref_seq:
+        output_unique.append('>%s\n%s\n' % (cluster_ref_seq[q], fasta_dict[cluster_ref_seq[q]]))
+
+    return {
+        'fasta_clusters': ''.join(output),
+        'cluster_summary': ''.join(output_summary),
+        'cluster_sizes': ''.join(output_clstr_size),
+        'unique': ''.join(output_unique),
+    }
+
+
+#
+# A fixed input
+#
+
+def write_clusters(fasta_path, clstr_path, num_clusters=600, seed=1):
+    """
+    Writes reads in clusters of replicates to fasta_path, in a shuffled
+    order, and their clusters to clstr_path as cd-hit-est writes them:
+    members by length, longest first, then in input order, the first one
+    the representative.  Some replicates start a base or two later, so
+    they are split off by the initial base pair requirement, and reads of
+    the same length make the representative depend on the member order.
+    """
+    rand = random.Random(seed)
+    clusters = []
+    reads = []
+    for k in xrange(num_clusters):
+        template = ''.join([rand.choice('ACGT') for x in xrange(400)])
+        members = []
+        for m in xrange(rand.choice([1, 1, 1, 2, 2, 3, 4, 6, 9])):
+            shift = rand.choice([0, 0, 0, 0, 1, 2])
+            sequence = template[shift:shift + rand.choice([150, 200, 200, 250, 300])]
+            members.append(len(reads))
+            reads.append(sequence)
+        clusters.append(members)
+
+    order = range(len(reads))
+    rand.shuffle(order)
+    ordinal = dict([(i, n) for (n, i) in enumerate(order)])
+
+    out = open(fasta_path, 'w')
+    for i in order:
+        out.write('>R%05d length=%d\n' % (i, len(reads[i])))
+        for j in xrange(0, len(reads[i]), 60):
+            out.write(reads[i][j:j + 60] + '\n')
+    out.close()
+
+    clstr = open(clstr_path, 'w')
+    for (k, members) in enumerate(clusters):
+        members.sort(key=lambda i: (-len(reads[i]), ordinal[i]))
+        clstr.write('>Cluster %d\n' % k)
+        for (m, i) in enumerate(members):
+            if m == 0:
+                clstr.write('%d\t%dnt, >R%05d... *\n' % (m, len(reads[i]), i))
+            else:
+                clstr.write('%d\t%dnt, >R%05d... at +/99.00%%\n' % (m, len(reads[i]), i))
+    clstr.close()
+
+
+class ExtractClustersTest(unittest.TestCase):
+
+    bp_values = (0, 3, 20)
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fasta_path = os.path.join(self.dirname, 'reads.fa')
+        self.clstr_path = os.path.join(self.dirname, 'reads.clstr')
+        write_clusters(self.fasta_path, self.clstr_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assertOriginalOutputs(self, outputs, bp_match):
+        expected = original_outputs(self.clstr_path, self.fasta_path, bp_match, self.fasta_path)
+        for key in ('cluster_summary', 'cluster_sizes', 'unique', 'fasta_clusters'):
+            self.assertEqual(open(outputs[key]).read(), expected[key], '%s differs at bp %d' % (key, bp_match))
+
+    def extract(self, reads, bp_match):
+        outfile = os.path.join(self.dirname, 'extracted_clusters')
+        cluster_file = open(self.clstr_path)
+        try:
+            result = extract_clusters.extract(cluster_file, reads, bp_match)
+        finally:
+            cluster_file.close()
+        return extract_clusters.write_outputs(result, outfile, self.fasta_path, self.fasta_path)
+
+    def test_index(self):
+        for bp_match in self.bp_values:
+            self.assertOriginalOutputs(self.extract(extract_clusters.load_reads(self.fasta_path), bp_match), bp_match)
+
+    def test_packed(self):
+        for bp_match in self.bp_values:
+            self.assertOriginalOutputs(self.extract(extract_clusters.load_reads(self.fasta_path, True), bp_match), bp_match)
+
+    def test_low_memory(self):
+        for bp_match in self.bp_values:
+            self.assertOriginalOutputs(self.extract(extract_clusters.scan_reads(self.fasta_path, bp_match), bp_match), bp_match)
+
+    def test_external(self):
+        outfile = os.path.join(self.dirname, 'extracted_clusters')
+        for bp_match in self.bp_values:
+            cluster_file = open(self.clstr_path)
+            try:
+                (summary, outputs) = extract_clusters.extract_external(cluster_file, self.fasta_path, bp_match, outfile,
+                                                                       self.fasta_path, self.fasta_path, memory=1 << 16,
+                                                                       tmp_dir=self.dirname)
+            finally:
+                cluster_file.close()
+            self.assertOriginalOutputs(outputs, bp_match)
+
+
+if __name__ == '__main__':
+    unittest.main()
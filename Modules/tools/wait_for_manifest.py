@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+#
+# Blocks until a dereplication run has written its completion manifest.
+#
+# extract_replicates.py and extract-clusters-html.py finish by renaming a JSON
+# manifest into place (see extract_clusters.write_manifest), so the manifest
+# existing means the run is over and every output it lists is complete.  This
+# waits for it with inotify on the manifest's directory, so it returns within
+# moments of the rename.  Where inotify isn't available (not Linux, no ctypes,
+# or the directory doesn't exist yet) it polls instead.
+#
+
+"""
+Usage: wait_for_manifest.py [options] <manifest>
+
+Waits for <manifest> to appear.  Exits with 0 if the run completed, 1 if it
+failed (the error is printed to stderr) and 2 on a timeout.  With --output
+NAME, prints the path of that output file (e.g. cluster_summary) from the
+manifest.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import struct
+from optparse import OptionParser
+
+
+# inotify events that can make the manifest appear: a rename into the
+# directory or a file being created or closed there
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+
+class Inotify(object):
+    """
+    A minimal inotify watch on one directory, through ctypes.  Raises
+    OSError if inotify isn't available.
+    """
+
+    def __init__(self, directory):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            init = libc.inotify_init
+            add_watch = libc.inotify_add_watch
+        except (ImportError, OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self.fd = init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+        if add_watch(self.fd, directory, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed on %s' % (directory,))
+
+    def wait(self, timeout):
+        """
+        Waits up to 'timeout' seconds for events, and returns the names of
+        the files they were about (empty on a timeout).
+        """
+        (ready, w, x) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        i = 0
+        while i + 16 <= len(data):
+            (wd, mask, cookie, size) = struct.unpack('iIII', data[i:i + 16])
+            names.append(data[i + 16:i + 16 + size].rstrip('\0'))
+            i = i + 16 + size
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_manifest(path):
+    """
+    The manifest at 'path' as a dict, or None if it isn't there (or
+    isn't whole) yet.
+    """
+    try:
+        return json.load(open(path))
+    except (IOError, ValueError):
+        return None
+
+
+def wait_for_manifest(path, timeout=None, poll=0.25, recheck=5.0):
+    """
+    Returns the manifest at 'path' once it exists, or None after 'timeout'
+    seconds.  With inotify, the directory is rechecked every 'recheck'
+    seconds anyway; without it, it is polled every 'poll' seconds.
+    """
+    deadline = timeout is not None and time.time() + timeout or None
+    directory = os.path.dirname(os.path.abspath(path))
+
+    def left(interval):
+        if deadline is None:
+            return interval
+        return max(min(interval, deadline - time.time()), 0)
+
+    watch = None
+    try:
+        while True:
+            if watch is None and os.path.isdir(directory):
+                try:
+                    watch = Inotify(directory)
+                except OSError:
+                    pass
+
+            # Check after setting the watch, so a rename in between isn't missed
+            record = read_manifest(path)
+            if record is not None:
+                return record
+
+            if deadline is not None and time.time() >= deadline:
+                return None
+
+            if watch is None:
+                time.sleep(left(poll))
+            else:
+                watch.wait(left(recheck))
+                if not os.path.isdir(directory):
+                    # The directory was removed; poll until it is back
+                    watch.close()
+                    watch = None
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--timeout", dest="timeout", type="float", default=None,
+                      help="Give up after TIMEOUT seconds (default: wait forever)")
+    parser.add_option("--poll", dest="poll", type="float", default=0.25,
+                      help="Seconds between checks when inotify can't be used (default: 0.25)")
+    parser.add_option("--output", dest="output",
+                      help="Print the path of this output file from the manifest")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print __doc__
+        sys.exit(2)
+
+    record = wait_for_manifest(args[0], options.timeout, options.poll)
+
+    if record is None:
+        sys.stderr.write('Timed out waiting for %s\n' % (args[0],))
+        sys.exit(2)
+
+    if record.get('status') != 'complete':
+        sys.stderr.write('%s: %s\n' % (args[0], record.get('error') or record.get('status')))
+        sys.exit(1)
+
+    if options.output:
+        output = record.get('outputs', {}).get(options.output)
+        if output is None:
+            sys.stderr.write('%s lists no %s output\n' % (args[0], options.output))
+            sys.exit(1)
+        print output